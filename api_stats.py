@@ -0,0 +1,179 @@
+import contextvars
+import functools
+import threading
+import time
+
+from telegram.request import HTTPXRequest
+
+from lanes import current_lane, lane_scheduler
+
+# Целевое число вызовов Bot API на одно срабатывание обработчика
+# (при закешированной подписке и стоке)
+HANDLER_API_BUDGET = {
+    "start_command": 1,
+    "handle_message": 1,
+    "handle_button_click": 1,
+    "show_settings_menu": 1,
+    "handle_settings_callback": 2,
+    "handle_subscription_check": 4,
+}
+
+class _Invocation:
+    """Вызовы Bot API в рамках одного срабатывания обработчика"""
+    __slots__ = ("name", "calls", "methods")
+
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.methods = {}
+
+_current_invocation = contextvars.ContextVar("current_invocation", default=None)
+
+class ApiCallStats:
+    """Счетчики исходящих вызовов Bot API и их задержки по обработчикам"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._handlers = {}
+
+    def _handler(self, name):
+        stats = self._handlers.get(name)
+        if stats is None:
+            stats = self._handlers[name] = {
+                "invocations": 0,
+                "calls": 0,
+                "over_budget": 0,
+                "methods": {},
+            }
+        return stats
+
+    def record_invocation(self, invocation):
+        """Сохраняет итоги срабатывания обработчика"""
+        budget = HANDLER_API_BUDGET.get(invocation.name)
+        with self._lock:
+            stats = self._handler(invocation.name)
+            stats["invocations"] += 1
+            stats["calls"] += invocation.calls
+            if budget is not None and invocation.calls > budget:
+                stats["over_budget"] += 1
+            for method, (count, errors, total_ms, max_ms) in invocation.methods.items():
+                self._add_method(stats, method, count, errors, total_ms, max_ms)
+
+    def record_call(self, handler, method, elapsed_ms, ok):
+        """Сохраняет вызов, сделанный вне обработчика (фоновые рассылки)"""
+        with self._lock:
+            stats = self._handler(handler)
+            stats["calls"] += 1
+            self._add_method(stats, method, 1, 0 if ok else 1, elapsed_ms, elapsed_ms)
+
+    @staticmethod
+    def _add_method(stats, method, count, errors, total_ms, max_ms):
+        method_stats = stats["methods"].setdefault(method, [0, 0, 0.0, 0.0])
+        method_stats[0] += count
+        method_stats[1] += errors
+        method_stats[2] += total_ms
+        method_stats[3] = max(method_stats[3], max_ms)
+
+    def snapshot(self):
+        """Текущие счетчики в виде словаря для JSON"""
+        with self._lock:
+            result = {}
+            for name, stats in self._handlers.items():
+                invocations = stats["invocations"]
+                result[name] = {
+                    "invocations": invocations,
+                    "calls": stats["calls"],
+                    "calls_per_invocation": round(stats["calls"] / invocations, 2) if invocations else None,
+                    "budget": HANDLER_API_BUDGET.get(name),
+                    "over_budget": stats["over_budget"],
+                    "methods": {
+                        method: {
+                            "count": count,
+                            "errors": errors,
+                            "avg_ms": round(total_ms / count, 1) if count else 0,
+                            "max_ms": round(max_ms, 1),
+                        }
+                        for method, (count, errors, total_ms, max_ms) in stats["methods"].items()
+                    },
+                }
+            return result
+
+    def format_report(self):
+        """Текстовый отчет для администратора"""
+        snapshot = self.snapshot()
+        if not snapshot:
+            return "📭 Вызовов Bot API еще не было"
+
+        lines = ["📡 ВЫЗОВЫ BOT API ПО ОБРАБОТЧИКАМ", ""]
+        for name, stats in sorted(snapshot.items(), key=lambda item: -item[1]["calls"]):
+            budget = stats["budget"]
+            line = f"{name}: {stats['calls']} вызовов"
+            if stats["invocations"]:
+                line += f", {stats['calls_per_invocation']}/срабатывание"
+            if budget is not None:
+                line += f" (бюджет {budget}, превышений {stats['over_budget']})"
+            lines.append(line)
+            for method, method_stats in sorted(stats["methods"].items()):
+                lines.append(
+                    f"├─ {method}: {method_stats['count']} шт, "
+                    f"ср. {method_stats['avg_ms']} мс, макс. {method_stats['max_ms']} мс, "
+                    f"ошибок {method_stats['errors']}"
+                )
+        return "\n".join(lines)
+
+api_stats = ApiCallStats()
+
+def track_handler(handler):
+    """Оборачивает обработчик PTB, чтобы считать его вызовы Bot API"""
+    @functools.wraps(handler)
+    async def wrapper(*args, **kwargs):
+        invocation = _Invocation(handler.__name__)
+        token = _current_invocation.set(invocation)
+        try:
+            return await handler(*args, **kwargs)
+        finally:
+            _current_invocation.reset(token)
+            api_stats.record_invocation(invocation)
+    return wrapper
+
+def label_invocation(name):
+    """Переименовывает текущее срабатывание (например, когда handle_message делегирует кнопке)"""
+    invocation = _current_invocation.get()
+    if invocation is not None:
+        invocation.name = name
+
+class InstrumentedRequest(HTTPXRequest):
+    """HTTPXRequest, который считает вызовы Bot API и их длительность.
+
+    Каждый запрос занимает слот своей полосы в LaneScheduler, поэтому
+    рассылки не вытесняют ответы пользователям из пула соединений
+    """
+
+    def __init__(self, *args, lanes=lane_scheduler, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.lanes = lanes
+
+    async def do_request(self, url, method, *args, **kwargs):
+        async with self.lanes.slot(current_lane()):
+            return await self._timed_request(url, method, *args, **kwargs)
+
+    async def _timed_request(self, url, method, *args, **kwargs):
+        api_method = url.rsplit("/", 1)[-1]
+        start = time.perf_counter()
+        ok = False
+        try:
+            result = await super().do_request(url, method, *args, **kwargs)
+            ok = True
+            return result
+        finally:
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            invocation = _current_invocation.get()
+            if invocation is None:
+                api_stats.record_call("background", api_method, elapsed_ms, ok)
+            else:
+                invocation.calls += 1
+                method_stats = invocation.methods.setdefault(api_method, [0, 0, 0.0, 0.0])
+                method_stats[0] += 1
+                method_stats[1] += 0 if ok else 1
+                method_stats[2] += elapsed_ms
+                method_stats[3] = max(method_stats[3], elapsed_ms)
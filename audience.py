@@ -0,0 +1,177 @@
+import heapq
+import threading
+from array import array
+from bisect import bisect_left
+
+from plants import ALERT_BIT, ALERT_KINDS, ALL_PLANTS_MASK, PLANT_BIT, PLANT_ORDER
+from registry import MERGE_THRESHOLD
+
+# Темы аудитории: растения и события, на которые подписываются отдельно
+_TOPICS = PLANT_ORDER + ALERT_KINDS
+_TOPIC_BIT = {**PLANT_BIT, **ALERT_BIT}
+
+def _find(ids, user_id):
+    i = bisect_left(ids, user_id)
+    return i if i < len(ids) and ids[i] == user_id else -1
+
+class AudienceIndex:
+    """Инвертированный индекс тема (растение или событие) -> пользователи, которым она видна.
+
+    Пользователи, которым видно все растения без подписок на события (настройки
+    по умолчанию), хранятся одним отсортированным массивом id и входят в любую
+    аудиторию растений без списков по темам. Остальные - отсортированный массив
+    id с параллельным массивом масок, а списки тем хранят позиции в этом массиве.
+    Изменения копятся в словаре поверх массивов и сливаются в новые массивы
+    пачкой, как в SubscriberRegistry. Аудитория стоит числа подходящих
+    пользователей, а не всех
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._merge_lock = threading.Lock()
+        # Видно все растения
+        self._all = array("q")
+        # Остальные: id по возрастанию и маски по тем же позициям
+        self._ids = array("q")
+        self._masks = array("I")
+        # тема -> позиции в _ids пользователей, которым она видна
+        self._postings = {topic: array("i") for topic in _TOPICS}
+        # Изменения поверх массивов: user_id -> маска или None (удален)
+        self._pending = {}
+        # На сколько изменения меняют число пользователей относительно массивов
+        self._delta = 0
+
+    def __len__(self):
+        with self._lock:
+            return len(self._all) + len(self._ids) + self._delta
+
+    def __contains__(self, user_id):
+        with self._lock:
+            return self._lookup(user_id) is not None
+
+    def load(self, rows):
+        """Добавляет в индекс пары (user_id, маска видимых растений); слияние - в вызывающем потоке"""
+        with self._lock:
+            for user_id, visible_mask in rows:
+                self._set(user_id, visible_mask)
+        if self._merge_due():
+            self._merge()
+
+    def set_user(self, user_id, visible_mask):
+        """Добавляет пользователя или обновляет его маску"""
+        with self._lock:
+            self._set(user_id, visible_mask)
+        self._maybe_merge()
+
+    def remove_user(self, user_id):
+        """Удаляет пользователя из индекса"""
+        with self._lock:
+            if user_id in self._pending or self._lookup(user_id) is not None:
+                self._set(user_id, None)
+        self._maybe_merge()
+
+    def visible_mask(self, user_id):
+        with self._lock:
+            return self._lookup(user_id)
+
+    def items(self):
+        """Пары (user_id, маска видимых растений)"""
+        with self._lock:
+            all_ids, ids, masks, pending = self._all, self._ids, self._masks, dict(self._pending)
+        result = [(user_id, ALL_PLANTS_MASK) for user_id in all_ids if user_id not in pending]
+        result += [(user_id, mask) for user_id, mask in zip(ids, masks) if user_id not in pending]
+        result += [(user_id, mask) for user_id, mask in pending.items() if mask is not None]
+        return result
+
+    def audience(self, topics):
+        """Пользователи, которым видна хотя бы одна из тем (растений или событий): {user_id: маска}"""
+        topics_mask = 0
+        for topic in topics:
+            topics_mask |= _TOPIC_BIT.get(topic, 0)
+        if not topics_mask:
+            return {}
+        with self._lock:
+            all_ids, ids, masks, postings, pending = self._all, self._ids, self._masks, self._postings, dict(self._pending)
+
+        result = dict.fromkeys(all_ids, ALL_PLANTS_MASK) if topics_mask & ALL_PLANTS_MASK else {}
+        for topic in topics:
+            for position in postings.get(topic, ()):
+                result[ids[position]] = masks[position]
+        # Изменения поверх массивов заменяют записи массивов
+        for user_id, mask in pending.items():
+            if mask is not None and mask & topics_mask:
+                result[user_id] = mask
+            else:
+                result.pop(user_id, None)
+        return result
+
+    def _lookup(self, user_id):
+        if user_id in self._pending:
+            return self._pending[user_id]
+        if _find(self._all, user_id) >= 0:
+            return ALL_PLANTS_MASK
+        position = _find(self._ids, user_id)
+        return self._masks[position] if position >= 0 else None
+
+    def _set(self, user_id, visible_mask):
+        before = self._lookup(user_id)
+        self._delta += (visible_mask is not None) - (before is not None)
+        self._pending[user_id] = visible_mask
+
+    def _merge_due(self):
+        # Порог растет с индексом: при потоковой загрузке массивы перестраиваются O(log n) раз
+        return len(self._pending) >= max(MERGE_THRESHOLD, (len(self._all) + len(self._ids)) // 4)
+
+    def _maybe_merge(self):
+        if self._merge_due() and not self._merge_lock.locked():
+            threading.Thread(target=self._merge, name="audience-merge", daemon=True).start()
+
+    def _merge(self):
+        """Перестраивает массивы и списки растений с накопленными изменениями вне блокировки"""
+        with self._merge_lock:
+            with self._lock:
+                all_ids, ids, masks, pending = self._all, self._ids, self._masks, dict(self._pending)
+                postings = self._postings
+
+            updates = sorted((user_id, mask) for user_id, mask in pending.items() if mask is not None)
+            last_id = max(all_ids[-1] if all_ids else -1 << 63, ids[-1] if ids else -1 << 63)
+            if min(pending, default=last_id + 1) > last_id:
+                # Потоковая загрузка по возрастанию id: копируем массивы и дописываем
+                new_all = array("q", all_ids)
+                new_ids = array("q", ids)
+                new_masks = array("I", masks)
+                postings = {topic: array("i", positions) for topic, positions in postings.items()}
+                rows = updates
+            else:
+                new_all = array("q")
+                new_ids = array("q")
+                new_masks = array("I")
+                postings = {topic: array("i") for topic in _TOPICS}
+                rows = heapq.merge(
+                    ((user_id, ALL_PLANTS_MASK) for user_id in all_ids if user_id not in pending),
+                    ((user_id, mask) for user_id, mask in zip(ids, masks) if user_id not in pending),
+                    updates,
+                )
+            topics_of_mask = {}
+            for user_id, mask in rows:
+                if mask == ALL_PLANTS_MASK:
+                    new_all.append(user_id)
+                    continue
+                topics = topics_of_mask.get(mask)
+                if topics is None:
+                    topics = topics_of_mask[mask] = [topic for topic in _TOPICS if mask & _TOPIC_BIT[topic]]
+                for topic in topics:
+                    postings[topic].append(len(new_ids))
+                new_ids.append(user_id)
+                new_masks.append(mask)
+
+            with self._lock:
+                self._all, self._ids, self._masks, self._postings = new_all, new_ids, new_masks, postings
+                # Изменения, пришедшие во время слияния, остаются поверх новых массивов
+                for user_id, mask in pending.items():
+                    if user_id in self._pending and self._pending[user_id] == mask:
+                        del self._pending[user_id]
+                self._delta = 0
+                for user_id, mask in self._pending.items():
+                    in_base = _find(new_all, user_id) >= 0 or _find(new_ids, user_id) >= 0
+                    self._delta += (mask is not None) - in_base
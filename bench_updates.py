@@ -0,0 +1,91 @@
+"""Нагрузочный тест обработки апдейтов.
+
+Прогоняет поток апдейтов через PerUserUpdateProcessor так же, как это делает
+Application (задача на каждый апдейт), с обработчиком, который имитирует
+ожидание Bot API и блокирующий запрос к БД (psycopg синхронный, обработчики
+уносят его в asyncio.to_thread). Печатает пропускную способность и задержки для
+разных уровней параллельности и проверяет порядок апдейтов каждого пользователя.
+С --db-on-loop запрос к БД блокирует цикл событий, как без to_thread.
+
+    python bench_updates.py --users 200 --updates 5 --latency 0.05 --db-latency 0.005 --concurrency 1,8,32,64
+"""
+import argparse
+import asyncio
+import random
+import time
+from types import SimpleNamespace
+
+from latency import percentile
+from update_processor import PerUserUpdateProcessor
+
+def make_update(user_id):
+    return SimpleNamespace(effective_user=SimpleNamespace(id=user_id), effective_chat=SimpleNamespace(id=user_id))
+
+async def run_level(concurrency, users, updates_per_user, latency, jitter, db_latency=0, db_on_loop=False):
+    processor = PerUserUpdateProcessor(concurrency)
+    seen = {}
+    durations = []
+    violations = 0
+
+    async def handler(user_id, seq, queued_at):
+        nonlocal violations
+        # check_subscription + ответ пользователю
+        await asyncio.sleep(latency * random.uniform(1 - jitter, 1 + jitter))
+        # add_user, чтение и запись настроек: синхронный запрос к БД
+        if db_latency:
+            if db_on_loop:
+                time.sleep(db_latency)
+            else:
+                await asyncio.to_thread(time.sleep, db_latency)
+        if seen.get(user_id, -1) != seq - 1:
+            violations += 1
+        seen[user_id] = seq
+        durations.append(time.perf_counter() - queued_at)
+
+    # Апдейты приходят вперемешку, как из getUpdates
+    order = [(user_id, seq) for seq in range(updates_per_user) for user_id in range(users)]
+    start = time.perf_counter()
+    async with processor:
+        tasks = [
+            asyncio.create_task(processor.process_update(make_update(user_id), handler(user_id, seq, time.perf_counter())))
+            for user_id, seq in order
+        ]
+        await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - start
+
+    return {
+        "concurrency": concurrency,
+        "updates": len(order),
+        "seconds": elapsed,
+        "throughput": len(order) / elapsed,
+        "p50_ms": percentile(durations, 50) * 1000,
+        "p99_ms": percentile(durations, 99) * 1000,
+        "violations": violations,
+    }
+
+async def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест PerUserUpdateProcessor")
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--updates", type=int, default=5, help="апдейтов на пользователя")
+    parser.add_argument("--latency", type=float, default=0.05, help="время обработки апдейта, с")
+    parser.add_argument("--jitter", type=float, default=0.5, help="разброс времени обработки, доля")
+    parser.add_argument("--db-latency", type=float, default=0.005, help="блокирующий запрос к БД в обработчике, с")
+    parser.add_argument("--db-on-loop", action="store_true", help="выполнять запрос к БД в цикле событий, без to_thread")
+    parser.add_argument("--concurrency", default="1,8,32,64")
+    args = parser.parse_args()
+
+    print(f"{'параллельно':>11} {'апдейтов':>9} {'секунд':>8} {'апд/с':>8} {'p50, мс':>9} {'p99, мс':>9} {'нарушений порядка':>18}")
+    baseline = None
+    for concurrency in [int(level) for level in args.concurrency.split(",")]:
+        result = await run_level(
+            concurrency, args.users, args.updates, args.latency, args.jitter, args.db_latency, args.db_on_loop
+        )
+        baseline = baseline or result["throughput"]
+        print(
+            f"{result['concurrency']:>11} {result['updates']:>9} {result['seconds']:>8.2f} "
+            f"{result['throughput']:>8.0f} {result['p50_ms']:>9.0f} {result['p99_ms']:>9.0f} "
+            f"{result['violations']:>18}  (x{result['throughput'] / baseline:.1f})"
+        )
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,18 +1,130 @@
 import psycopg
 import os
 import json
+import socket
+import threading
+import time
+import uuid
+from collections import deque
+from contextlib import contextmanager
 from datetime import datetime
 import logging
 
-# Настройка логирования
-logging.basicConfig(level=logging.INFO)
+from latency import TRACE_STAGES
+from plants import RARITY_ORDER
+
+# Логирование настраивается в logging_setup.setup_logging()
 logger = logging.getLogger(__name__)
 
+# Пауза между попытками переподключения после неудачи
+RECONNECT_INTERVAL = 10
+
+# Канал NOTIFY, по которому экземпляры бота сообщают друг другу об изменениях
+CHANGES_CHANNEL = os.getenv("CHANGES_CHANNEL", "plants_bot_changes")
+# Идентификатор этого экземпляра: свои уведомления слушатель пропускает
+NODE_ID = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+# Предел полезной нагрузки NOTIFY - 8000 байт; больший сток шлется ссылкой
+NOTIFY_PAYLOAD_LIMIT = 7500
+# Как часто слушатель просыпается без уведомлений (проверка живости соединения), секунд
+LISTEN_TIMEOUT = 30
+
+class _CountingQueue(deque):
+    """Очередь команд пайплайна, считающая Sync и первые PREPARE"""
+
+    def __init__(self, commands, counter):
+        super().__init__(commands)
+        self.counter = counter
+
+    def append(self, command):
+        name = getattr(getattr(command, "func", command), "__name__", "")
+        if name == "pipeline_sync":
+            self.counter.syncs += 1
+        elif name == "send_prepare":
+            self.counter.prepares += 1
+        super().append(command)
+
+class PipelineCounter:
+    """Сетевые проходы блока пайплайна: Sync и Flush, после которых клиент ждет ответа.
+    
+    psycopg таких счетчиков не дает, поэтому смотрим в очередь команд пайплайна
+    (Sync, PREPARE) и на чтения результатов с Flush внутри блока. Это внутренности
+    psycopg 3.2 - версия закреплена в requirements.txt
+    """
+
+    def __init__(self, pipeline):
+        self.syncs = 0
+        self.flushes = 0
+        self.prepares = 0
+        # Выход из блока: Flush при дочитывании результатов за Sync прохода не добавляет
+        self.closing = False
+        pipeline.command_queue = _CountingQueue(pipeline.command_queue, self)
+        fetch_gen = pipeline._fetch_gen
+
+        def counting_fetch_gen(*, flush):
+            if flush and not self.closing and pipeline.result_queue:
+                self.flushes += 1
+            return fetch_gen(flush=flush)
+
+        pipeline._fetch_gen = counting_fetch_gen
+
+    @property
+    def round_trips(self):
+        return self.syncs + self.flushes
+
+class DbCallStats:
+    """Число обращений, сетевых проходов, первых PREPARE, ошибок и время по методам Database"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._methods = {}
+
+    def record(self, method, round_trips, prepares, elapsed_ms, ok):
+        with self._lock:
+            stats = self._methods.setdefault(method, [0, 0, 0, 0, 0.0, 0.0])
+            stats[0] += 1
+            stats[1] += round_trips
+            stats[2] += prepares
+            stats[3] += 0 if ok else 1
+            stats[4] += elapsed_ms
+            stats[5] = max(stats[5], elapsed_ms)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                method: {
+                    "calls": calls,
+                    "round_trips": round_trips,
+                    "round_trips_per_call": round(round_trips / calls, 2) if calls else 0,
+                    "prepares": prepares,
+                    "errors": errors,
+                    "avg_ms": round(total_ms / calls, 2) if calls else 0,
+                    "max_ms": round(max_ms, 2),
+                }
+                for method, (calls, round_trips, prepares, errors, total_ms, max_ms) in self._methods.items()
+            }
+
 class Database:
     def __init__(self):
-        self.conn = None
-        self.connect()
-        self.init_tables()
+        # Подключаемся лениво при первом обращении, схему создает migrate.py
+        self._conn = None
+        self._connect_lock = threading.Lock()
+        self._next_connect_at = 0
+        # Пайплайн занимает соединение целиком, поэтому методы из разных потоков идут по очереди
+        self._lock = threading.Lock()
+        self.stats = DbCallStats()
+    
+    @property
+    def conn(self):
+        """Соединение с PostgreSQL (подключается при первом обращении и после обрыва)"""
+        if (self._conn is None or self._conn.closed) and time.monotonic() >= self._next_connect_at:
+            with self._connect_lock:
+                if (self._conn is None or self._conn.closed) and time.monotonic() >= self._next_connect_at:
+                    self.connect()
+                    if self._conn is None or self._conn.closed:
+                        self._next_connect_at = time.monotonic() + RECONNECT_INTERVAL
+        if self._conn is not None and self._conn.closed:
+            return None
+        return self._conn
     
     def connect(self):
         """Подключение к PostgreSQL"""
@@ -24,26 +136,64 @@ class Database:
                     logger.error("❌ DATABASE_URL не найден в переменных окружения")
                     return
                 
-                self.conn = psycopg.connect(database_url)
+                # autocommit: одиночные запросы не тратят проходы на BEGIN/COMMIT,
+                # транзакции открываются явно (_pipeline(transaction=True), init_tables)
+                self._conn = psycopg.connect(database_url, autocommit=True)
                 logger.info("✅ Успешное подключение к PostgreSQL с psycopg3")
                 break
                 
             except Exception as e:
                 logger.error(f"❌ Попытка {attempt + 1}/{max_retries}: Ошибка подключения к PostgreSQL: {e}")
                 if attempt < max_retries - 1:
-                    import time
                     time.sleep(2)
                 else:
                     logger.error("❌ Не удалось подключиться к PostgreSQL после всех попыток")
     
+    @contextmanager
+    def _pipeline(self, method, transaction=False):
+        """Запросы блока уходят на сервер одним пакетом - один сетевой проход.
+        
+        Выдает соединение: внутри блока запросы ставятся через conn.execute(),
+        результаты читаются из курсоров после выхода из блока. transaction=True
+        оборачивает запросы в BEGIN/COMMIT в том же пакете
+        """
+        conn = self.conn
+        start = time.perf_counter()
+        ok = False
+        counter = None
+        with self._lock:
+            try:
+                with conn.pipeline() as pipeline:
+                    counter = PipelineCounter(pipeline)
+                    try:
+                        if transaction:
+                            conn.execute("BEGIN")
+                        yield conn
+                        if transaction:
+                            conn.execute("COMMIT")
+                    finally:
+                        counter.closing = True
+                ok = True
+            finally:
+                if not ok and not conn.closed:
+                    # Сбрасываем прерванную транзакцию (вне транзакции ничего не делает)
+                    conn.rollback()
+                self.stats.record(
+                    method, counter.round_trips if counter else 0, counter.prepares if counter else 0,
+                    (time.perf_counter() - start) * 1000, ok
+                )
+    
     def init_tables(self):
-        """Создание таблиц если их нет"""
+        """Создание таблиц если их нет (вызывается из migrate.py, а не при каждом запуске).
+        
+        Возвращает, применилась ли схема: False должен остановить деплой
+        """
         if not self.conn:
             logger.error("❌ Нет подключения к БД для создания таблиц")
-            return
+            return False
             
         try:
-            with self.conn.cursor() as cur:
+            with self.conn.transaction(), self.conn.cursor() as cur:
                 # Таблица пользователей
                 cur.execute("""
                     CREATE TABLE IF NOT EXISTS users (
@@ -57,7 +207,11 @@ class Database:
                 cur.execute("""
                     CREATE TABLE IF NOT EXISTS user_settings (
                         user_id BIGINT PRIMARY KEY REFERENCES users(user_id) ON DELETE CASCADE,
-                        ignored_rarities JSONB DEFAULT '[]'::jsonb,
+                        ignored_mask SMALLINT NOT NULL DEFAULT 0,
+                        watched_plants INTEGER NOT NULL DEFAULT 0,
+                        ignored_plants INTEGER NOT NULL DEFAULT 0,
+                        digest_interval INTEGER NOT NULL DEFAULT 0,
+                        last_digest_at TIMESTAMP WITH TIME ZONE,
                         created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
                         updated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
                     )
@@ -76,16 +230,95 @@ class Database:
                 
                 # Индексы для производительности
                 cur.execute("CREATE INDEX IF NOT EXISTS idx_users_created ON users(created_at)")
-                cur.execute("CREATE INDEX IF NOT EXISTS idx_settings_rarities ON user_settings USING GIN (ignored_rarities)")
                 cur.execute("CREATE INDEX IF NOT EXISTS idx_stock_created ON current_stock(created_at DESC)")
                 
-                self.conn.commit()
-                logger.info("✅ Таблицы и индексы созданы/проверены")
+                # Трассы рестоков: смещения этапов в мс от публикации в Discord
+                cur.execute("""
+                    CREATE TABLE IF NOT EXISTS restock_traces (
+                        id SERIAL PRIMARY KEY,
+                        message_id TEXT,
+                        posted_at TIMESTAMP WITH TIME ZONE NOT NULL,
+                        detected_ms INTEGER,
+                        parsed_ms INTEGER,
+                        persisted_ms INTEGER,
+                        fanout_start_ms INTEGER,
+                        first_ms INTEGER,
+                        p50_ms INTEGER,
+                        p99_ms INTEGER,
+                        last_ms INTEGER,
+                        recipients INTEGER NOT NULL DEFAULT 0,
+                        delivered INTEGER NOT NULL DEFAULT 0
+                    )
+                """)
+                cur.execute("CREATE INDEX IF NOT EXISTS idx_traces_posted ON restock_traces(posted_at DESC)")
+                # Доставка по ярусам редкости: {ярус: {recipients, delivered, first, p50, last}}
+                cur.execute("ALTER TABLE restock_traces ADD COLUMN IF NOT EXISTS tiers JSONB")
+                
+                # Досинхронизация после старта из снимка читает только изменившихся пользователей
+                cur.execute("CREATE INDEX IF NOT EXISTS idx_users_last_active ON users(last_active)")
+                cur.execute("CREATE INDEX IF NOT EXISTS idx_settings_updated ON user_settings(updated_at)")
+                cur.execute("CREATE INDEX IF NOT EXISTS idx_settings_last_digest ON user_settings(last_digest_at)")
+                
+                self._migrate_ignored_rarities_to_mask(cur)
+                
+                # Списки растений (битовые маски по PLANT_ORDER)
+                cur.execute("ALTER TABLE user_settings ADD COLUMN IF NOT EXISTS watched_plants INTEGER NOT NULL DEFAULT 0")
+                cur.execute("ALTER TABLE user_settings ADD COLUMN IF NOT EXISTS ignored_plants INTEGER NOT NULL DEFAULT 0")
+                
+                # Режим доставки: 0 - мгновенно, иначе дайджест раз в digest_interval минут
+                cur.execute("ALTER TABLE user_settings ADD COLUMN IF NOT EXISTS digest_interval INTEGER NOT NULL DEFAULT 0")
+                cur.execute("ALTER TABLE user_settings ADD COLUMN IF NOT EXISTS last_digest_at TIMESTAMP WITH TIME ZONE")
+                
+                # Подписки на снаряжение и объявления (биты по ALERT_KINDS), по умолчанию выключены
+                cur.execute("ALTER TABLE user_settings ADD COLUMN IF NOT EXISTS alert_kinds SMALLINT NOT NULL DEFAULT 0")
+                
+                # Одно сообщение Discord - одна строка стока, сколько бы экземпляров его ни увидели
+                # (повторы раздували бы счетчики дайджестов). Старые дубли удаляем перед индексом
+                cur.execute("""
+                    DELETE FROM current_stock a USING current_stock b
+                    WHERE a.message_id = b.message_id AND a.id > b.id
+                """)
+                cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_stock_message ON current_stock(message_id)")
+                
+                # Какой экземпляр рассылает сообщение Discord: каждый опрашивает каналы сам
+                cur.execute("""
+                    CREATE TABLE IF NOT EXISTS fanout_claims (
+                        message_id TEXT PRIMARY KEY,
+                        node TEXT NOT NULL,
+                        claimed_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+                    )
+                """)
+                
+            logger.info("✅ Таблицы и индексы созданы/проверены")
+            return True
                 
         except Exception as e:
             logger.error(f"❌ Ошибка создания таблиц: {e}")
-            if self.conn:
-                self.conn.rollback()
+            return False
+    
+    def _migrate_ignored_rarities_to_mask(self, cur):
+        """Переводит старый JSONB-массив ignored_rarities в битовую маску ignored_mask"""
+        cur.execute(
+            """SELECT 1 FROM information_schema.columns
+            WHERE table_name = 'user_settings' AND column_name = 'ignored_rarities'"""
+        )
+        if not cur.fetchone():
+            return
+        
+        cur.execute("ALTER TABLE user_settings ADD COLUMN IF NOT EXISTS ignored_mask SMALLINT NOT NULL DEFAULT 0")
+        # Бит редкости = ее позиция в RARITY_ORDER, неизвестные редкости отбрасываются
+        cur.execute(
+            """UPDATE user_settings SET ignored_mask = COALESCE((
+                SELECT SUM(DISTINCT 1 << (array_position(%s::text[], r) - 1))
+                FROM jsonb_array_elements_text(ignored_rarities) AS r
+            ), 0)::smallint
+            WHERE jsonb_typeof(ignored_rarities) = 'array'""",
+            (RARITY_ORDER,)
+        )
+        logger.info(f"✅ Настройки {cur.rowcount} пользователей переведены на битовую маску")
+        
+        cur.execute("DROP INDEX IF EXISTS idx_settings_rarities")
+        cur.execute("ALTER TABLE user_settings DROP COLUMN ignored_rarities")
     
     def add_user(self, user_id):
         """Добавление пользователя"""
@@ -93,27 +326,35 @@ class Database:
             return False
             
         try:
-            with self.conn.cursor() as cur:
-                # Добавляем пользователя
-                cur.execute(
-                    "INSERT INTO users (user_id) VALUES (%s) ON CONFLICT (user_id) DO UPDATE SET last_active = CURRENT_TIMESTAMP",
-                    (user_id,)
+            with self._pipeline("add_user", transaction=True) as conn:
+                # Добавляем пользователя; о новом сообщаем остальным экземплярам
+                # (xmax = 0 только у вставленной строки, уведомление уйдет при COMMIT)
+                conn.execute(
+                    """WITH upsert AS (
+                        INSERT INTO users (user_id) VALUES (%(user_id)s)
+                        ON CONFLICT (user_id) DO UPDATE SET last_active = CURRENT_TIMESTAMP
+                        RETURNING xmax = 0 AS inserted
+                    )
+                    SELECT pg_notify(%(channel)s, %(payload)s) FROM upsert WHERE inserted""",
+                    {
+                        "user_id": user_id,
+                        "channel": CHANGES_CHANNEL,
+                        "payload": json.dumps({"type": "user", "node": NODE_ID, "user_id": user_id}),
+                    },
+                    prepare=True
                 )
                 # Добавляем/обновляем настройки
-                cur.execute(
-                    """INSERT INTO user_settings (user_id, ignored_rarities) 
-                    VALUES (%s, %s) 
+                conn.execute(
+                    """INSERT INTO user_settings (user_id) 
+                    VALUES (%s) 
                     ON CONFLICT (user_id) DO NOTHING""",
-                    (user_id, json.dumps([]))
+                    (user_id,), prepare=True
                 )
-                self.conn.commit()
-                logger.info(f"✅ Пользователь {user_id} добавлен/обновлен")
-                return True
+            logger.debug("✅ Пользователь %s добавлен/обновлен", user_id)
+            return True
                 
         except Exception as e:
             logger.error(f"❌ Ошибка добавления пользователя {user_id}: {e}")
-            if self.conn:
-                self.conn.rollback()
             return False
     
     def get_user_settings(self, user_id):
@@ -122,22 +363,29 @@ class Database:
             return self._get_default_settings()
             
         try:
-            with self.conn.cursor() as cur:
-                cur.execute(
-                    "SELECT ignored_rarities, created_at FROM user_settings WHERE user_id = %s",
-                    (user_id,)
+            with self._pipeline("get_user_settings") as conn:
+                cur = conn.execute(
+                    """SELECT ignored_mask, watched_plants, ignored_plants, created_at,
+                        digest_interval, EXTRACT(EPOCH FROM last_digest_at)::float8, alert_kinds
+                    FROM user_settings WHERE user_id = %s""",
+                    (user_id,), prepare=True
                 )
-                result = cur.fetchone()
-                
-                if result:
-                    return {
-                        "ignored_rarities": result[0] or [],
-                        "created_at": result[1].isoformat() if result[1] else datetime.now().isoformat()
-                    }
-                else:
-                    # Создаем настройки по умолчанию
-                    self.add_user(user_id)
-                    return self._get_default_settings()
+            result = cur.fetchone()
+            
+            if result:
+                return {
+                    "ignored_mask": result[0] or 0,
+                    "watched_plants": result[1] or 0,
+                    "ignored_plants": result[2] or 0,
+                    "created_at": result[3].isoformat() if result[3] else datetime.now().isoformat(),
+                    "digest_interval": result[4] or 0,
+                    "last_digest_at": result[5],
+                    "alert_kinds": result[6] or 0
+                }
+            else:
+                # Создаем настройки по умолчанию
+                self.add_user(user_id)
+                return self._get_default_settings()
                     
         except Exception as e:
             logger.error(f"❌ Ошибка получения настроек пользователя {user_id}: {e}")
@@ -146,66 +394,196 @@ class Database:
     def _get_default_settings(self):
         """Настройки по умолчанию"""
         return {
-            "ignored_rarities": [],
-            "created_at": datetime.now().isoformat()
+            "ignored_mask": 0,
+            "watched_plants": 0,
+            "ignored_plants": 0,
+            "created_at": datetime.now().isoformat(),
+            "digest_interval": 0,
+            "last_digest_at": None,
+            "alert_kinds": 0
         }
     
     def update_user_settings(self, user_id, settings):
-        """Обновление настроек пользователя"""
+        """Обновление настроек пользователя.
+        
+        При переходе на дайджест отсчет ведется от момента переключения,
+        при возврате к мгновенным уведомлениям время доставки сбрасывается
+        """
         if not self.conn:
             return False
             
         try:
-            with self.conn.cursor() as cur:
-                cur.execute(
-                    """UPDATE user_settings 
-                    SET ignored_rarities = %s, updated_at = CURRENT_TIMESTAMP 
-                    WHERE user_id = %s""",
-                    (json.dumps(settings.get("ignored_rarities", [])), user_id)
+            with self._pipeline("update_user_settings") as conn:
+                # Уведомление с новыми настройками - тем же запросом
+                conn.execute(
+                    """WITH updated AS (
+                        UPDATE user_settings 
+                        SET ignored_mask = %(ignored_mask)s, watched_plants = %(watched_plants)s,
+                            ignored_plants = %(ignored_plants)s, digest_interval = %(digest_interval)s,
+                            alert_kinds = %(alert_kinds)s,
+                            last_digest_at = CASE WHEN %(digest_interval)s > 0
+                                THEN COALESCE(last_digest_at, CURRENT_TIMESTAMP) END,
+                            updated_at = CURRENT_TIMESTAMP 
+                        WHERE user_id = %(user_id)s
+                        RETURNING user_id, ignored_mask, watched_plants, ignored_plants, digest_interval,
+                            last_digest_at, alert_kinds
+                    )
+                    SELECT pg_notify(%(channel)s, json_build_object(
+                        'type', 'settings', 'node', %(node)s::text, 'user_id', user_id,
+                        'ignored_mask', ignored_mask, 'watched_plants', watched_plants,
+                        'ignored_plants', ignored_plants, 'digest_interval', digest_interval,
+                        'last_digest_at', EXTRACT(EPOCH FROM last_digest_at)::float8, 'alert_kinds', alert_kinds
+                    )::text) FROM updated""",
+                    {
+                        "ignored_mask": settings.get("ignored_mask", 0),
+                        "watched_plants": settings.get("watched_plants", 0),
+                        "ignored_plants": settings.get("ignored_plants", 0),
+                        "digest_interval": settings.get("digest_interval", 0),
+                        "alert_kinds": settings.get("alert_kinds", 0),
+                        "user_id": user_id,
+                        "channel": CHANGES_CHANNEL,
+                        "node": NODE_ID,
+                    },
+                    prepare=True
                 )
-                self.conn.commit()
-                logger.info(f"✅ Настройки пользователя {user_id} обновлены")
-                return True
+            logger.debug("✅ Настройки пользователя %s обновлены", user_id)
+            return True
                 
         except Exception as e:
             logger.error(f"❌ Ошибка обновления настроек пользователя {user_id}: {e}")
-            if self.conn:
-                self.conn.rollback()
             return False
     
+    def listen_changes(self, on_change, on_reconnect):
+        """Слушает уведомления других экземпляров (блокирует поток, переподключается сам).
+        
+        on_change(payload) получает каждое чужое изменение. После переподключения
+        уведомления за время обрыва потеряны, поэтому сначала вызывается
+        on_reconnect() - полная пересинхронизация. Отдельное соединение: основное
+        занято пайплайнами и не читает уведомления между запросами
+        """
+        database_url = os.getenv('DATABASE_URL')
+        if not database_url:
+            return
+        
+        connected_before = False
+        while True:
+            try:
+                with psycopg.connect(database_url, autocommit=True) as conn:
+                    conn.execute(f"LISTEN {CHANGES_CHANNEL}")
+                    logger.info(f"📡 Слушаем изменения других экземпляров ({CHANGES_CHANNEL}, узел {NODE_ID})")
+                    if connected_before:
+                        on_reconnect()
+                    connected_before = True
+                    
+                    while True:
+                        for notify in conn.notifies(timeout=LISTEN_TIMEOUT):
+                            try:
+                                payload = json.loads(notify.payload)
+                            except ValueError:
+                                logger.warning(f"⚠️ Непонятное уведомление: {notify.payload[:100]}")
+                                continue
+                            if payload.get("node") != NODE_ID:
+                                on_change(payload)
+                        # Тишина: проверяем, что соединение живо
+                        conn.execute("SELECT 1")
+                        
+            except Exception as e:
+                logger.error(f"❌ Слушатель изменений отключился: {e}")
+            time.sleep(RECONNECT_INTERVAL)
+    
     def get_all_users(self):
         """Получение всех пользователей"""
         if not self.conn:
             return []
             
         try:
-            with self.conn.cursor() as cur:
-                cur.execute("SELECT user_id FROM users")
-                return [row[0] for row in cur.fetchall()]
+            with self._pipeline("get_all_users") as conn:
+                cur = conn.execute("SELECT user_id FROM users")
+            return [row[0] for row in cur.fetchall()]
         except Exception as e:
             logger.error(f"❌ Ошибка получения пользователей: {e}")
             return []
     
+    def iter_user_settings(self, batch_size=10000, since=None):
+        """Потоковое чтение настроек всех пользователей пачками, по возрастанию user_id.
+        
+        Строки: (user_id, ignored_mask, watched_plants, ignored_plants, digest_interval,
+        last_digest_at в unix-секундах или None, alert_kinds). С since (unix-время) - только
+        пользователи, появившиеся или изменившиеся после него. Читаем серверным
+        курсором на отдельном соединении, чтобы не держать все строки в памяти и не
+        мешать транзакциям основного соединения. Ошибка пробрасывается после
+        логирования: неполный список нельзя принимать за полный
+        """
+        database_url = os.getenv('DATABASE_URL')
+        if not database_url:
+            return
+        
+        query = """SELECT u.user_id,
+                COALESCE(s.ignored_mask, 0),
+                COALESCE(s.watched_plants, 0),
+                COALESCE(s.ignored_plants, 0),
+                COALESCE(s.digest_interval, 0),
+                EXTRACT(EPOCH FROM s.last_digest_at)::float8,
+                COALESCE(s.alert_kinds, 0)
+            FROM users u LEFT JOIN user_settings s ON s.user_id = u.user_id"""
+        params = {}
+        if since is not None:
+            query += """
+            WHERE u.user_id IN (
+                SELECT user_id FROM users WHERE last_active > to_timestamp(%(since)s)
+                UNION
+                SELECT user_id FROM user_settings
+                WHERE updated_at > to_timestamp(%(since)s) OR last_digest_at > to_timestamp(%(since)s)
+            )"""
+            params["since"] = since
+        query += " ORDER BY u.user_id"
+            
+        try:
+            with psycopg.connect(database_url) as conn:
+                with conn.cursor(name="stream_user_settings") as cur:
+                    cur.itersize = batch_size
+                    cur.execute(query, params)
+                    while True:
+                        rows = cur.fetchmany(batch_size)
+                        if not rows:
+                            break
+                        yield rows
+        except Exception as e:
+            logger.error(f"❌ Ошибка получения настроек пользователей: {e}")
+            raise
+    
     def save_current_stock(self, stock_data, restock_time, message_id=None):
-        """Сохранение текущего стока"""
+        """Сохранение текущего стока (сообщение, уже записанное другим экземпляром, пропускается)"""
         if not self.conn:
             return False
             
+        payload = json.dumps({
+            "type": "stock", "node": NODE_ID,
+            "stock_data": stock_data, "restock_time": restock_time, "message_id": message_id
+        })
+        if len(payload.encode("utf-8")) > NOTIFY_PAYLOAD_LIMIT:
+            # Слушатели прочитают сток из БД
+            payload = json.dumps({"type": "stock", "node": NODE_ID, "message_id": message_id})
+        
         try:
-            with self.conn.cursor() as cur:
-                cur.execute(
-                    """INSERT INTO current_stock (stock_data, restock_time, message_id) 
-                    VALUES (%s, %s, %s)""",
-                    (json.dumps(stock_data), restock_time, message_id)
+            with self._pipeline("save_current_stock", transaction=True) as conn:
+                # Уведомление уходит, только если строка вставлена
+                conn.execute(
+                    """WITH inserted AS (
+                        INSERT INTO current_stock (stock_data, restock_time, message_id)
+                        VALUES (%s, %s, %s)
+                        ON CONFLICT (message_id) DO NOTHING
+                        RETURNING 1
+                    )
+                    SELECT pg_notify(%s, %s) FROM inserted""",
+                    (json.dumps(stock_data), restock_time, message_id, CHANGES_CHANNEL, payload),
+                    prepare=True
                 )
-                self.conn.commit()
-                logger.info("✅ Сток сохранен в БД")
-                return True
+            logger.debug("✅ Сток сохранен в БД")
+            return True
                 
         except Exception as e:
             logger.error(f"❌ Ошибка сохранения стока: {e}")
-            if self.conn:
-                self.conn.rollback()
             return False
     
     def get_latest_stock(self):
@@ -214,40 +592,183 @@ class Database:
             return None, None
             
         try:
-            with self.conn.cursor() as cur:
-                cur.execute(
-                    "SELECT stock_data, restock_time FROM current_stock ORDER BY created_at DESC LIMIT 1"
+            with self._pipeline("get_latest_stock") as conn:
+                cur = conn.execute(
+                    "SELECT stock_data, restock_time FROM current_stock ORDER BY created_at DESC LIMIT 1",
+                    prepare=True
                 )
-                result = cur.fetchone()
-                if result:
-                    return json.loads(result[0]), result[1]
-                return None, None
+            result = cur.fetchone()
+            if result:
+                # psycopg3 сам декодирует JSONB
+                stock_data = result[0]
+                if isinstance(stock_data, str):
+                    stock_data = json.loads(stock_data)
+                return stock_data, result[1]
+            return None, None
                 
         except Exception as e:
             logger.error(f"❌ Ошибка получения стока: {e}")
             return None, None
     
+    def get_stock_since(self, since):
+        """Рестоки после момента since (unix): [(stock_data, restock_time, unix-время)] от старых к новым"""
+        if not self.conn:
+            return []
+            
+        try:
+            with self._pipeline("get_stock_since") as conn:
+                cur = conn.execute(
+                    """SELECT stock_data, restock_time, EXTRACT(EPOCH FROM created_at)::float8
+                    FROM current_stock WHERE created_at > to_timestamp(%s) ORDER BY created_at""",
+                    (since,), prepare=True
+                )
+            return [
+                (json.loads(stock_data) if isinstance(stock_data, str) else stock_data, restock_time, created_at)
+                for stock_data, restock_time, created_at in cur.fetchall()
+            ]
+                
+        except Exception as e:
+            logger.error(f"❌ Ошибка получения рестоков для дайджеста: {e}")
+            return []
+    
+    def claim_fanout(self, message_id):
+        """Берет рассылку сообщения Discord на этот экземпляр: True - рассылаем мы.
+        
+        Сообщение видят все экземпляры, рассылает тот, чья вставка прошла первой.
+        Без БД или message_id рассылаем сами: лучше повтор, чем потерянный ресток
+        """
+        if not message_id or not self.conn:
+            return True
+            
+        try:
+            with self._pipeline("claim_fanout") as conn:
+                cur = conn.execute(
+                    """INSERT INTO fanout_claims (message_id, node) VALUES (%s, %s)
+                    ON CONFLICT (message_id) DO NOTHING RETURNING message_id""",
+                    (str(message_id), NODE_ID), prepare=True
+                )
+                conn.execute(
+                    "DELETE FROM fanout_claims WHERE claimed_at < CURRENT_TIMESTAMP - INTERVAL '7 days'",
+                    prepare=True
+                )
+            return cur.fetchone() is not None
+                
+        except Exception as e:
+            logger.error(f"❌ Ошибка выбора экземпляра для рассылки: {e}")
+            return True
+    
+    def claim_digests(self, user_ids, sent_at):
+        """Отмечает доставку дайджеста тем из user_ids, кому он еще положен, и возвращает их.
+        
+        Условное обновление - выбор экземпляра на каждого пользователя: второй
+        экземпляр увидит свежий last_digest_at и дайджест не отправит.
+        None - БД недоступна
+        """
+        if not self.conn:
+            return None
+            
+        try:
+            with self._pipeline("claim_digests") as conn:
+                cur = conn.execute(
+                    """UPDATE user_settings SET last_digest_at = to_timestamp(%(sent_at)s)
+                    WHERE user_id = ANY(%(user_ids)s) AND (
+                        last_digest_at IS NULL
+                        OR last_digest_at + make_interval(mins => digest_interval) <= to_timestamp(%(sent_at)s) + INTERVAL '1 second'
+                    )
+                    RETURNING user_id""",
+                    {"sent_at": sent_at, "user_ids": list(user_ids)}, prepare=True
+                )
+            return [row[0] for row in cur.fetchall()]
+                
+        except Exception as e:
+            logger.error(f"❌ Ошибка сохранения времени дайджеста: {e}")
+            return None
+    
+    def get_restock_history(self, limit=50):
+        """Последние рестоки: [(message_id, created_at)] от старых к новым"""
+        if not self.conn:
+            return []
+            
+        try:
+            with self._pipeline("get_restock_history") as conn:
+                cur = conn.execute(
+                    "SELECT message_id, created_at FROM current_stock ORDER BY created_at DESC LIMIT %s",
+                    (limit,)
+                )
+            return list(reversed(cur.fetchall()))
+                
+        except Exception as e:
+            logger.error(f"❌ Ошибка получения истории стока: {e}")
+            return []
+    
+    def save_restock_trace(self, message_id, posted_at, summary):
+        """Сохранение трассы рестока (сводка из RestockTrace.summary)"""
+        if not self.conn:
+            return False
+            
+        columns = [f"{stage}_ms" for stage in TRACE_STAGES] + ["recipients", "delivered", "tiers"]
+        values = [summary.get(stage) for stage in TRACE_STAGES] + [
+            summary["recipients"], summary["delivered"],
+            json.dumps(summary["tiers"]) if summary.get("tiers") else None
+        ]
+        try:
+            with self._pipeline("save_restock_trace") as conn:
+                conn.execute(
+                    f"""INSERT INTO restock_traces (message_id, posted_at, {', '.join(columns)})
+                    VALUES (%s, to_timestamp(%s), {', '.join(['%s'] * len(columns))})""",
+                    [message_id, posted_at] + values
+                )
+            return True
+                
+        except Exception as e:
+            logger.error(f"❌ Ошибка сохранения трассы рестока: {e}")
+            return False
+    
+    def get_restock_traces(self, limit=100):
+        """Последние трассы рестоков: [{этап: мс, ...}] от новых к старым"""
+        if not self.conn:
+            return []
+            
+        columns = [f"{stage}_ms" for stage in TRACE_STAGES] + ["recipients", "delivered", "tiers"]
+        try:
+            with self._pipeline("get_restock_traces") as conn:
+                cur = conn.execute(
+                    f"SELECT {', '.join(columns)} FROM restock_traces ORDER BY posted_at DESC LIMIT %s",
+                    (limit,)
+                )
+            keys = list(TRACE_STAGES) + ["recipients", "delivered", "tiers"]
+            return [dict(zip(keys, row)) for row in cur.fetchall()]
+                
+        except Exception as e:
+            logger.error(f"❌ Ошибка получения трасс рестоков: {e}")
+            return []
+    
     def get_user_stats(self):
         """Статистика пользователей"""
         if not self.conn:
             return {}
             
         try:
-            with self.conn.cursor() as cur:
-                cur.execute("SELECT COUNT(*) FROM users")
-                total_users = cur.fetchone()[0]
-                
-                cur.execute("SELECT COUNT(*) FROM user_settings WHERE ignored_rarities != '[]'::jsonb")
-                users_with_settings = cur.fetchone()[0]
-                
-                return {
-                    "total_users": total_users,
-                    "users_with_settings": users_with_settings,
-                    "users_without_settings": total_users - users_with_settings
-                }
+            # Оба счетчика одним запросом
+            with self._pipeline("get_user_stats") as conn:
+                cur = conn.execute(
+                    """SELECT
+                        (SELECT COUNT(*) FROM users),
+                        (SELECT COUNT(*) FROM user_settings
+                         WHERE ignored_mask <> 0 OR watched_plants <> 0 OR ignored_plants <> 0
+                            OR digest_interval <> 0)""",
+                    prepare=True
+                )
+            total_users, users_with_settings = cur.fetchone()
+            
+            return {
+                "total_users": total_users,
+                "users_with_settings": users_with_settings,
+                "users_without_settings": total_users - users_with_settings
+            }
         except Exception as e:
             logger.error(f"❌ Ошибка получения статистики: {e}")
             return {}
 
-# Глобальный экземпляр БД
+# Глобальный экземпляр БД (без подключения при импорте)
 db = Database()
@@ -0,0 +1,129 @@
+import heapq
+import threading
+
+from plants import ALERT_BIT, PLANT_BIT, stock_plant_mask
+
+# Варианты доставки в минутах: 0 - мгновенно, иначе дайджест раз в N минут
+DIGEST_INTERVALS = [0, 60, 180, 720, 1440]
+# Как часто планировщик проверяет, кому пора отправить дайджест, секунд
+DIGEST_TICK = 60
+
+def format_digest_interval(minutes):
+    """Подпись режима доставки для меню"""
+    if not minutes:
+        return "мгновенно"
+    if minutes % 1440 == 0:
+        days = minutes // 1440
+        return "раз в сутки" if days == 1 else f"раз в {days} дн"
+    if minutes % 60 == 0:
+        return f"раз в {minutes // 60} ч"
+    return f"раз в {minutes} мин"
+
+def next_digest_interval(minutes):
+    """Следующий вариант доставки по кругу"""
+    if minutes not in DIGEST_INTERVALS:
+        return DIGEST_INTERVALS[0]
+    return DIGEST_INTERVALS[(DIGEST_INTERVALS.index(minutes) + 1) % len(DIGEST_INTERVALS)]
+
+class DigestSchedule:
+    """Пользователи в режиме дайджеста и время их следующей доставки.
+
+    Сроки лежат в куче, поэтому проверка раз в минуту стоит числа пользователей,
+    которым пора, а не всех дайджест-пользователей. Устаревшие записи кучи
+    (после смены настроек) отбрасываются при извлечении
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # user_id -> (маска видимых растений, интервал в минутах, время последней доставки)
+        self._users = {}
+        self._heap = []
+
+    def __len__(self):
+        return len(self._users)
+
+    def __contains__(self, user_id):
+        return user_id in self._users
+
+    def load(self, rows):
+        """Добавляет строки (user_id, маска, интервал, время последней доставки)"""
+        with self._lock:
+            for user_id, visible_mask, interval, last_digest_at in rows:
+                self._set(user_id, visible_mask, interval, last_digest_at)
+
+    def set_user(self, user_id, visible_mask, interval, last_digest_at):
+        """Добавляет пользователя, обновляет его фильтр или, при interval=0, удаляет"""
+        with self._lock:
+            self._set(user_id, visible_mask, interval, last_digest_at)
+
+    def remove_user(self, user_id):
+        with self._lock:
+            self._users.pop(user_id, None)
+
+    def last_digest_at(self, user_id):
+        entry = self._users.get(user_id)
+        return entry[2] if entry else None
+
+    def visible_mask(self, user_id):
+        entry = self._users.get(user_id)
+        return entry[0] if entry else None
+
+    def items(self):
+        """Копия строк (user_id, маска, интервал, время последней доставки) в формате load()"""
+        with self._lock:
+            return [(user_id, *entry) for user_id, entry in self._users.items()]
+
+    def due(self, now):
+        """Пользователи, которым пора отправить дайджест: [(user_id, маска, время последней доставки)]"""
+        result = []
+        seen = set()
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                due_at, user_id = heapq.heappop(self._heap)
+                entry = self._users.get(user_id)
+                if entry is None or entry[2] + entry[1] * 60 != due_at or user_id in seen:
+                    continue
+                seen.add(user_id)
+                result.append((user_id, entry[0], entry[2]))
+        return result
+
+    def mark_sent(self, user_ids, sent_at):
+        """Переносит следующую доставку на интервал вперед"""
+        with self._lock:
+            for user_id in user_ids:
+                entry = self._users.get(user_id)
+                if entry is not None:
+                    self._set(user_id, entry[0], entry[1], sent_at)
+
+    def _set(self, user_id, visible_mask, interval, last_digest_at):
+        if not interval:
+            self._users.pop(user_id, None)
+            return
+        old = self._users.get(user_id)
+        self._users[user_id] = (visible_mask, interval, last_digest_at)
+        if old is None or old[1] != interval or old[2] != last_digest_at:
+            heapq.heappush(self._heap, (last_digest_at + interval * 60, user_id))
+
+def suffix_plant_masks(restocks):
+    """Маски растений, появлявшихся в рестоках начиная с i-го (последний элемент - 0)"""
+    masks = [0] * (len(restocks) + 1)
+    for i in range(len(restocks) - 1, -1, -1):
+        masks[i] = masks[i + 1] | stock_plant_mask(restocks[i][0])
+    return masks
+
+def suffix_alert_masks(alerts):
+    """Биты видов событий (time, kind, ...), случившихся начиная с i-го (последний элемент - 0)"""
+    masks = [0] * (len(alerts) + 1)
+    for i in range(len(alerts) - 1, -1, -1):
+        masks[i] = masks[i + 1] | ALERT_BIT[alerts[i][1]]
+    return masks
+
+def summarize_restocks(restocks, visible_mask):
+    """Сводка по рестокам для маски видимых растений: {растение: (раз в стоке, максимум штук)}"""
+    summary = {}
+    for stock_data, _, _ in restocks:
+        for plant, count in stock_data.items():
+            if visible_mask & PLANT_BIT.get(plant, 0):
+                times, max_count = summary.get(plant, (0, 0))
+                summary[plant] = (times + 1, max(max_count, count))
+    return summary
@@ -0,0 +1,444 @@
+import asyncio
+import logging
+import os
+import random
+import re
+import statistics
+import time
+from bisect import bisect_left, insort
+from datetime import datetime, timedelta
+from typing import NamedTuple
+
+import httpx
+
+from latency import RestockTrace
+from plants import PLANTS_RARITY
+
+logger = logging.getLogger(__name__)
+
+DISCORD_API_BASE = os.getenv("DISCORD_API_BASE", "https://discord.com/api/v9")
+# Общий потолок запросов к Discord в секунду на все каналы
+DISCORD_MAX_RPS = float(os.getenv("DISCORD_MAX_RPS", 1))
+# Сколько новых сообщений забираем за один опрос канала
+DISCORD_FETCH_LIMIT = 10
+# Сколько последних сообщений канала смотрим при старте, чтобы оценить период рестоков
+DISCORD_HISTORY_LIMIT = 50
+# Частый опрос в окне вокруг ожидаемого рестока
+DISCORD_FAST_INTERVAL = float(os.getenv("DISCORD_FAST_INTERVAL", 1))
+# Редкий опрос между рестоками, когда период уже известен
+DISCORD_IDLE_INTERVAL = float(os.getenv("DISCORD_IDLE_INTERVAL", 60))
+# Окно частого опроса: секунд до и после ожидаемого рестока
+DISCORD_WINDOW_BEFORE = float(os.getenv("DISCORD_WINDOW_BEFORE", 3))
+DISCORD_WINDOW_AFTER = float(os.getenv("DISCORD_WINDOW_AFTER", 20))
+# Экспоненциальная пауза с джиттером после ошибок
+DISCORD_BACKOFF_BASE = 2
+DISCORD_BACKOFF_MAX = 300
+# Эпоха snowflake-идентификаторов Discord, мс
+DISCORD_EPOCH_MS = 1420070400000
+# Заголовки embed-объявлений, которые пересылаются пользователям как есть
+DISCORD_ANNOUNCEMENT_TITLES = [
+    title.strip() for title in os.getenv("DISCORD_ANNOUNCEMENT_TITLES", "EVENT!,WEATHER EVENT!").split(",")
+    if title.strip()
+]
+
+class StockEvent(NamedTuple):
+    """Событие из Discord, разобранное парсером embed"""
+    kind: str
+    channel_id: str
+    message_id: str
+    timestamp: str
+    title: str
+    items: dict
+    time_info: str
+    text: str = ""
+    # RestockTrace сообщения, выставляется планировщиком опроса
+    trace: object = None
+
+# События, которые выходят по расписанию магазина
+CADENCE_KINDS = ("seeds", "gear")
+
+# Реестр парсеров: заголовок embed -> функция(embed, message, channel_id) -> StockEvent | None
+EMBED_PARSERS = {}
+
+def embed_parser(*titles):
+    """Регистрирует парсер для embed с указанными заголовками"""
+    def decorator(parser):
+        for title in titles:
+            EMBED_PARSERS[title] = parser
+        return parser
+    return decorator
+
+# === РАЗБОР EMBED ===
+def snowflake_time(snowflake):
+    """Время создания объекта Discord (unix, секунды) по его id"""
+    return ((int(snowflake) >> 22) + DISCORD_EPOCH_MS) / 1000
+
+def convert_to_msk(discord_time_str):
+    try:
+        if "@" in discord_time_str:
+            date_part, time_part = discord_time_str.split('@')
+            day, month, year = date_part.strip().split('/')
+            hour, minute = time_part.strip().replace('GMT', '').strip().split(':')
+
+            dt_utc = datetime(int(year), int(month), int(day), int(hour), int(minute))
+            dt_msk = dt_utc + timedelta(hours=3)
+            return dt_msk.strftime("%d/%m/%Y %H:%M")
+        else:
+            return discord_time_str
+    except:
+        return discord_time_str
+
+def extract_restock_time(embed):
+    """Время рестока МСК из поля author ('⏳ дд/мм/гггг @ чч:мм GMT')"""
+    author = embed.get('author', {})
+    if author and 'name' in author:
+        author_name = author['name']
+        if "⏳" in author_name:
+            discord_time = author_name.replace('⏳', '').strip()
+            current_time = convert_to_msk(discord_time)
+            logger.debug("⏰ Время из Discord: %s -> МСК: %s", discord_time, current_time)
+            return current_time
+
+    current_time = datetime.now().strftime("%d/%m/%Y %H:%M")
+    logger.debug("⏰ Используем текущее время МСК: %s", current_time)
+    return current_time
+
+def extract_field_counts(embed):
+    """Пары (очищенное название поля, количество '+N') из полей embed"""
+    counts = []
+    for field in embed.get('fields', []):
+        clean_name = re.sub(r'[^\w\s]', '', field.get('name', '')).strip()
+        stock_match = re.search(r'\+\d+', field.get('value', ''))
+        if clean_name and stock_match:
+            counts.append((clean_name, int(stock_match.group(0).replace('+', ''))))
+    return counts
+
+def extract_stock_info_from_embed(embed, message_timestamp):
+    stock_data = {}
+    current_time = extract_restock_time(embed)
+
+    for clean_plant_name, stock_count in extract_field_counts(embed):
+        for known_plant in PLANTS_RARITY.keys():
+            if known_plant.lower() in clean_plant_name.lower():
+                stock_data[known_plant] = stock_count
+                logger.debug("✅ %s: %s шт", known_plant, stock_count)
+                break
+
+    return stock_data, current_time
+
+@embed_parser("SEEDS SHOP RESTOCK!")
+def parse_seeds_embed(embed, message, channel_id):
+    stock_data, time_info = extract_stock_info_from_embed(embed, message.get('timestamp'))
+    if not stock_data:
+        return None
+    return StockEvent("seeds", channel_id, message['id'], message.get('timestamp'), embed.get('title'), stock_data, time_info)
+
+@embed_parser("GEAR SHOP RESTOCK!")
+def parse_gear_embed(embed, message, channel_id):
+    items = dict(extract_field_counts(embed))
+    if not items:
+        return None
+    return StockEvent("gear", channel_id, message['id'], message.get('timestamp'), embed.get('title'), items, extract_restock_time(embed))
+
+def parse_announcement_embed(embed, message, channel_id):
+    text = embed.get('description') or ""
+    for field in embed.get('fields', []):
+        text += f"\n{field.get('name', '')}: {field.get('value', '')}"
+    return StockEvent(
+        "announcement", channel_id, message['id'], message.get('timestamp'), embed.get('title'), {},
+        extract_restock_time(embed), text.strip()
+    )
+
+embed_parser(*DISCORD_ANNOUNCEMENT_TITLES)(parse_announcement_embed)
+
+def parse_message(message, channel_id):
+    """Все события из embed сообщения, для которых есть парсер"""
+    events = []
+    for embed in message.get('embeds', []):
+        parser = EMBED_PARSERS.get(embed.get('title'))
+        if parser:
+            event = parser(embed, message, channel_id)
+            if event:
+                events.append(event)
+    return events
+
+# === ЛИМИТЫ DISCORD ===
+class RouteRateLimiter:
+    """Учет лимитов Discord по бакетам из заголовков X-RateLimit-*"""
+
+    def __init__(self):
+        self._route_buckets = {}
+        self._buckets = {}
+        self._global_reset_at = 0
+
+    async def wait(self, route):
+        """Ждет, если бакет маршрута или глобальный лимит исчерпан"""
+        now = time.monotonic()
+        delay = self._global_reset_at - now
+        bucket = self._buckets.get(self._route_buckets.get(route, route))
+        if bucket:
+            remaining, reset_at = bucket
+            if remaining <= 0:
+                delay = max(delay, reset_at - now)
+        if delay > 0:
+            logger.debug("⏳ Лимит Discord для %s, ждем %.2f с", route, delay)
+            await asyncio.sleep(delay)
+
+    def update(self, route, response):
+        """Обновляет состояние бакета по заголовкам ответа"""
+        headers = response.headers
+        bucket_id = headers.get('X-RateLimit-Bucket', route)
+        self._route_buckets[route] = bucket_id
+
+        remaining = headers.get('X-RateLimit-Remaining')
+        reset_after = headers.get('X-RateLimit-Reset-After')
+        if remaining is not None and reset_after is not None:
+            self._buckets[bucket_id] = (int(remaining), time.monotonic() + float(reset_after))
+
+        if response.status_code == 429:
+            try:
+                retry_after = float(response.json().get('retry_after', reset_after or 1))
+            except Exception:
+                retry_after = float(reset_after or 1)
+            reset_at = time.monotonic() + retry_after
+            if headers.get('X-RateLimit-Global'):
+                self._global_reset_at = reset_at
+            else:
+                self._buckets[bucket_id] = (0, reset_at)
+            logger.warning(f"⚠️ Discord 429 для {route}, повтор через {retry_after:.1f} с")
+
+# === РАСПИСАНИЕ РЕСТОКОВ ===
+class RestockCadence:
+    """Оценка периода рестоков канала по времени прошлых рестоков.
+
+    Период - медиана интервалов между рестоками, где интервал, накрывший
+    пропущенные рестоки, делится на их число. Фаза берется от последнего
+    рестока, разброс (медиана отклонений) расширяет окно частого опроса
+    """
+
+    # Рестоки ближе этого считаются одним (семена и снаряжение в соседних сообщениях)
+    MIN_PERIOD = 30
+    MAX_HISTORY = 50
+    # После стольких пропущенных подряд рестоков расписание считается устаревшим
+    MAX_MISSED = 3
+
+    def __init__(self):
+        self._times = []
+        self.period = None
+        self.spread = 0
+
+    @property
+    def last(self):
+        return self._times[-1] if self._times else None
+
+    def observe(self, restock_at):
+        """Учитывает ресток; False, если это повтор уже учтенного"""
+        i = bisect_left(self._times, restock_at)
+        for known in self._times[max(0, i - 1):i + 1]:
+            if abs(restock_at - known) < self.MIN_PERIOD:
+                return False
+        insort(self._times, restock_at)
+        del self._times[:-self.MAX_HISTORY]
+        self._estimate()
+        return True
+
+    def _estimate(self):
+        diffs = [later - earlier for earlier, later in zip(self._times, self._times[1:])]
+        if len(diffs) < 2:
+            return
+        base = statistics.median(diffs)
+        normalized = [diff / max(1, round(diff / base)) for diff in diffs]
+        self.period = statistics.median(normalized)
+        self.spread = statistics.median(abs(diff - self.period) for diff in normalized)
+
+    def expected_next(self, now):
+        """Ожидаемое время ближайшего рестока, окно которого еще не закрылось; None, если период неизвестен"""
+        if self.period is None or now - self.last > self.MAX_MISSED * self.period:
+            return None
+        window_after = DISCORD_WINDOW_AFTER + self.spread
+        missed = max(0, int((now - window_after - self.last) // self.period))
+        return self.last + (missed + 1) * self.period
+
+    def next_delay(self, now, idle_interval):
+        """Пауза до следующего опроса; None, если расписание неизвестно"""
+        expected = self.expected_next(now)
+        if expected is None:
+            return None
+        window_start = expected - DISCORD_WINDOW_BEFORE - self.spread
+        if now >= window_start:
+            return DISCORD_FAST_INTERVAL
+        return min(idle_interval, window_start - now)
+
+# === ПЛАНИРОВЩИК ОПРОСА ===
+class ChannelState:
+    """Состояние опроса одного канала"""
+
+    def __init__(self, channel_id, interval):
+        self.channel_id = channel_id
+        self.interval = interval
+        self.cursor = None
+        self.next_poll_at = 0
+        self.in_flight = False
+        self.cadence = RestockCadence()
+        self.errors = 0
+        self.requests = 0
+        self.detection_delay = None
+
+class DiscordPoller:
+    """Опрос нескольких каналов Discord одним asyncio-планировщиком.
+
+    Все каналы делят одну HTTP-сессию, лимиты по бакетам и общий потолок
+    DISCORD_MAX_RPS, поэтому новый канал не добавляет поток и не умножает
+    частоту запросов
+    """
+
+    def __init__(self, channels, token, on_event, max_rps=DISCORD_MAX_RPS, history=None, cursors=None):
+        self.channels = [ChannelState(channel_id, interval) for channel_id, interval in channels.items()]
+        # История рестоков из БД: {channel_id: [unix-время, ...]}
+        for channel in self.channels:
+            for restock_at in (history or {}).get(channel.channel_id, []):
+                channel.cadence.observe(restock_at)
+            # Курсоры из снимка: сообщения, вышедшие за время простоя, не теряются
+            channel.cursor = (cursors or {}).get(channel.channel_id)
+        self.token = token
+        self.on_event = on_event
+        self.min_spacing = 1 / max_rps if max_rps > 0 else 0
+        self.rate_limiter = RouteRateLimiter()
+        self._client = None
+        self._last_request_at = 0
+
+    async def run(self):
+        headers = {'Authorization': self.token, 'Content-Type': 'application/json'}
+        async with httpx.AsyncClient(base_url=DISCORD_API_BASE, headers=headers, timeout=5) as client:
+            self._client = client
+            # Курсоры: начинаем с последнего сообщения каждого канала
+            await asyncio.gather(*(self._init_cursor(channel) for channel in self.channels))
+
+            while True:
+                channel = min(
+                    (channel for channel in self.channels if not channel.in_flight),
+                    key=lambda channel: channel.next_poll_at,
+                    default=None
+                )
+                if channel is None:
+                    await asyncio.sleep(0.1)
+                    continue
+
+                now = time.monotonic()
+                delay = max(channel.next_poll_at - now, self._last_request_at + self.min_spacing - now)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+
+                self._last_request_at = time.monotonic()
+                channel.in_flight = True
+                asyncio.create_task(self._poll(channel))
+
+    def status(self):
+        """Состояние опроса каналов для /polling"""
+        now = time.time()
+        channels = []
+        for channel in self.channels:
+            expected = channel.cadence.expected_next(now)
+            channels.append({
+                "channel_id": channel.channel_id,
+                "interval": channel.interval,
+                "period": round(channel.cadence.period, 1) if channel.cadence.period else None,
+                "spread": round(channel.cadence.spread, 1),
+                "next_restock_in": round(expected - now, 1) if expected else None,
+                "errors": channel.errors,
+                "requests": channel.requests,
+                "detection_delay": channel.detection_delay,
+            })
+        return {"channels": channels}
+
+    def cursors(self):
+        """Последние обработанные сообщения каналов: {channel_id: message_id}"""
+        return {channel.channel_id: channel.cursor for channel in self.channels if channel.cursor}
+
+    async def fetch_messages(self, channel_id, **params):
+        """Сообщения канала (новые первыми) или None при ошибке"""
+        route = f"GET /channels/{channel_id}/messages"
+        await self.rate_limiter.wait(route)
+        response = await self._client.get(f"/channels/{channel_id}/messages", params=params)
+        self.rate_limiter.update(route, response)
+        if response.status_code != 200:
+            logger.warning(f"❌ Discord вернул {response.status_code} для канала {channel_id}")
+            return None
+        return response.json()
+
+    async def _init_cursor(self, channel):
+        failed = True
+        try:
+            # Одним запросом берем курсор и историю рестоков для оценки периода
+            channel.requests += 1
+            messages = await self.fetch_messages(channel.channel_id, limit=DISCORD_HISTORY_LIMIT)
+            failed = messages is None
+            if messages:
+                if not channel.cursor:
+                    channel.cursor = max(messages, key=lambda message: int(message['id']))['id']
+                    logger.info(f"📝 Канал {channel.channel_id}: начальное сообщение {channel.cursor}")
+                for message in messages:
+                    self._observe_restock(channel, message, parse_message(message, channel.channel_id))
+        except Exception as e:
+            logger.error(f"❌ Ошибка подключения к Discord: {e}")
+        channel.next_poll_at = time.monotonic() + self._next_delay(channel, failed)
+
+    def _observe_restock(self, channel, message, events):
+        """Учитывает время сообщения о рестоке в расписании канала"""
+        if not any(event.kind in CADENCE_KINDS for event in events):
+            return False
+        period = channel.cadence.period
+        observed = channel.cadence.observe(snowflake_time(message['id']))
+        if observed and channel.cadence.period and channel.cadence.period != period:
+            logger.debug(
+                "📈 Канал %s: период рестока %.1f с (разброс %.1f с)",
+                channel.channel_id, channel.cadence.period, channel.cadence.spread
+            )
+        return observed
+
+    def _next_delay(self, channel, failed):
+        """Пауза до следующего опроса канала"""
+        if failed:
+            channel.errors += 1
+            backoff = min(DISCORD_BACKOFF_MAX, DISCORD_BACKOFF_BASE * 2 ** (channel.errors - 1))
+            return random.uniform(backoff / 2, backoff)
+        channel.errors = 0
+        delay = channel.cadence.next_delay(time.time(), DISCORD_IDLE_INTERVAL)
+        # Пока период неизвестен - равномерный опрос с интервалом канала
+        return channel.interval if delay is None else delay
+
+    async def _poll(self, channel):
+        failed = True
+        try:
+            params = {'limit': DISCORD_FETCH_LIMIT}
+            if channel.cursor:
+                params['after'] = channel.cursor
+            channel.requests += 1
+            messages = await self.fetch_messages(channel.channel_id, **params)
+            detected_at = time.time()
+            failed = messages is None
+
+            # Обрабатываем от старых к новым, курсор сдвигаем на последнее
+            for message in sorted(messages or [], key=lambda message: int(message['id'])):
+                channel.cursor = message['id']
+                logger.info(f"🆕 ОБНАРУЖЕНО НОВОЕ СООБЩЕНИЕ: {message['id']} (канал {channel.channel_id})")
+                trace = RestockTrace(message['id'], snowflake_time(message['id']))
+                trace.mark("detected", detected_at)
+                events = parse_message(message, channel.channel_id)
+                trace.mark("parsed")
+                if self._observe_restock(channel, message, events):
+                    channel.detection_delay = round(time.time() - snowflake_time(message['id']), 2)
+                    logger.info(
+                        f"⏱️ Ресток замечен через {channel.detection_delay} с после публикации",
+                        extra={"event": "restock_detected", "channel_id": channel.channel_id,
+                               "detection_delay": channel.detection_delay}
+                    )
+                if not events:
+                    logger.info("📭 Сообщение без известных embed - игнорируем")
+                for event in events:
+                    await self.on_event(event._replace(trace=trace))
+        except Exception as e:
+            logger.error(f"❌ Ошибка мониторинга канала {channel.channel_id}: {e}")
+        finally:
+            channel.next_poll_at = time.monotonic() + self._next_delay(channel, failed)
+            channel.in_flight = False
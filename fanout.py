@@ -0,0 +1,63 @@
+import os
+import threading
+
+from lanes import BOT_API_CONCURRENCY, INTERACTIVE_RESERVED
+from plants import RARITY_ORDER, RARITY_PLANTS_MASK
+
+# Сколько сообщений рестока отправляется одновременно (все слоты, доступные рассылкам)
+FANOUT_WORKERS = int(os.getenv("FANOUT_WORKERS", BOT_API_CONCURRENCY - INTERACTIVE_RESERVED))
+# Ярус пользователей, в чьем стоке нет растений известной редкости
+TIER_OTHER = "OTHER"
+# Сдвиг начала яруса между рестоками: дробная часть золотого сечения
+# дает равномерно разнесенные позиции при любом числе рестоков
+ROTATION_STEP = 0.6180339887498949
+
+# Ярусы от самой редкой редкости
+TIER_ORDER = list(reversed(RARITY_ORDER)) + [TIER_OTHER]
+
+def top_rarity(view_mask):
+    """Самая редкая редкость среди растений маски"""
+    for rarity in TIER_ORDER[:-1]:
+        if view_mask & RARITY_PLANTS_MASK[rarity]:
+            return rarity
+    return TIER_OTHER
+
+class FanoutPlanner:
+    """Порядок рассылки рестока по ценности.
+
+    Пользователь попадает в ярус самой редкой редкости в своем отфильтрованном
+    стоке, ярусы рассылаются от SECRET к RARE. Внутри яруса пользователи
+    упорядочены по id, а начало очереди сдвигается с каждым рестоком, поэтому
+    место в очереди среди равных переходит по кругу
+    """
+
+    def __init__(self, step=ROTATION_STEP):
+        self.step = step
+        self._lock = threading.Lock()
+        self._rounds = 0
+
+    def plan(self, audience, stock_mask):
+        """Ярусы рассылки: [(ярус, [(chat_id, маска видимых растений), ...])] по порядку отправки"""
+        with self._lock:
+            self._rounds += 1
+            rounds = self._rounds
+
+        tiers = {}
+        tier_of_view = {}
+        for chat_id, visible_mask in audience.items():
+            view_mask = visible_mask & stock_mask
+            tier = tier_of_view.get(view_mask)
+            if tier is None:
+                tier = tier_of_view[view_mask] = top_rarity(view_mask)
+            tiers.setdefault(tier, []).append((chat_id, visible_mask))
+
+        plan = []
+        for tier in TIER_ORDER:
+            users = tiers.get(tier)
+            if users:
+                users.sort()
+                offset = int(len(users) * (rounds * self.step % 1))
+                plan.append((tier, users[offset:] + users[:offset]))
+        return plan
+
+fanout_planner = FanoutPlanner()
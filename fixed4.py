@@ -1,19 +1,57 @@
-from flask import Flask
+# Замеры запуска стартуют до тяжелых импортов
+from startup import startup_report
+
+from flask import Flask, Response, request as flask_request
 import threading
-import requests
+import httpx
 import time
 from telegram import Bot, Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, ContextTypes, MessageHandler, filters, CallbackQueryHandler
+from telegram.ext import (
+    Application, ApplicationHandlerStop, CommandHandler, ContextTypes, MessageHandler, TypeHandler, filters,
+    CallbackQueryHandler
+)
 from telegram import ReplyKeyboardMarkup, KeyboardButton
+from telegram.helpers import escape_markdown
 import threading
 import asyncio
-import re
-from datetime import datetime, timedelta
+from bisect import bisect_right
+from collections import deque
+import functools
+import io
 import json
+import logging
 import os
 
+from logging_setup import setup_logging
+
 # Импортируем нашу БД
 from database import db
+from plants import (
+    PLANTS_RARITY, PLANTS_EMOJI, RARITY_EMOJI, RARITY_ORDER, PLANT_ORDER,
+    RARITY_BIT, PLANT_BIT, ALL_PLANTS_MASK, ALERT_KINDS, ALERT_NAMES, ALERT_BIT,
+    mask_to_rarities, mask_to_plants, stock_plant_mask, visible_plants_mask
+)
+from audience import AudienceIndex
+from registry import SubscriberRegistry
+from profiler import SamplingProfiler, profile_blocking, profile_seconds
+from discord_monitor import DISCORD_API_BASE, DiscordPoller, parse_message, snowflake_time
+from latency import summarize_traces, format_latency_report
+from api_stats import api_stats, track_handler, label_invocation, InstrumentedRequest
+from stock_cache import StockCache
+from update_processor import PerUserUpdateProcessor
+from digest import (
+    DIGEST_TICK, DigestSchedule, format_digest_interval, next_digest_interval,
+    suffix_alert_masks, suffix_plant_masks, summarize_restocks
+)
+from lanes import LANE_BROADCAST, LANE_RESTOCK, BOT_API_CONCURRENCY, bot_lane, lane_scheduler
+from snapshot import SNAPSHOT_PATH, SNAPSHOT_INTERVAL, read_snapshot, write_snapshot
+from stock_feed import StockFeed, parse_rarity_filter
+from fanout import FANOUT_WORKERS, fanout_planner
+from throttle import TokenBuckets, RecentReplies
+
+startup_report.mark("imports")
+
+logger = logging.getLogger(__name__)
 
 # Health check сервер
 app = Flask(__name__)
@@ -26,77 +64,271 @@ def health_check():
 def health():
     return "🟢 OK"
 
+def operator_authorized():
+    """Запрос несет PROFILE_TOKEN в заголовке X-Profile-Token или в ?token="""
+    token = flask_request.headers.get('X-Profile-Token') or flask_request.args.get('token')
+    return bool(PROFILE_TOKEN) and token == PROFILE_TOKEN
+
+def operator_only(view):
+    """Служебный эндпоинт: 403 без PROFILE_TOKEN, как /apistats только для администраторов"""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if not operator_authorized():
+            return {"error": "forbidden"}, 403
+        return view(*args, **kwargs)
+    return wrapper
+
 @app.route('/stats')
 def stats_api():
-    """API для статистики"""
+    """API для статистики; внутренние счетчики только с PROFILE_TOKEN"""
     stats = db.get_user_stats()
-    return {
+    result = {
         "total_users": stats.get('total_users', 0),
         "users_with_settings": stats.get('users_with_settings', 0),
         "status": "running"
     }
+    if not operator_authorized():
+        return result
+    return {
+        **result,
+        "stock_cache": stock_cache.snapshot(),
+        "updates": update_processor.snapshot(),
+        "db": db.stats.snapshot(),
+        "stock_feed": stock_feed.snapshot(),
+        "throttle": {**update_buckets.snapshot(), **interaction_stats},
+        "sync": sync_stats,
+    }
+
+@app.route('/stock')
+def stock_api():
+    """Публичный API последнего стока: ?rarity=GODLY,SECRET, условный GET по ETag/Last-Modified"""
+    try:
+        rarity_mask = parse_rarity_filter(flask_request.args.get('rarity'))
+    except ValueError as e:
+        return {"error": str(e)}, 400
+    
+    view, not_modified = stock_feed.lookup(
+        rarity_mask,
+        flask_request.headers.get('If-None-Match'),
+        flask_request.headers.get('If-Modified-Since')
+    )
+    if view is None:
+        return {"error": "stock is not loaded yet"}, 503, {"Retry-After": "10"}
+    
+    headers = {
+        "ETag": view.etag,
+        "Last-Modified": view.last_modified,
+        "Cache-Control": "no-cache",
+        "Access-Control-Allow-Origin": "*",
+    }
+    if not_modified:
+        return Response(status=304, headers=headers)
+    return Response(view.body, mimetype='application/json', headers=headers)
+
+@app.route('/stock/stream')
+def stock_stream_api():
+    """Server-sent events с каждым новым стоком; Last-Event-ID догоняет пропущенное"""
+    # Каждый поток занимает поток waitress - оставляем запас для остальных запросов
+    if stock_feed.clients >= STOCK_STREAM_MAX_CLIENTS:
+        return {"error": "too many stream clients"}, 503, {"Retry-After": "30"}
+    
+    try:
+        last_event_id = int(flask_request.headers.get('Last-Event-ID', ''))
+    except ValueError:
+        last_event_id = None
+    
+    return Response(
+        stock_feed.events(last_event_id),
+        mimetype='text/event-stream',
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no", "Access-Control-Allow-Origin": "*"}
+    )
+
+@app.route('/startup')
+@operator_only
+def startup_api():
+    """API для отчета о фазах запуска"""
+    return startup_report.as_dict()
+
+@app.route('/api_calls')
+@operator_only
+def api_calls_api():
+    """API для счетчиков вызовов Bot API по обработчикам"""
+    return api_stats.snapshot()
+
+@app.route('/latency')
+@operator_only
+def latency_api():
+    """API для перцентилей задержки рестоков: ?limit=N последних рестоков"""
+    try:
+        limit = int(flask_request.args.get('limit', LATENCY_WINDOW))
+    except ValueError:
+        return {"error": "limit must be an integer"}, 400
+    return summarize_traces(db.get_restock_traces(limit))
+
+@app.route('/lanes')
+@operator_only
+def lanes_api():
+    """API для полос Bot API: глубина очередей и ожидание слота"""
+    return lane_scheduler.snapshot()
+
+@app.route('/polling')
+@operator_only
+def polling_api():
+    """API для состояния опроса Discord: период рестоков, ошибки, число запросов"""
+    if discord_poller is None:
+        return {"channels": []}
+    return discord_poller.status()
+
+@app.route('/debug/profile')
+@operator_only
+def profile_api():
+    """Профилирование процесса: ?seconds=N&format=json|folded"""
+    try:
+        seconds = profile_seconds(flask_request.args.get('seconds', 10))
+    except ValueError:
+        return {"error": "seconds must be a number"}, 400
+    
+    result = profile_blocking(seconds)
+    if result is None:
+        return {"error": "profiler is busy"}, 409
+    
+    if flask_request.args.get('format') == 'folded':
+        return Response(result.folded(), mimetype='text/plain')
+    return result.as_dict()
 
 def run_health_server():
     try:
         port = int(os.environ.get('PORT', 8080))
-        print(f"🏥 Starting health check server on port {port}...")
+        logger.info(f"🏥 Starting health check server on port {port}...")
         # Убираем предупреждение используя production-ready сервер
         from waitress import serve
-        serve(app, host='0.0.0.0', port=port)
+        serve(app, host='0.0.0.0', port=port, threads=HTTP_THREADS)
     except Exception as e:
-        print(f"❌ Health server error: {e}")
+        logger.error(f"❌ Health server error: {e}")
 
-# Запускаем health сервер в отдельном потоке
-health_thread = threading.Thread(target=run_health_server, daemon=True)
-health_thread.start()
+def start_health_server():
+    """Запускает health сервер в отдельном потоке"""
+    health_thread = threading.Thread(target=run_health_server, name="health", daemon=True)
+    health_thread.start()
 
 # === НАСТРОЙКИ ===
 DISCORD_CHANNEL_ID = "1407975317682917457"
+# Каналы Discord для мониторинга: "id:интервал_опроса_сек,id:интервал"
+DISCORD_CHANNELS = {
+    channel.split(":")[0].strip(): float(channel.split(":")[1]) if ":" in channel else 10
+    for channel in os.getenv("DISCORD_CHANNELS", f"{DISCORD_CHANNEL_ID}:10").split(",")
+    if channel.strip()
+}
 DISCORD_USER_TOKEN = os.getenv("DISCORD_USER_TOKEN")
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
+# Адрес Bot API без "/bot<token>" (soak.py подставляет свой сервер)
+TELEGRAM_API_BASE = os.getenv("TELEGRAM_API_BASE", "https://api.telegram.org")
 
-# === НАСТРОЙКИ ДЛЯ ПОДПИСКИ ===
-CHANNEL_ID = "-1003166042604"
-
-# Растения
-PLANTS_RARITY = {
-    "Cactus": "RARE", "Strawberry": "RARE", "Pumpkin": "EPIC", "Sunflower": "EPIC",
-    "Dragon Fruit": "LEGENDARY", "Eggplant": "LEGENDARY", "Watermelon": "MYTHIC",
-    "Grape": "MYTHIC", "Cocotank": "GODLY", "Carnivorous Plant": "GODLY",
-    "Mr Carrot": "SECRET", "Tomatrio": "SECRET", "Shroombino": "SECRET"
-}
+# Когда рассылать повторно опубликованный сток:
+# any - при любом изменении, new_plant - при появлении нового растения,
+# increase - при увеличении количества растения
+RESTOCK_NOTIFY_POLICY = os.getenv("RESTOCK_NOTIFY_POLICY", "any")
+# Сколько последних событий (снаряжение, объявления) помним для дайджестов
+RECENT_ALERTS_SIZE = 200
 
-# Эмодзи для растений
-PLANTS_EMOJI = {
-    "Cactus": "🌵", "Strawberry": "🍓", "Pumpkin": "🎃", "Sunflower": "🌻",
-    "Dragon Fruit": "🐉", "Eggplant": "🍆", "Watermelon": "🍉", "Grape": "🍇",
-    "Cocotank": "🥥", "Carnivorous Plant": "🌿", "Mr Carrot": "🥕",
-    "Tomatrio": "🍅", "Shroombino": "🍄"
-}
+# === АДМИНИСТРИРОВАНИЕ ===
+# Telegram id администраторов через запятую
+ADMIN_IDS = {int(admin_id) for admin_id in os.getenv("ADMIN_IDS", "").split(",") if admin_id.strip()}
+# Токен служебных HTTP-эндпоинтов (/debug/profile, /startup, /api_calls, /latency,
+# /lanes, /polling, счетчики /stats), без него они закрыты
+PROFILE_TOKEN = os.getenv("PROFILE_TOKEN")
+# По скольким последним рестокам считаются перцентили задержки
+LATENCY_WINDOW = 100
 
-# Эмодзи для редкостей
-RARITY_EMOJI = {
-    "RARE": "🔵",
-    "EPIC": "🟣", 
-    "LEGENDARY": "🟡",
-    "MYTHIC": "🔴",
-    "GODLY": "🌈",
-    "SECRET": "🔲"
-}
+# === HTTP API ===
+# Потоки waitress: каждый подключенный /stock/stream держит один поток
+HTTP_THREADS = int(os.getenv("HTTP_THREADS", 64))
+# Сколько SSE-клиентов принимаем, остальные потоки - для /stock, /health и статистики
+STOCK_STREAM_MAX_CLIENTS = int(os.getenv("STOCK_STREAM_MAX_CLIENTS", max(HTTP_THREADS - 16, 1)))
 
-# Порядок редкостей для меню
-RARITY_ORDER = ["RARE", "EPIC", "LEGENDARY", "MYTHIC", "GODLY", "SECRET"]
+# === НАСТРОЙКИ ДЛЯ ПОДПИСКИ ===
+CHANNEL_ID = "-1003166042604"
+# Размер пачки получателей в рассылке /all
+BROADCAST_CHUNK_SIZE = 1000
+# Сколько секунд доверяем положительной проверке подписки
+SUBSCRIPTION_CACHE_TTL = int(os.getenv("SUBSCRIPTION_CACHE_TTL", 600))
 
 # Глобальные переменные
 current_stock = {}
 last_restock_time = None
 last_message_id = None
 last_stock_message_id = None
-user_chat_ids = set()
+# Последний сток снаряжения и объявление: повторы не рассылаем
+last_gear_items = {}
+last_announcement = None
+# События для дайджестов: (время, вид, строка сводки); только в памяти, после перезапуска пусто
+recent_alerts = deque(maxlen=RECENT_ALERTS_SIZE)
+# Все подписчики: отсортированный массив int64 вместо set из int-объектов
+user_chat_ids = SubscriberRegistry()
+# user_id -> время (monotonic), до которого подписка считается подтвержденной
+subscription_cache = {}
+# Когда (monotonic) из кеша подписок последний раз вычищались истекшие записи
+subscription_cache_pruned_at = 0
+# Индекс растение -> пользователи для рассылки рестоков
+audience_index = AudienceIndex()
+# Пользователи в режиме дайджеста (в индекс мгновенной рассылки не входят)
+digest_schedule = DigestSchedule()
+# Последний сток для публичного /stock и /stock/stream
+stock_feed = StockFeed()
+# Выставляется после загрузки пользователей из БД или снимка, до этого рассылки ждут
+users_loaded = threading.Event()
+# Пользователи загружены полностью: только тогда снимок можно перезаписывать
+users_complete = threading.Event()
+# Цикл событий Telegram: рассылки из монитора Discord выполняются в нем
+telegram_loop = None
+telegram_ready = threading.Event()
+# Параллельная обработка апдейтов разных пользователей, по порядку - одного
+update_processor = PerUserUpdateProcessor()
+# Личные лимиты апдейтов и уже отправленные ответы (для склейки повторов)
+update_buckets = TokenBuckets()
+stock_replies = RecentReplies()
+# (chat_id, message_id) -> последнее состояние меню; помним час
+menu_edits = RecentReplies(window=3600)
+# Счетчики склеенных и пропущенных запросов
+interaction_stats = {"stock_coalesced": 0, "toggles_debounced": 0, "menu_edits_skipped": 0}
+# Изменения, полученные от других экземпляров через LISTEN/NOTIFY
+sync_stats = {"user": 0, "settings": 0, "stock": 0, "resyncs": 0, "errors": 0}
+# Планировщик опроса Discord (создается в потоке мониторинга)
+discord_poller = None
+# Курсоры каналов Discord из свежего снимка
+warm_start_cursors = {}
+# Администратор, запросивший профиль следующей рассылки стока (/profile next)
+profile_next_broadcast_chat_id = None
 
 # === TELEGRAM БОТ ===
-telegram_app = Application.builder().token(TELEGRAM_TOKEN).build()
-telegram_bot = telegram_app.bot
+# Создаются в build_telegram_app(), чтобы импорт модуля не имел побочных эффектов
+telegram_app = None
+telegram_bot = None
+
+async def on_telegram_ready(application):
+    """Вызывается PTB после инициализации бота, перед стартом опроса"""
+    global telegram_loop
+    telegram_loop = asyncio.get_running_loop()
+    telegram_ready.set()
+    application.create_task(run_digests())
+    application.create_task(run_snapshots())
+    startup_report.mark("serving_updates")
+    logger.info(startup_report.format(), extra={"startup": startup_report.as_dict()})
+
+def build_telegram_app():
+    """Создает Telegram приложение"""
+    global telegram_app, telegram_bot
+    telegram_app = (
+        Application.builder()
+        .token(TELEGRAM_TOKEN)
+        .base_url(f"{TELEGRAM_API_BASE}/bot")
+        .request(InstrumentedRequest(connection_pool_size=BOT_API_CONCURRENCY))
+        .concurrent_updates(update_processor)
+        .post_init(on_telegram_ready)
+        .build()
+    )
+    telegram_bot = telegram_app.bot
+    return telegram_app
 
 # Основная клавиатура
 keyboard = ReplyKeyboardMarkup(
@@ -112,21 +344,119 @@ def get_user_settings(user_id):
     """Получает настройки пользователя из БД"""
     return db.get_user_settings(user_id)
 
+def get_visible_mask(user_settings):
+    """Маска растений, видимых пользователю с данными настройками"""
+    return visible_plants_mask(
+        user_settings.get("ignored_mask", 0),
+        user_settings.get("watched_plants", 0),
+        user_settings.get("ignored_plants", 0),
+        user_settings.get("alert_kinds", 0)
+    )
+
+def index_user(user_id, visible_mask, digest_interval=0, last_digest_at=None):
+    """Раскладывает пользователя по рассылкам: мгновенные рестоки или дайджест"""
+    if digest_interval:
+        audience_index.remove_user(user_id)
+        last_digest_at = digest_schedule.last_digest_at(user_id) or last_digest_at or time.time()
+        digest_schedule.set_user(user_id, visible_mask, digest_interval, last_digest_at)
+    else:
+        digest_schedule.remove_user(user_id)
+        audience_index.set_user(user_id, visible_mask)
+
+def indexed_visible_mask(user_id):
+    """Маска видимых растений из индексов рассылки (они совпадают с БД) или None"""
+    visible_mask = audience_index.visible_mask(user_id)
+    if visible_mask is None:
+        visible_mask = digest_schedule.visible_mask(user_id)
+    return visible_mask
+
+def get_cached_visible_mask(user_id):
+    """Маска видимых растений из индексов рассылки, иначе из БД"""
+    visible_mask = indexed_visible_mask(user_id)
+    if visible_mask is None:
+        visible_mask = get_visible_mask(get_user_settings(user_id))
+    return visible_mask
+
 def update_user_settings(user_id, new_settings):
-    """Обновляет настройки пользователя в БД"""
-    return db.update_user_settings(user_id, new_settings)
+    """Обновляет настройки пользователя в БД и индексе рассылки"""
+    if not db.update_user_settings(user_id, new_settings):
+        return False
+    index_user(
+        user_id, get_visible_mask(new_settings),
+        new_settings.get("digest_interval", 0), new_settings.get("last_digest_at")
+    )
+    return True
 
-def load_users():
-    """Загружает пользователей из БД"""
-    global user_chat_ids
-    user_chat_ids = set(db.get_all_users())
-    print(f"📊 Загружено {len(user_chat_ids)} пользователей из БД")
+def index_user_rows(rows):
+    """Раскладывает строки (user_id, маска, интервал дайджеста, время дайджеста) по рассылкам"""
+    realtime = []
+    digest = []
+    for user_id, visible_mask, digest_interval, last_digest_at in rows:
+        if digest_interval:
+            digest.append((user_id, visible_mask, digest_interval, last_digest_at or time.time()))
+        else:
+            realtime.append((user_id, visible_mask))
+    audience_index.load(realtime)
+    digest_schedule.load(digest)
+    # Пользователь мог сменить режим доставки с момента снимка
+    for user_id, _ in realtime:
+        if user_id in digest_schedule:
+            digest_schedule.remove_user(user_id)
+    for user_id, _, _, _ in digest:
+        if user_id in audience_index:
+            audience_index.remove_user(user_id)
+
+def load_users(since=None):
+    """Загружает пользователей и их фильтры из БД (дополняет уже добавленных).
+    
+    С since (unix-время) читает только пользователей, изменившихся после него
+    """
+    loaded = 0
+    
+    def user_id_batches():
+        nonlocal loaded
+        # Одна потоковая выборка заполняет реестр, индекс рассылки и расписание дайджестов
+        for rows in db.iter_user_settings(since=since):
+            index_user_rows(
+                (user_id, visible_plants_mask(ignored_mask, watched_plants, ignored_plants, alert_kinds), digest_interval, last_digest_at)
+                for user_id, ignored_mask, watched_plants, ignored_plants, digest_interval, last_digest_at, alert_kinds in rows
+            )
+            loaded += len(rows)
+            yield [row[0] for row in rows]
+    
+    user_chat_ids.load_sorted_batches(user_id_batches())
+    if since is None:
+        logger.info(f"📊 Загружено {len(user_chat_ids)} пользователей из БД")
+    else:
+        logger.info(f"🔄 Досинхронизировано {loaded} пользователей из БД, всего {len(user_chat_ids)}")
+
+def load_users_in_background(snapshot=None):
+    """Подключается к БД и загружает пользователей, не задерживая старт бота.
+    
+    После старта из снимка читает только изменения с момента его записи
+    """
+    try:
+        with startup_report.phase("db_connect"):
+            db.conn
+        with startup_report.phase("load_users"):
+            load_users(since=snapshot.created_at - SNAPSHOT_RECONCILE_MARGIN if snapshot else None)
+        users_complete.set()
+    except Exception as e:
+        logger.error(f"❌ Ошибка загрузки пользователей: {e}")
+    finally:
+        users_loaded.set()
 
 def add_user(chat_id):
     """Добавляет пользователя в БД"""
     if db.add_user(chat_id):
         user_chat_ids.add(chat_id)
-        print(f"👤 Добавлен новый пользователь: {chat_id}")
+        if chat_id not in audience_index and chat_id not in digest_schedule:
+            user_settings = get_user_settings(chat_id)
+            index_user(
+                chat_id, get_visible_mask(user_settings),
+                user_settings.get("digest_interval", 0), user_settings.get("last_digest_at")
+            )
+        logger.debug("👤 Добавлен новый пользователь: %s", chat_id)
 
 # === ВРЕМЕННЫЕ НАСТРОЙКИ ДЛЯ РЕДАКТИРОВАНИЯ ===
 temp_settings = {}
@@ -139,6 +469,11 @@ def get_temp_settings(user_id):
         temp_settings[user_id] = current_settings.copy()
     return temp_settings[user_id]
 
+async def load_temp_settings(user_id):
+    """Читает настройки из БД во временные в отдельном потоке, не держа цикл событий"""
+    if user_id not in temp_settings:
+        await asyncio.to_thread(get_temp_settings, user_id)
+
 def save_temp_settings(user_id, new_settings):
     """Сохраняет временные настройки"""
     temp_settings[user_id] = new_settings
@@ -155,16 +490,44 @@ def apply_temp_settings(user_id):
 def toggle_rarity_ignore_temp(user_id, rarity):
     """Переключает игнорирование редкости во временных настройках"""
     user_settings = get_temp_settings(user_id)
-    ignored_rarities = user_settings.get("ignored_rarities", [])
+    ignored_mask = user_settings.get("ignored_mask", 0) ^ RARITY_BIT.get(rarity, 0)
     
-    if rarity in ignored_rarities:
-        ignored_rarities.remove(rarity)
+    user_settings["ignored_mask"] = ignored_mask
+    save_temp_settings(user_id, user_settings)
+    return ignored_mask
+
+def cycle_plant_temp(user_id, plant):
+    """Переключает растение по кругу: обычное -> отслеживаемое -> игнорируемое -> обычное"""
+    user_settings = get_temp_settings(user_id)
+    bit = PLANT_BIT.get(plant, 0)
+    watched_plants = user_settings.get("watched_plants", 0)
+    ignored_plants = user_settings.get("ignored_plants", 0)
+    
+    if watched_plants & bit:
+        watched_plants &= ~bit
+        ignored_plants |= bit
+    elif ignored_plants & bit:
+        ignored_plants &= ~bit
     else:
-        ignored_rarities.append(rarity)
+        watched_plants |= bit
     
-    user_settings["ignored_rarities"] = ignored_rarities
+    user_settings["watched_plants"] = watched_plants
+    user_settings["ignored_plants"] = ignored_plants
+    save_temp_settings(user_id, user_settings)
+
+def cycle_digest_temp(user_id):
+    """Переключает режим доставки по кругу: мгновенно -> дайджест 1 ч -> ... -> мгновенно"""
+    user_settings = get_temp_settings(user_id)
+    user_settings["digest_interval"] = next_digest_interval(user_settings.get("digest_interval", 0))
+    save_temp_settings(user_id, user_settings)
+
+def toggle_alert_temp(user_id, kind):
+    """Включает или выключает подписку на события (снаряжение, объявления)"""
+    if kind not in ALERT_KINDS:
+        return
+    user_settings = get_temp_settings(user_id)
+    user_settings["alert_kinds"] = user_settings.get("alert_kinds", 0) ^ (1 << ALERT_KINDS.index(kind))
     save_temp_settings(user_id, user_settings)
-    return ignored_rarities
 
 # === МЕНЮ НАСТРОЕК ===
 async def show_settings_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -173,42 +536,157 @@ async def show_settings_menu(update: Update, context: ContextTypes.DEFAULT_TYPE)
     
     # Получаем временные настройки (не сохраняем в БД пока не подтвердят)
     user_settings = get_temp_settings(user_id)
-    ignored_rarities = user_settings.get("ignored_rarities", [])
+    ignored_mask = user_settings.get("ignored_mask", 0)
     
     text = "⚙️ *НАСТРОЙКИ УВЕДОМЛЕНИЙ*\n\n"
     text += "🎯 *Выбери редкости которые хочешь игнорировать:*\n\n"
     
-    if not ignored_rarities:
+    if not ignored_mask:
         text += "🔕 *Игнорируемые редкости:* Нет\n\n"
     else:
         text += "🔕 *Игнорируемые редкости:*\n"
-        for rarity in ignored_rarities:
+        for rarity in mask_to_rarities(ignored_mask):
             emoji = RARITY_EMOJI.get(rarity, "⚪")
             text += f"├─ {emoji} {rarity}\n"
         text += "\n"
     
+    watched_plants = user_settings.get("watched_plants", 0)
+    if watched_plants:
+        text += "👁 *Включен список растений* - фильтр по редкостям не действует\n\n"
+    
+    digest_interval = user_settings.get("digest_interval", 0)
+    text += f"📬 *Доставка:* {format_digest_interval(digest_interval)}\n"
+    if digest_interval:
+        text += "Вместо уведомления о каждом рестоке придет одна сводка за период\n"
+    text += "\n"
+    
+    alert_kinds = user_settings.get("alert_kinds", 0)
+    subscribed = [ALERT_NAMES[kind] for i, kind in enumerate(ALERT_KINDS) if alert_kinds & (1 << i)]
+    text += f"🔔 *Подписки:* {', '.join(subscribed) if subscribed else 'Нет'}\n\n"
+    
     text += "💡 *Настройки сохранятся только после нажатия '✅ Подтвердить'*"
 
     # Создаем клавиатуру для выбора редкостей
     keyboard_buttons = []
     for rarity in RARITY_ORDER:
         emoji = RARITY_EMOJI.get(rarity, "⚪")
-        if rarity in ignored_rarities:
+        if ignored_mask & RARITY_BIT[rarity]:
             button_text = f"✅ {emoji} {rarity}"
         else:
             button_text = f"❌ {emoji} {rarity}"
         keyboard_buttons.append([InlineKeyboardButton(button_text, callback_data=f"toggle_{rarity}")])
     
+    keyboard_buttons.append([InlineKeyboardButton("🌱 Настроить растения", callback_data="plants_menu")])
+    keyboard_buttons.append([InlineKeyboardButton(f"📬 Доставка: {format_digest_interval(digest_interval)}", callback_data="digest_cycle")])
+    for i, kind in enumerate(ALERT_KINDS):
+        state = "✅" if alert_kinds & (1 << i) else "❌"
+        keyboard_buttons.append([InlineKeyboardButton(f"{state} {ALERT_NAMES[kind]}", callback_data=f"alert_{kind}")])
     keyboard_buttons.append([InlineKeyboardButton("📊 Показать текущий сток с фильтром", callback_data="test_filter")])
     keyboard_buttons.append([InlineKeyboardButton("✅ Подтвердить изменения", callback_data="confirm_changes")])
     
     reply_markup = InlineKeyboardMarkup(keyboard_buttons)
     
     if update.callback_query:
-        await update.callback_query.edit_message_text(text, reply_markup=reply_markup, parse_mode='Markdown')
+        await edit_menu(update.callback_query, text, reply_markup)
     else:
         await update.message.reply_text(text, reply_markup=reply_markup, parse_mode='Markdown')
 
+async def show_plants_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Показывает меню отслеживаемых и игнорируемых растений"""
+    user_id = update.effective_user.id
+    
+    user_settings = get_temp_settings(user_id)
+    watched_plants = user_settings.get("watched_plants", 0)
+    ignored_plants = user_settings.get("ignored_plants", 0)
+    
+    text = "🌱 *НАСТРОЙКИ РАСТЕНИЙ*\n\n"
+    text += "Нажимай на растение, чтобы переключить:\n"
+    text += "➖ обычное → 👁 отслеживать → 🔕 игнорировать\n\n"
+    
+    if watched_plants:
+        text += "👁 *Отслеживаемые:* " + ", ".join(mask_to_plants(watched_plants)) + "\n"
+        text += "Уведомления будут приходить только об этих растениях\n\n"
+    else:
+        text += "👁 *Отслеживаемые:* Нет\n\n"
+    
+    if ignored_plants:
+        text += "🔕 *Игнорируемые:* " + ", ".join(mask_to_plants(ignored_plants)) + "\n\n"
+    else:
+        text += "🔕 *Игнорируемые:* Нет\n\n"
+    
+    text += "💡 *Настройки сохранятся только после нажатия '✅ Подтвердить'*"
+    
+    keyboard_buttons = []
+    row = []
+    for plant in PLANT_ORDER:
+        bit = PLANT_BIT[plant]
+        if watched_plants & bit:
+            state = "👁"
+        elif ignored_plants & bit:
+            state = "🔕"
+        else:
+            state = "➖"
+        row.append(InlineKeyboardButton(f"{state} {PLANTS_EMOJI.get(plant, '🌱')} {plant}", callback_data=f"plant_{plant}"))
+        if len(row) == 2:
+            keyboard_buttons.append(row)
+            row = []
+    if row:
+        keyboard_buttons.append(row)
+    
+    keyboard_buttons.append([InlineKeyboardButton("⬅️ Назад к редкостям", callback_data="settings_menu")])
+    keyboard_buttons.append([InlineKeyboardButton("✅ Подтвердить изменения", callback_data="confirm_changes")])
+    
+    await edit_menu(update.callback_query, text, InlineKeyboardMarkup(keyboard_buttons))
+
+async def edit_menu(query, text, reply_markup):
+    """Правит меню, пропуская правку без изменений (Bot API ответил бы "message is not modified")"""
+    if query.message is None:
+        await query.edit_message_text(text, reply_markup=reply_markup, parse_mode='Markdown')
+        return
+    
+    key = (query.message.chat_id, query.message.message_id)
+    state = (text, tuple((button.text, button.callback_data) for row in reply_markup.inline_keyboard for button in row))
+    if menu_edits.is_recent(key, state):
+        interaction_stats["menu_edits_skipped"] += 1
+        return
+    await query.edit_message_text(text, reply_markup=reply_markup, parse_mode='Markdown')
+    menu_edits.remember(key, state)
+
+# Переключатели, которые сами перерисовывают меню: префикс callback_data -> меню
+MENU_TOGGLES = {"toggle_": "settings", "digest_cycle": "settings", "alert_": "settings", "plant_": "plants"}
+
+def toggle_menu(data):
+    """Меню, которое перерисует нажатие-переключатель; None для остальных кнопок"""
+    for prefix, menu in MENU_TOGGLES.items():
+        if data and data.startswith(prefix):
+            return menu
+    return None
+
+def menu_message_key(query):
+    """(чат, сообщение) меню, в котором нажата кнопка"""
+    return (query.message.chat_id, query.message.message_id) if query.message is not None else None
+
+def menu_update_pending(update, menu):
+    """За нажатием в очереди пользователя есть еще переключатели - меню перерисует последний.
+    
+    Только если вся очередь - переключатели того же меню в том же сообщении
+    (test_filter, plants_menu и прочие кнопки меню не перерисуют) и лимит
+    апдейтов пропустит ее целиком: отброшенное throttle_update нажатие
+    меню уже не перерисует
+    """
+    user_id = update.effective_user.id
+    queued = update_processor.queued_callbacks(user_id)
+    if not queued:
+        return False
+    message_key = menu_message_key(update.callback_query)
+    for query in queued:
+        if query is None or toggle_menu(query.data) != menu or menu_message_key(query) != message_key:
+            return False
+    if not is_admin(user_id) and update_buckets.available(user_id) < len(queued):
+        return False
+    interaction_stats["toggles_debounced"] += 1
+    return True
+
 async def handle_settings_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обрабатывает нажатия в меню настроек"""
     query = update.callback_query
@@ -217,11 +695,38 @@ async def handle_settings_callback(update: Update, context: ContextTypes.DEFAULT
     user_id = update.effective_user.id
     data = query.data
     
+    # Меню работает с временными настройками; подтверждение без них - ошибка, а не пустое сохранение
+    if data != "confirm_changes":
+        await load_temp_settings(user_id)
+    
     if data.startswith("toggle_"):
         rarity = data.replace("toggle_", "")
-        ignored_rarities = toggle_rarity_ignore_temp(user_id, rarity)
+        toggle_rarity_ignore_temp(user_id, rarity)
+        
+        # Показываем обновленное меню (серию нажатий - одной правкой)
+        if not menu_update_pending(update, "settings"):
+            await show_settings_menu(update, context)
+        
+    elif data.startswith("plant_"):
+        plant = data.replace("plant_", "", 1)
+        cycle_plant_temp(user_id, plant)
+        if not menu_update_pending(update, "plants"):
+            await show_plants_menu(update, context)
+        
+    elif data == "plants_menu":
+        await show_plants_menu(update, context)
         
-        # Показываем обновленное меню
+    elif data == "digest_cycle":
+        cycle_digest_temp(user_id)
+        if not menu_update_pending(update, "settings"):
+            await show_settings_menu(update, context)
+        
+    elif data.startswith("alert_"):
+        toggle_alert_temp(user_id, data.replace("alert_", "", 1))
+        if not menu_update_pending(update, "settings"):
+            await show_settings_menu(update, context)
+        
+    elif data == "settings_menu":
         await show_settings_menu(update, context)
         
     elif data == "test_filter":
@@ -230,23 +735,26 @@ async def handle_settings_callback(update: Update, context: ContextTypes.DEFAULT
         
     elif data == "confirm_changes":
         # Подтверждаем изменения и сохраняем настройки в БД
-        if apply_temp_settings(user_id):
-            user_settings = get_user_settings(user_id)
-            ignored_count = len(user_settings.get("ignored_rarities", []))
+        if await asyncio.to_thread(apply_temp_settings, user_id):
+            user_settings = await asyncio.to_thread(get_user_settings, user_id)
+            ignored_count = user_settings.get("ignored_mask", 0).bit_count()
+            watched_count = user_settings.get("watched_plants", 0).bit_count()
+            ignored_plants_count = user_settings.get("ignored_plants", 0).bit_count()
+            delivery = format_digest_interval(user_settings.get("digest_interval", 0))
+            alert_kinds = user_settings.get("alert_kinds", 0)
+            subscribed = ", ".join(ALERT_NAMES[kind] for i, kind in enumerate(ALERT_KINDS) if alert_kinds & (1 << i)) or "нет"
             
-            # Удаляем сообщение с настройками
-            try:
-                await query.message.delete()
-            except Exception as e:
-                print(f"❌ Не удалось удалить сообщение: {e}")
-            
-            # Отправляем подтверждение
-            await context.bot.send_message(
-                chat_id=user_id,
-                text=f"✅ *Настройки сохранены!*\n\n"
-                     f"🔕 Игнорируемых редкостей: {ignored_count}\n\n"
-                     f"Теперь ты будешь получать уведомления только о выбранных редкостях!",
-                reply_markup=keyboard,
+            # Заменяем меню подтверждением (клавиатура у пользователя уже есть)
+            if query.message is not None:
+                menu_edits.forget((query.message.chat_id, query.message.message_id))
+            await query.edit_message_text(
+                f"✅ *Настройки сохранены!*\n\n"
+                     f"🔕 Игнорируемых редкостей: {ignored_count}\n"
+                     f"👁 Отслеживаемых растений: {watched_count}\n"
+                     f"🚫 Игнорируемых растений: {ignored_plants_count}\n"
+                     f"📬 Доставка: {delivery}\n"
+                     f"🔔 Подписки: {subscribed}\n\n"
+                f"Теперь ты будешь получать уведомления только о выбранных растениях!",
                 parse_mode='Markdown'
             )
         else:
@@ -258,17 +766,21 @@ async def test_user_filter(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     # Используем временные настройки для теста
     user_settings = get_temp_settings(user_id)
-    ignored_rarities = user_settings.get("ignored_rarities", [])
+    visible_mask = get_visible_mask(user_settings)
     
     # Получаем текущий сток
-    stock_data, time_info = get_latest_stock()
+    stock_data, time_info = await stock_cache.get()
     
     if stock_data:
         # Применяем фильтр пользователя
-        filtered_stock = filter_stock_by_settings(stock_data, ignored_rarities)
+        telegram_message = render_stock_view(stock_data, time_info, visible_mask)
         
-        if filtered_stock:
-            telegram_message = create_telegram_message(filtered_stock, time_info, is_alert=False)
+        # Тот же результат только что отправлен - повторное нажатие не отвечаем
+        if stock_replies.is_recent((user_id, "test_filter"), telegram_message):
+            interaction_stats["stock_coalesced"] += 1
+            return
+        
+        if telegram_message:
             await update.callback_query.message.reply_text(
                 telegram_message,
                 parse_mode='Markdown'
@@ -276,135 +788,325 @@ async def test_user_filter(update: Update, context: ContextTypes.DEFAULT_TYPE):
         else:
             await update.callback_query.message.reply_text(
                 "🌫️ *С твоими настройками этот сток пуст!*\n\n"
-                "Все растения в этом стоке находятся в твоем списке игнорируемых редкостей.",
+                "Все растения в этом стоке отфильтрованы твоими настройками.",
                 parse_mode='Markdown'
             )
+        stock_replies.remember((user_id, "test_filter"), telegram_message)
     else:
         await update.callback_query.message.reply_text("❌ Не удалось получить сток")
 
 # === ФИЛЬТРАЦИЯ СТОКА ===
-def filter_stock_by_settings(stock_data, ignored_rarities):
-    """Фильтрует сток по игнорируемым редкостям"""
-    if not ignored_rarities:
+def filter_stock_by_settings(stock_data, visible_mask):
+    """Фильтрует сток по маске видимых пользователю растений (get_visible_mask)"""
+    if visible_mask & ALL_PLANTS_MASK == ALL_PLANTS_MASK:
         return stock_data
     
-    filtered_stock = {}
-    for plant, stock in stock_data.items():
-        rarity = PLANTS_RARITY.get(plant)
-        if rarity not in ignored_rarities:
-            filtered_stock[plant] = stock
+    return {
+        plant: stock for plant, stock in stock_data.items()
+        if PLANT_BIT.get(plant, 0) & visible_mask
+    }
+
+# Готовые сообщения стока: (время рестока, видимые растения стока) -> текст
+stock_render_cache = {}
+STOCK_RENDER_CACHE_SIZE = 256
+
+def render_stock_view(stock_data, time_info, visible_mask):
+    """Сообщение со стоком для фильтра пользователя или None, если все отфильтровано.
     
-    return filtered_stock
+    Пользователи с одинаковым набором видимых растений стока получают один и тот же текст
+    """
+    shown_mask = visible_mask & stock_plant_mask(stock_data)
+    if not shown_mask:
+        return None
+    key = (time_info, shown_mask)
+    message = stock_render_cache.get(key)
+    if message is None:
+        if len(stock_render_cache) >= STOCK_RENDER_CACHE_SIZE:
+            stock_render_cache.clear()
+        message = create_telegram_message(filter_stock_by_settings(stock_data, visible_mask), time_info, is_alert=False)
+        stock_render_cache[key] = message
+    return message
 
-def should_notify_user(stock_data, ignored_rarities):
-    """Определяет, нужно ли уведомлять пользователя"""
-    if not stock_data:
-        return False
+def diff_stock(old_stock, new_stock, policy=RESTOCK_NOTIFY_POLICY):
+    """Возвращает растения, изменившиеся между снимками стока согласно политике"""
+    old_stock = old_stock or {}
     
-    if not ignored_rarities:
-        return True
+    if policy == "new_plant":
+        return {plant for plant in new_stock if plant not in old_stock}
     
-    # Проверяем, есть ли хоть одно растение с неигнорируемой редкостью
-    for plant in stock_data.keys():
-        rarity = PLANTS_RARITY.get(plant)
-        if rarity not in ignored_rarities:
-            return True
+    if policy == "increase":
+        return {plant for plant, stock in new_stock.items() if stock > old_stock.get(plant, 0)}
     
-    return False
+    # any: появление, исчезновение или изменение количества
+    return {
+        plant for plant in old_stock.keys() | new_stock.keys()
+        if old_stock.get(plant) != new_stock.get(plant)
+    }
 
 # === ОСНОВНЫЕ ФУНКЦИИ БОТА ===
-async def send_telegram_alert_to_all(stock_data):
-    """Отправляет уведомления всем пользователям с учетом их настроек"""
-    if not user_chat_ids:
-        print("📭 Нет пользователей для рассылки")
-        return
+@track_handler
+async def send_telegram_alert_to_all(stock_data, changed_plants=None, trace=None):
+    """Отправляет уведомления всем пользователям с учетом их настроек.
     
-    print(f"📤 Начинаем рассылку для {len(user_chat_ids)} пользователей...")
+    changed_plants - растения, изменившиеся с прошлого стока; уведомляются только
+    пользователи, у которых изменился отфильтрованный сток. trace - RestockTrace
+    рестока, сохраняется в БД после рассылки
+    """
+    global profile_next_broadcast_chat_id
     
-    tasks = []
-    for chat_id in list(user_chat_ids):
-        # Используем только сохраненные настройки из БД
-        user_settings = get_user_settings(chat_id)
-        ignored_rarities = user_settings.get("ignored_rarities", [])
-        
-        # Проверяем, нужно ли уведомлять этого пользователя
-        if should_notify_user(stock_data, ignored_rarities):
-            # Фильтруем сток для этого пользователя
-            user_stock = filter_stock_by_settings(stock_data, ignored_rarities)
-            user_message = create_telegram_message(user_stock, last_restock_time, is_alert=True)
-            
-            tasks.append(send_single_message(chat_id, user_message))
-        else:
-            print(f"🔇 Пропускаем пользователя {chat_id} - все редкости игнорируются")
+    # Профилируем рассылку, если администратор запросил /profile next
+    profile_chat_id, profile_next_broadcast_chat_id = profile_next_broadcast_chat_id, None
+    profiler = SamplingProfiler() if profile_chat_id else None
+    if profiler and not profiler.start():
+        profiler = None
     
+    try:
+        recipients = await broadcast_restock(stock_data, changed_plants, trace)
+        if trace:
+            await save_restock_trace(trace, recipients)
+    finally:
+        if profiler:
+            await send_profile_report(telegram_bot, profile_chat_id, profiler.stop(), "📤 Профиль рассылки стока")
+
+async def save_restock_trace(trace, recipients):
+    """Пишет итог трассы рестока в лог и БД"""
+    summary = trace.summary(recipients)
+    logger.info(
+        f"⏱️ Ресток {trace.message_id}: первая доставка через {summary['first']} мс, "
+        f"последняя через {summary['last']} мс после публикации",
+        extra={"event": "restock_trace", "message_id": trace.message_id, **summary}
+    )
+    await asyncio.to_thread(db.save_restock_trace, trace.message_id, trace.posted_at, summary)
+
+async def broadcast_restock(stock_data, changed_plants, trace=None):
+    """Рассылка стока аудитории изменившихся растений, возвращает число получателей"""
+    if trace:
+        trace.mark("fanout_start")
+    
+    # Аудитория - объединение подписчиков изменившихся растений из индекса.
+    # Исчезнувшее из стока растение не повод для уведомления: показать по нему нечего
+    plants = stock_data.keys() if changed_plants is None else [plant for plant in changed_plants if plant in stock_data]
+    stock_mask = stock_plant_mask(stock_data)
+    audience = {
+        chat_id: visible_mask for chat_id, visible_mask in audience_index.audience(plants).items()
+        if visible_mask & stock_mask
+    }
+    
+    if not audience:
+        logger.info("🔇 Нет пользователей для уведомления")
+        return 0
+    
+    logger.info(f"📤 Начинаем рассылку для {len(audience)} пользователей...")
+    
+    # Сначала те, у кого в стоке самые редкие растения; среди равных - по кругу
+    plan = fanout_planner.plan(audience, stock_mask)
+    if trace:
+        trace.set_tiers({tier: len(users) for tier, users in plan})
+    
+    # Одинаковые отфильтрованные стоки рендерим один раз
+    rendered = {}
+    
+    def deliveries():
+        for tier, users in plan:
+            for chat_id, visible_mask in users:
+                view_mask = visible_mask & stock_mask
+                user_message = rendered.get(view_mask)
+                if user_message is None:
+                    user_stock = filter_stock_by_settings(stock_data, visible_mask)
+                    user_message = rendered[view_mask] = create_telegram_message(user_stock, last_restock_time, is_alert=True)
+                yield tier, chat_id, user_message
+    
+    # Пул отправителей берет получателей строго по порядку плана
+    queue = deliveries()
+    started = time.monotonic()
+    tier_sent = {tier: 0 for tier, _ in plan}
+    tier_done = {}
+    failed_chat_ids = []
+    
+    async def worker():
+        for tier, chat_id, user_message in queue:
+            try:
+                if await send_single_message(chat_id, user_message, trace, tier):
+                    tier_sent[tier] += 1
+            except Exception:
+                failed_chat_ids.append(chat_id)
+                audience_index.remove_user(chat_id)
+            tier_done[tier] = time.monotonic() - started
+    
+    with bot_lane(LANE_RESTOCK):
+        await asyncio.gather(*(worker() for _ in range(min(FANOUT_WORKERS, len(audience)))))
+    user_chat_ids.discard_many(failed_chat_ids)
+    
+    # Одна итоговая строка на рассылку вместо строки на каждого пользователя
+    sent_count = sum(tier_sent.values())
+    tiers_report = ", ".join(
+        f"{tier} {tier_sent[tier]}/{len(users)} за {tier_done.get(tier, 0):.1f} с" for tier, users in plan
+    )
+    logger.info(
+        f"📊 Рассылка завершена: отправлено {sent_count} из {len(audience)} сообщений ({tiers_report})",
+        extra={
+            "event": "restock_broadcast", "recipients": len(audience), "sent": sent_count,
+            "tiers": {
+                tier: {"recipients": len(users), "sent": tier_sent[tier], "seconds": round(tier_done.get(tier, 0), 3)}
+                for tier, users in plan
+            }
+        }
+    )
+    return len(audience)
+
+async def run_digests():
+    """Раз в DIGEST_TICK секунд рассылает дайджесты тем, кому подошло время"""
+    await asyncio.to_thread(users_loaded.wait)
+    while True:
+        await asyncio.sleep(DIGEST_TICK)
+        try:
+            await send_due_digests()
+        except Exception as e:
+            logger.error(f"❌ Ошибка рассылки дайджестов: {e}")
+
+async def send_due_digests():
+    """Сводка рестоков с прошлой доставки для каждого пользователя, которому пора"""
+    now = time.time()
+    due = digest_schedule.due(now)
+    if not due:
+        return
+    
+    # Каждому пользователю дайджест шлет один экземпляр - тот, чья отметка в БД прошла.
+    # Срок сдвигаем всем: и тем, кому нечего отправить, и взятым другим экземпляром
+    user_ids = [chat_id for chat_id, _, _ in due]
+    claimed = await asyncio.to_thread(db.claim_digests, user_ids, now)
+    digest_schedule.mark_sent(user_ids, now)
+    if claimed is not None:
+        claimed = set(claimed)
+        due = [entry for entry in due if entry[0] in claimed]
+        if not due:
+            return
+    
+    # Один запрос истории на всех: с самой ранней прошлой доставки
+    restocks = await asyncio.to_thread(db.get_stock_since, min(last_at for _, _, last_at in due))
+    restock_times = [created_at for _, _, created_at in restocks]
+    suffix_masks = suffix_plant_masks(restocks)
+    alerts = list(recent_alerts)
+    alert_times = [created_at for created_at, _, _ in alerts]
+    alert_masks = suffix_alert_masks(alerts)
+    
+    # Одинаковые сводки (тот же период и те же видимые растения) рендерим один раз
+    rendered = {}
+    chat_ids = []
+    tasks = []
+    for chat_id, visible_mask, last_at in due:
+        start = bisect_right(restock_times, last_at)
+        view_mask = visible_mask & suffix_masks[start]
+        alert_start = bisect_right(alert_times, last_at)
+        alert_mask = visible_mask & alert_masks[alert_start]
+        if not view_mask and not alert_mask:
+            continue
+        key = (start, view_mask, alert_start, alert_mask)
+        message = rendered.get(key)
+        if message is None:
+            period = restocks[start:]
+            lines = [line for _, kind, line in alerts[alert_start:] if alert_mask & ALERT_BIT[kind]]
+            message = rendered[key] = create_digest_message(summarize_restocks(period, view_mask), period, lines)
+        chat_ids.append(chat_id)
+        tasks.append(send_single_message(chat_id, message))
+    
+    sent_count = 0
     if tasks:
-        results = await asyncio.gather(*tasks, return_exceptions=True)
-        
-        sent_count = 0
-        for i, result in enumerate(results):
-            chat_id = list(user_chat_ids)[i]
+        with bot_lane(LANE_BROADCAST):
+            results = await asyncio.gather(*tasks, return_exceptions=True)
+        failed_chat_ids = []
+        for chat_id, result in zip(chat_ids, results):
             if isinstance(result, Exception):
-                user_chat_ids.discard(chat_id)
-            else:
+                failed_chat_ids.append(chat_id)
+                digest_schedule.remove_user(chat_id)
+            elif result is True:
                 sent_count += 1
-        
-        print(f"📊 Рассылка завершена: отправлено {sent_count} сообщений")
-    else:
-        print("🔇 Нет пользователей для уведомления")
+        user_chat_ids.discard_many(failed_chat_ids)
+    
+    logger.info(
+        f"📰 Дайджесты: {len(due)} пользователей, отправлено {sent_count}",
+        extra={"event": "digest_broadcast", "due": len(due), "recipients": len(chat_ids), "sent": sent_count}
+    )
 
 async def handle_button_click(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Обрабатывает запрос стока с учетом фильтров"""
-    print("🎯 Запрос текущего стока от пользователя")
+    """Обрабатывает запрос стока с учетом фильтров.
     
-    processing_msg = await update.message.reply_text("⏳ Получаем сток...")
+    Вызывается из handle_message, который уже проверил подписку и добавил пользователя,
+    поэтому при закешированном стоке обходится одним вызовом Bot API
+    """
+    logger.debug("🎯 Запрос текущего стока от пользователя %s", update.effective_user.id)
     
     user_id = update.effective_user.id
-    is_subscribed = await check_subscription(user_id)
-    
-    if not is_subscribed:
-        await processing_msg.delete()
-        text, reply_markup = create_subscription_message()
-        await update.message.reply_text(text, reply_markup=reply_markup)
-        return
     
-    add_user(update.message.chat_id)
-    
-    # Используем только сохраненные настройки из БД
-    user_settings = get_user_settings(user_id)
-    ignored_rarities = user_settings.get("ignored_rarities", [])
+    # Сохраненные настройки: из индексов рассылки, для неизвестных - из БД в отдельном потоке
+    visible_mask = indexed_visible_mask(user_id)
+    if visible_mask is None:
+        visible_mask = await asyncio.to_thread(get_cached_visible_mask, user_id)
     
     # Получаем последний известный сток
-    stock_data, time_info = get_latest_stock()
+    stock_data, time_info = await stock_cache.get()
     
     if stock_data:
         # Применяем фильтр пользователя
-        filtered_stock = filter_stock_by_settings(stock_data, ignored_rarities)
+        telegram_message = render_stock_view(stock_data, time_info, visible_mask)
         
-        if filtered_stock:
-            telegram_message = create_telegram_message(filtered_stock, time_info, is_alert=False)
-            await processing_msg.delete()
+        if telegram_message:
             await update.message.reply_text(
                 telegram_message, 
                 reply_markup=keyboard,
                 parse_mode='Markdown'
             )
-            print("✅ Отправлен отфильтрованный сток")
+            logger.debug("✅ Отправлен отфильтрованный сток")
         else:
-            await processing_msg.delete()
             await update.message.reply_text(
                 "🌫️ *Ой, а здесь пусто!*\n\n"
-                "В текущем стоке только растения с редкостями которые ты игнорируешь.\n\n"
+                "В текущем стоке только растения, которые отфильтрованы твоими настройками.\n\n"
                 "Хочешь изменить настройки? Нажми кнопку ⚙️ НАСТРОЙКИ",
                 reply_markup=keyboard,
                 parse_mode='Markdown'
             )
+        # Повторные нажатия в пределах окна получат этот же ответ - их не отправляем
+        stock_replies.remember(user_id, telegram_message)
     else:
-        await processing_msg.delete()
         await update.message.reply_text("❌ Не удалось получить сток", reply_markup=keyboard)
 
+def is_repeated_stock_request(user_id):
+    """Пользователь уже получил этот же сток в пределах STOCK_REPLY_WINDOW.
+    
+    Вызывается до проверки подписки, поэтому только по памяти: чтение настроек
+    из БД создало бы пользователя
+    """
+    stock_data, time_info = stock_cache.peek()
+    if not stock_data or not stock_replies.has_recent(user_id):
+        return False
+    visible_mask = indexed_visible_mask(user_id)
+    if visible_mask is None:
+        return False
+    return stock_replies.is_recent(user_id, render_stock_view(stock_data, time_info, visible_mask))
+
+async def throttle_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Личный лимит апдейтов: сверх него апдейт отбрасывается до обработчиков"""
+    user = update.effective_user
+    if user is None or is_admin(user.id) or update_buckets.allow(user.id):
+        return
+    
+    # О лимите сообщаем один раз за серию отказов, дальше молча
+    if update_buckets.first_rejection(user.id):
+        if update.callback_query:
+            await update.callback_query.answer("⏳ Слишком часто! Подожди пару секунд")
+        elif update.message:
+            await update.message.reply_text("⏳ Слишком много запросов. Подожди пару секунд 🙏", reply_markup=keyboard)
+    raise ApplicationHandlerStop
+
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обрабатывает текстовые сообщения"""
     user_id = update.effective_user.id
+    
+    # Повторное нажатие "узнать сток" с тем же ответом - без проверок и запросов
+    if update.message.text == "🎯УЗНАТЬ СТОК🎯" and is_repeated_stock_request(user_id):
+        interaction_stats["stock_coalesced"] += 1
+        return
+    
     is_subscribed = await check_subscription(user_id)
     
     if not is_subscribed:
@@ -412,11 +1114,14 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text(text, reply_markup=reply_markup)
         return
     
-    add_user(update.message.chat_id)
+    await asyncio.to_thread(add_user, update.message.chat_id)
     
     if update.message.text == "🎯УЗНАТЬ СТОК🎯":
+        label_invocation("handle_button_click")
         await handle_button_click(update, context)
     elif update.message.text == "⚙️ НАСТРОЙКИ":
+        label_invocation("show_settings_menu")
+        await load_temp_settings(user_id)
         await show_settings_menu(update, context)
     else:
         await update.message.reply_text("Используй кнопки для навигации 🎯", reply_markup=keyboard)
@@ -431,16 +1136,7 @@ async def admin_broadcast_command(update: Update, context: ContextTypes.DEFAULT_
     message_text = " ".join(context.args)
     broadcast_message = f"📢 **ОБЪЯВЛЕНИЕ:**\n\n{message_text}"
     
-    print(f"🔄 Начинаю рассылку сообщения для {len(user_chat_ids)} пользователей...")
-    
-    tasks = []
-    for chat_id in list(user_chat_ids):
-        tasks.append(send_broadcast_message(context, chat_id, broadcast_message))
-    
-    results = await asyncio.gather(*tasks, return_exceptions=True)
-    
-    sent_count = sum(1 for r in results if not isinstance(r, Exception))
-    error_count = len(results) - sent_count
+    sent_count, error_count = await send_text_to_all(broadcast_message)
     
     await update.message.reply_text(
         f"📊 Рассылка завершена:\n✅ Отправлено: {sent_count}\n❌ Ошибок: {error_count}"
@@ -448,7 +1144,7 @@ async def admin_broadcast_command(update: Update, context: ContextTypes.DEFAULT_
 
 async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Статистика бота"""
-    stats = db.get_user_stats()
+    stats = await asyncio.to_thread(db.get_user_stats)
     
     text = f"""
 📊 *СТАТИСТИКА БОТА*
@@ -459,128 +1155,431 @@ async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 💾 База данных: ✅ PostgreSQL 17
 🔄 Активных: {len(user_chat_ids)}
+
+🛡 Отклонено по лимиту: {update_buckets.stats['rejected']} (серий: {update_buckets.stats['throttled_users']})
+🧩 Склеено запросов стока: {interaction_stats['stock_coalesced']}
+✏️ Пропущено правок меню: {interaction_stats['toggles_debounced'] + interaction_stats['menu_edits_skipped']}
     """
     
     await update.message.reply_text(text, parse_mode='Markdown')
 
-async def send_broadcast_message(context, chat_id, message):
+def is_admin(user_id):
+    """Является ли пользователь администратором (ADMIN_IDS)"""
+    return user_id in ADMIN_IDS
+
+async def send_profile_report(bot, chat_id, result, title):
+    """Отправляет топ функций и свернутые стеки для flamegraph"""
+    await bot.send_message(chat_id=chat_id, text=f"{title}\n\n{result.format_top()}")
+    await bot.send_document(
+        chat_id=chat_id,
+        document=io.BytesIO(result.folded().encode("utf-8")),
+        filename="profile.folded",
+        caption="Свернутые стеки: flamegraph.pl или speedscope.app"
+    )
+
+async def run_profile(bot, chat_id, seconds):
+    """Профилирует процесс заданное время и отправляет отчет"""
+    profiler = SamplingProfiler()
+    if not profiler.start():
+        await bot.send_message(chat_id=chat_id, text="⏳ Профилирование уже идет")
+        return
     try:
-        await context.bot.send_message(
+        await asyncio.sleep(seconds)
+    finally:
+        result = profiler.stop()
+    await send_profile_report(bot, chat_id, result, f"🔥 Профиль за {seconds} с")
+
+async def profile_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Профилирование: /profile <секунды> или /profile next (следующая рассылка стока)"""
+    global profile_next_broadcast_chat_id
+    
+    user_id = update.effective_user.id
+    if not is_admin(user_id):
+        return
+    
+    arg = context.args[0] if context.args else "10"
+    if arg == "next":
+        profile_next_broadcast_chat_id = update.effective_chat.id
+        await update.message.reply_text("✅ Профиль снимется во время следующей рассылки стока")
+        return
+    
+    try:
+        seconds = profile_seconds(arg)
+    except ValueError:
+        await update.message.reply_text("❌ Использование: /profile <секунды> | /profile next")
+        return
+    
+    await update.message.reply_text(f"🔥 Профилирую {seconds:g} с...")
+    # Не держим обработчик, пока идет профилирование
+    context.application.create_task(run_profile(context.bot, update.effective_chat.id, seconds))
+
+async def latency_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Перцентили задержки рестоков: /latency [число рестоков]"""
+    if not is_admin(update.effective_user.id):
+        return
+    
+    try:
+        limit = int(context.args[0]) if context.args else LATENCY_WINDOW
+    except ValueError:
+        await update.message.reply_text("❌ Использование: /latency [число рестоков]")
+        return
+    
+    traces = await asyncio.to_thread(db.get_restock_traces, limit)
+    await update.message.reply_text(format_latency_report(summarize_traces(traces)))
+
+async def api_stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Счетчики вызовов Bot API по обработчикам и состояние полос"""
+    if not is_admin(update.effective_user.id):
+        return
+    
+    await update.message.reply_text(f"{api_stats.format_report()}\n\n{lane_scheduler.format_report()}")
+
+async def send_text_to_all(message, parse_mode='Markdown', lane=LANE_BROADCAST, chat_ids=None):
+    """Отправляет одинаковый текст всем пользователям (или chat_ids), возвращает (отправлено, ошибок).
+    
+    По умолчанию идет по полосе рассылок, которую вытесняют рестоки и ответы пользователям
+    """
+    if chat_ids is None:
+        chunks = user_chat_ids.chunks(BROADCAST_CHUNK_SIZE)
+        total = len(user_chat_ids)
+    else:
+        chunks = (chat_ids[start:start + BROADCAST_CHUNK_SIZE] for start in range(0, len(chat_ids), BROADCAST_CHUNK_SIZE))
+        total = len(chat_ids)
+    logger.info(f"🔄 Начинаю рассылку сообщения для {total} пользователей...")
+    
+    # Идем по получателям пачками, не создавая корутины сразу на всех пользователей
+    sent_count = 0
+    error_count = 0
+    for chunk in chunks:
+        with bot_lane(lane):
+            results = await asyncio.gather(
+                *(send_broadcast_message(telegram_bot, chat_id, message, parse_mode) for chat_id in chunk),
+                return_exceptions=True
+            )
+        chunk_sent = sum(1 for r in results if r is True)
+        sent_count += chunk_sent
+        error_count += len(results) - chunk_sent
+    
+    logger.info(
+        f"📊 Рассылка завершена: отправлено {sent_count}, ошибок {error_count}",
+        extra={"event": "text_broadcast", "sent": sent_count, "errors": error_count}
+    )
+    return sent_count, error_count
+
+async def send_broadcast_message(bot, chat_id, message, parse_mode='Markdown'):
+    try:
+        await bot.send_message(
             chat_id=chat_id,
             text=message,
-            parse_mode='Markdown'
+            parse_mode=parse_mode
         )
         return True
     except:
         return False
 
 # === DISCORD МОНИТОРИНГ ===
-def get_latest_stock():
-    """Получает последний известный сток (ищет в истории сообщений если нужно)"""
-    global current_stock, last_restock_time, last_stock_message_id
-    
-    # Если у нас уже есть актуальный сток в памяти, возвращаем его
-    if current_stock and last_restock_time:
-        print("📊 Используем сток из памяти")
-        return current_stock, last_restock_time
-    
-    # Пробуем получить из БД
-    stock_data, time_info = db.get_latest_stock()
+async def load_latest_stock():
+    """Загрузка стока для кеша: из БД, иначе из истории сообщений Discord"""
+    stock_data, time_info = await asyncio.to_thread(db.get_latest_stock)
     if stock_data:
-        print("📊 Используем сток из БД")
-        current_stock = stock_data
-        last_restock_time = time_info
+        logger.debug("📊 Используем сток из БД")
+        stock_feed.publish(stock_data, time_info)
         return stock_data, time_info
     
     # Иначе ищем сток в Discord
-    print("🔍 Ищем сток в Discord...")
-    messages = get_discord_messages(limit=10)
+    logger.info("🔍 Ищем сток в Discord...")
+    messages = await get_discord_messages(limit=10)
     
     for message in messages:
-        embeds = message.get('embeds', [])
-        for embed in embeds:
-            if embed.get('title') == 'SEEDS SHOP RESTOCK!':
-                message_timestamp = message.get('timestamp')
-                stock_data, time_info = extract_stock_info_from_embed(embed, message_timestamp)
-                
-                if stock_data:
-                    print(f"✅ Найден сток в истории: {list(stock_data.keys())}")
-                    current_stock = stock_data
-                    last_restock_time = time_info
-                    last_stock_message_id = message['id']
-                    # Сохраняем в БД
-                    db.save_current_stock(stock_data, time_info, message['id'])
-                    return stock_data, time_info
-    
-    print("❌ Сток не найден в истории")
+        for event in parse_message(message, DISCORD_CHANNEL_ID):
+            if event.kind == "seeds":
+                logger.info(f"✅ Найден сток в истории: {list(event.items.keys())}")
+                # Сохраняем в БД
+                await asyncio.to_thread(db.save_current_stock, event.items, event.time_info, event.message_id)
+                stock_feed.publish(event.items, event.time_info, event.message_id)
+                return event.items, event.time_info
+    
+    logger.warning("❌ Сток не найден в истории")
     return None, None
 
-def monitor_discord():
-    global current_stock, last_restock_time, last_message_id, last_stock_message_id
+# Последний сток для обработчиков: загрузка одна на всех ожидающих,
+# после STOCK_CACHE_MAX_AGE перепроверяется в фоне
+stock_cache = StockCache(load_latest_stock)
+
+async def claim_fanout(event):
+    """Рассылает ли это сообщение Discord этот экземпляр (все экземпляры видят одни и те же сообщения)"""
+    if await asyncio.to_thread(db.claim_fanout, event.message_id):
+        return True
+    logger.info(f"📡 Сообщение {event.message_id} рассылает другой экземпляр")
+    return False
+
+async def broadcast_alert(kind, message, parse_mode='Markdown', lane=LANE_BROADCAST):
+    """Рассылка события подписчикам из индекса; дайджест-пользователи получат его в сводке"""
+    chat_ids = list(audience_index.audience([kind]))
+    if not chat_ids:
+        logger.info(f"🔇 Нет подписчиков на {kind}")
+        return 0, 0
+    return await send_text_to_all(message, parse_mode, lane, chat_ids)
+
+def dispatch_to_telegram(coro):
+    """Запускает корутину в цикле Telegram из потока мониторинга"""
+    future = asyncio.run_coroutine_threadsafe(coro, telegram_loop)
+    
+    def log_error(done):
+        if done.exception():
+            logger.error(f"❌ Ошибка рассылки: {done.exception()}")
+    
+    future.add_done_callback(log_error)
+    return future
+
+async def handle_stock_event(event):
+    """Обрабатывает событие из Discord (вызывается в цикле мониторинга)"""
+    global current_stock, last_restock_time, last_message_id, last_stock_message_id, last_gear_items, last_announcement
+    
+    last_message_id = event.message_id
     
-    print("🕵️ Запускаем мониторинг Discord канала...")
+    if event.kind == "seeds":
+        stock_data, time_info = event.items, event.time_info
+        changed_plants = diff_stock(current_stock, stock_data)
+        
+        if not changed_plants:
+            logger.info(f"♻️ Значимых изменений стока нет (политика {RESTOCK_NOTIFY_POLICY}) - рассылку пропускаем")
+            last_stock_message_id = event.message_id
+            stock_cache.set(stock_data, time_info)
+            stock_feed.publish(stock_data, time_info, event.message_id)
+            if stock_data != current_stock or time_info != last_restock_time:
+                stock_render_cache.clear()
+                current_stock = stock_data
+                last_restock_time = time_info
+                await asyncio.to_thread(db.save_current_stock, stock_data, time_info, event.message_id)
+            return
+        
+        logger.info(f"📊 ОБНАРУЖЕН НОВЫЙ СТОК! Растения: {list(stock_data.keys())}, изменились: {sorted(changed_plants)}")
+        
+        current_stock = stock_data
+        last_restock_time = time_info
+        last_stock_message_id = event.message_id
+        stock_cache.set(stock_data, time_info)
+        stock_feed.publish(stock_data, time_info, event.message_id)
+        stock_render_cache.clear()
+        
+        # СОХРАНЯЕМ В БД
+        await asyncio.to_thread(db.save_current_stock, stock_data, time_info, event.message_id)
+        if event.trace:
+            event.trace.mark("persisted")
+        if not await claim_fanout(event):
+            return
+        coro = send_telegram_alert_to_all(stock_data, changed_plants, event.trace)
+    
+    elif event.kind == "gear":
+        # Как и у семян: уведомляем, только если появилось или изменилось что-то из стока
+        changed_items = diff_stock(last_gear_items, event.items)
+        last_gear_items = event.items
+        if not changed_items & event.items.keys():
+            logger.info("♻️ Сток снаряжения не изменился - рассылку пропускаем")
+            return
+        logger.info(f"🛠 ОБНАРУЖЕН СТОК СНАРЯЖЕНИЯ: {list(event.items.keys())}")
+        items = ", ".join(f"{item} ×{stock}" for item, stock in event.items.items())
+        recent_alerts.append((time.time(), "gear", escape_markdown(f"🛠 {event.time_info}: {items}")))
+        if not await claim_fanout(event):
+            return
+        coro = broadcast_alert("gear", create_gear_message(event), parse_mode='Markdown', lane=LANE_RESTOCK)
     
-    initial_message = get_latest_discord_message()
-    if initial_message:
-        last_message_id = initial_message['id']
-        print(f"📝 Начальное сообщение: {last_message_id}")
+    else:
+        if (event.title, event.text) == last_announcement:
+            logger.info(f"♻️ Повтор объявления {event.title} - рассылку пропускаем")
+            return
+        last_announcement = (event.title, event.text)
+        logger.info(f"📣 ОБЪЯВЛЕНИЕ ИЗ DISCORD: {event.title}")
+        recent_alerts.append((time.time(), "announcement", escape_markdown(f"📣 {event.title}")))
+        if not await claim_fanout(event):
+            return
+        coro = broadcast_alert("announcement", f"📣 {event.title}\n\n{event.text}", parse_mode=None)
+    
+    # Рассылка идет в цикле Telegram, когда бот запущен и пользователи загружены
+    await asyncio.to_thread(telegram_ready.wait)
+    await asyncio.to_thread(users_loaded.wait)
+    dispatch_to_telegram(coro)
+
+def monitor_discord():
+    """Мониторинг каналов Discord: один поток, один asyncio-планировщик на все каналы"""
+    global current_stock, last_restock_time, discord_poller
+    
+    logger.info(f"🕵️ Запускаем мониторинг Discord каналов: {list(DISCORD_CHANNELS)}")
+    
+    # Базовый снимок для сравнения после перезапуска
+    if not current_stock:
+        stock_data, time_info = db.get_latest_stock()
+        if stock_data:
+            current_stock = stock_data
+            last_restock_time = time_info
+            stock_cache.set(stock_data, time_info)
+            stock_feed.publish(stock_data, time_info)
+    
+    # История рестоков из БД для оценки периода (сток пишется только из канала семян)
+    history = [
+        snowflake_time(message_id) if message_id and message_id.isdigit() else created_at.timestamp()
+        for message_id, created_at in db.get_restock_history()
+    ]
+    
+    discord_poller = DiscordPoller(
+        DISCORD_CHANNELS, DISCORD_USER_TOKEN, handle_stock_event,
+        history={DISCORD_CHANNEL_ID: history}, cursors=warm_start_cursors
+    )
+    asyncio.run(discord_poller.run())
+
+# === СНИМОК СОСТОЯНИЯ ===
+# Курсоры Discord из снимка старше этого (секунд) не используем: не рассылаем давние рестоки
+SNAPSHOT_CURSOR_MAX_AGE = 600
+# Запас при досинхронизации: изменения за столько секунд до снимка перечитываются
+SNAPSHOT_RECONCILE_MARGIN = 60
+
+def apply_snapshot(snapshot):
+    """Поднимает пользователей, сток и курсоры из снимка: бот отвечает, не дожидаясь БД"""
+    global current_stock, last_restock_time, last_stock_message_id, warm_start_cursors
+    
+    index_user_rows(snapshot.rows())
+    user_chat_ids.load_sorted_batches([snapshot.user_ids])
+    
+    stock = snapshot.meta.get("stock")
+    if stock:
+        current_stock = stock["data"]
+        last_restock_time = stock["time_info"]
+        last_stock_message_id = stock["message_id"]
+        stock_cache.set(current_stock, last_restock_time)
+        stock_feed.publish(current_stock, last_restock_time, last_stock_message_id)
+        for visible_mask, message in snapshot.meta.get("render", []):
+            stock_render_cache[(last_restock_time, visible_mask)] = message
+    
+    age = time.time() - snapshot.created_at
+    if age < SNAPSHOT_CURSOR_MAX_AGE:
+        warm_start_cursors = snapshot.meta.get("cursors", {})
+    
+    users_complete.set()
+    users_loaded.set()
+    logger.info(f"💾 Старт из снимка {age:.0f} с давности: {len(snapshot)} пользователей")
+
+def save_snapshot():
+    """Пишет снимок состояния для быстрого перезапуска"""
+    if not users_complete.is_set():
+        logger.debug("💾 Пользователи загружены не полностью - снимок не пишем")
+        return
     
+    started = time.perf_counter()
+    try:
+        users = {user_id: (visible_mask, 0, None) for user_id, visible_mask in audience_index.items()}
+        for user_id, visible_mask, digest_interval, last_digest_at in digest_schedule.items():
+            users[user_id] = (visible_mask, digest_interval, last_digest_at)
+        
+        stock_data, time_info = current_stock, last_restock_time
+        meta = {
+            "stock": {"data": stock_data, "time_info": time_info, "message_id": last_stock_message_id} if stock_data else None,
+            "render": [
+                [visible_mask, message] for (render_time, visible_mask), message in stock_render_cache.copy().items()
+                if render_time == time_info
+            ],
+            "cursors": discord_poller.cursors() if discord_poller else {},
+        }
+        size = write_snapshot(SNAPSHOT_PATH, ((user_id, *users[user_id]) for user_id in sorted(users)), meta)
+        logger.info(
+            f"💾 Снимок записан: {len(users)} пользователей, {size // 1024} КБ за {time.perf_counter() - started:.2f} с",
+            extra={"event": "snapshot_saved", "users": len(users), "bytes": size}
+        )
+    except Exception as e:
+        logger.error(f"❌ Ошибка записи снимка: {e}")
+
+async def run_snapshots():
+    """Периодическая запись снимка (в отдельном потоке, чтобы не держать цикл событий)"""
     while True:
-        try:
-            message = get_latest_discord_message()
-            
-            if message:
-                current_message_id = message['id']
-                
-                if current_message_id != last_message_id:
-                    print(f"🆕 ОБНАРУЖЕНО НОВОЕ СООБЩЕНИЕ: {current_message_id}")
-                    last_message_id = current_message_id
-                    
-                    embeds = message.get('embeds', [])
-                    stock_found = False
-                    
-                    for embed in embeds:
-                        if embed.get('title') == 'SEEDS SHOP RESTOCK!':
-                            print("🎯 НАЙДЕН СТОК В EMBED!")
-                            stock_found = True
-                            
-                            message_timestamp = message.get('timestamp')
-                            stock_data, time_info = extract_stock_info_from_embed(embed, message_timestamp)
-                            
-                            if stock_data:
-                                print(f"📊 ОБНАРУЖЕН НОВЫЙ СТОК! Растения: {list(stock_data.keys())}")
-                                
-                                current_stock = stock_data
-                                last_restock_time = time_info
-                                last_stock_message_id = current_message_id
-                                
-                                # СОХРАНЯЕМ В БД
-                                db.save_current_stock(stock_data, time_info, current_message_id)
-                                
-                                # Запускаем рассылку
-                                threading.Thread(
-                                    target=lambda: asyncio.run(send_telegram_alert_to_all(stock_data)),
-                                    daemon=True
-                                ).start()
-                            break
-                    
-                    if not stock_found:
-                        print("📭 Последнее сообщение не о стоке - игнорируем")
-            
-            time.sleep(10)
-            
-        except Exception as e:
-            print(f"❌ Ошибка мониторинга: {e}")
-            time.sleep(30)
+        await asyncio.sleep(SNAPSHOT_INTERVAL)
+        await asyncio.to_thread(save_snapshot)
+
+# === СИНХРОНИЗАЦИЯ ЭКЗЕМПЛЯРОВ ===
+def apply_remote_stock(stock_data, time_info, message_id=None):
+    """Сток, сохраненный другим экземпляром: обновляем кеши без рассылки"""
+    global current_stock, last_restock_time, last_stock_message_id
+    
+    if stock_data == current_stock and time_info == last_restock_time:
+        return
+    # Монитор Discord этого экземпляра тоже видит это сообщение; разошлет его
+    # только экземпляр, первым записавший его в fanout_claims (claim_fanout)
+    current_stock = stock_data
+    last_restock_time = time_info
+    last_stock_message_id = message_id
+    stock_cache.set(stock_data, time_info)
+    stock_feed.publish(stock_data, time_info, message_id)
+    stock_render_cache.clear()
+
+def apply_change(change):
+    """Применяет изменение другого экземпляра к локальным кешам (поток слушателя)"""
+    kind = change.get("type")
+    try:
+        if kind == "user":
+            user_id = change["user_id"]
+            user_chat_ids.add(user_id)
+            if user_id not in audience_index and user_id not in digest_schedule:
+                index_user(user_id, visible_plants_mask(0))
+        
+        elif kind == "settings":
+            user_id = change["user_id"]
+            user_chat_ids.add(user_id)
+            visible_mask = visible_plants_mask(
+                change["ignored_mask"], change["watched_plants"], change["ignored_plants"], change.get("alert_kinds", 0)
+            )
+            index_user_rows([(user_id, visible_mask, change["digest_interval"], change["last_digest_at"])])
+        
+        elif kind == "stock":
+            if "stock_data" in change:
+                apply_remote_stock(change["stock_data"], change["restock_time"], change.get("message_id"))
+            else:
+                # Большой сток приходит ссылкой
+                stock_data, time_info = db.get_latest_stock()
+                if stock_data:
+                    apply_remote_stock(stock_data, time_info, change.get("message_id"))
+        
+        else:
+            logger.warning(f"⚠️ Неизвестное изменение от {change.get('node')}: {kind}")
+            return
+        sync_stats[kind] += 1
+        logger.debug("📡 Изменение %s от %s применено", kind, change.get("node"))
+    except Exception as e:
+        sync_stats["errors"] += 1
+        logger.error(f"❌ Ошибка применения изменения {kind}: {e}")
+
+def resync_from_db():
+    """Полная пересинхронизация: уведомления за время обрыва слушателя потеряны"""
+    logger.info("🔄 Слушатель переподключился - перечитываем пользователей и сток из БД")
+    sync_stats["resyncs"] += 1
+    load_users()
+    stock_data, time_info = db.get_latest_stock()
+    if stock_data:
+        apply_remote_stock(stock_data, time_info)
 
 # === ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ ===
+def prune_subscription_cache():
+    """Раз в SUBSCRIPTION_CACHE_TTL удаляет истекшие проверки подписки: кеш не растет с каждым пользователем"""
+    global subscription_cache, subscription_cache_pruned_at
+    
+    now = time.monotonic()
+    if now - subscription_cache_pruned_at < SUBSCRIPTION_CACHE_TTL:
+        return
+    subscription_cache_pruned_at = now
+    subscription_cache = {user_id: expires_at for user_id, expires_at in subscription_cache.items() if expires_at > now}
+
 async def check_subscription(user_id):
     """Проверяет, подписан ли пользователь на канал"""
+    # Недавно подтвержденная подписка не требует вызова Bot API
+    expires_at = subscription_cache.get(user_id)
+    if expires_at and expires_at > time.monotonic():
+        return True
+    prune_subscription_cache()
+    
     max_retries = 2
     for attempt in range(max_retries):
         try:
             member = await telegram_bot.get_chat_member(CHANNEL_ID, user_id)
             if member.status in ['member', 'administrator', 'creator']:
+                subscription_cache[user_id] = time.monotonic() + SUBSCRIPTION_CACHE_TTL
                 return True
             else:
                 return False
@@ -590,10 +1589,16 @@ async def check_subscription(user_id):
                 if attempt < max_retries - 1:
                     await asyncio.sleep(0.5)
                     continue
-                print(f"⚠️ Ошибка асинхронности для пользователя {user_id} после {max_retries} попыток")
+                logger.warning(
+                    "⚠️ Ошибка асинхронности для пользователя %s после %s попыток", user_id, max_retries,
+                    extra={"sample_key": "subscription_loop_error"}
+                )
                 return True
             else:
-                print(f"❌ Ошибка проверки подписки для пользователя {user_id}: {e}")
+                logger.warning(
+                    "❌ Ошибка проверки подписки для пользователя %s: %s", user_id, e,
+                    extra={"sample_key": "subscription_check_error"}
+                )
                 return True
     return True
 
@@ -629,7 +1634,7 @@ async def handle_subscription_check(update: Update, context: ContextTypes.DEFAUL
         except:
             pass
         
-        add_user(user_id)
+        await asyncio.to_thread(add_user, user_id)
         await show_current_stock(user_id, context)
     else:
         text, reply_markup = create_subscription_message()
@@ -640,7 +1645,7 @@ async def handle_subscription_check(update: Update, context: ContextTypes.DEFAUL
 
 async def show_current_stock(user_id, context):
     """Показывает текущий сток пользователю"""
-    stock_data, time_info = get_latest_stock()
+    stock_data, time_info = await stock_cache.get()
     
     if stock_data:
         telegram_message = create_telegram_message(stock_data, time_info, is_alert=False)
@@ -669,7 +1674,7 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
     
-    add_user(update.message.chat_id)
+    await asyncio.to_thread(add_user, update.message.chat_id)
     
     welcome_text = """
 🤖 Бот для отслеживания стока Plants Vs Brainrots
@@ -681,105 +1686,52 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
     await update.message.reply_text(welcome_text, reply_markup=keyboard)
 
-async def send_single_message(chat_id, message):
+async def send_single_message(chat_id, message, trace=None, tier=None):
     try:
         await telegram_bot.send_message(
             chat_id=chat_id,
             text=message,
             parse_mode='Markdown'
         )
+        if trace:
+            trace.delivered(tier)
         return True
     except Exception as e:
-        print(f"❌ Ошибка отправки пользователю {chat_id}: {e}")
+        # Итог по ошибкам пишет сама рассылка, здесь только выборочно
+        logger.debug(
+            "❌ Ошибка отправки пользователю %s: %s", chat_id, e,
+            extra={"sample_key": "send_error"}
+        )
         return False
 
 # === DISCORD API ФУНКЦИИ ===
-def get_latest_discord_message():
-    headers = {
-        'Authorization': DISCORD_USER_TOKEN,
-        'Content-Type': 'application/json',
-    }
-    
-    url = f'https://discord.com/api/v9/channels/{DISCORD_CHANNEL_ID}/messages?limit=1'
-    
-    try:
-        response = requests.get(url, headers=headers, timeout=5)
-        if response.status_code == 200:
-            messages = response.json()
-            if messages:
-                return messages[0]
-        return None
-    except Exception as e:
-        print(f"❌ Ошибка подключения к Discord: {e}")
-        return None
-
-def get_discord_messages(limit=10):
+async def get_discord_messages(limit=10):
     """Получает несколько последних сообщений из Discord"""
     headers = {
         'Authorization': DISCORD_USER_TOKEN,
         'Content-Type': 'application/json',
     }
     
-    url = f'https://discord.com/api/v9/channels/{DISCORD_CHANNEL_ID}/messages?limit={limit}'
+    url = f'{DISCORD_API_BASE}/channels/{DISCORD_CHANNEL_ID}/messages?limit={limit}'
     
     try:
-        response = requests.get(url, headers=headers, timeout=5)
+        async with httpx.AsyncClient(timeout=5) as client:
+            response = await client.get(url, headers=headers)
         if response.status_code == 200:
             return response.json()
         return []
     except Exception as e:
-        print(f"❌ Ошибка подключения к Discord: {e}")
+        logger.warning(f"❌ Ошибка подключения к Discord: {e}")
         return []
 
-def convert_to_msk(discord_time_str):
-    try:
-        if "@" in discord_time_str:
-            date_part, time_part = discord_time_str.split('@')
-            day, month, year = date_part.strip().split('/')
-            hour, minute = time_part.strip().replace('GMT', '').strip().split(':')
-            
-            dt_utc = datetime(int(year), int(month), int(day), int(hour), int(minute))
-            dt_msk = dt_utc + timedelta(hours=3)
-            return dt_msk.strftime("%d/%m/%Y %H:%M")
-        else:
-            return discord_time_str
-    except:
-        return discord_time_str
-
-def extract_stock_info_from_embed(embed, message_timestamp):
-    stock_data = {}
-    current_time = ""
-    
-    author = embed.get('author', {})
-    if author and 'name' in author:
-        author_name = author['name']
-        if "⏳" in author_name:
-            discord_time = author_name.replace('⏳', '').strip()
-            current_time = convert_to_msk(discord_time)
-            print(f"⏰ Время из Discord: {discord_time} -> МСК: {current_time}")
-    
-    if not current_time:
-        current_time = datetime.now().strftime("%d/%m/%Y %H:%M")
-        print(f"⏰ Используем текущее время МСК: {current_time}")
-    
-    fields = embed.get('fields', [])
-    for field in fields:
-        plant_name = field.get('name', '')
-        plant_value = field.get('value', '')
-        
-        clean_plant_name = re.sub(r'[^\w\s]', '', plant_name).strip()
-        
-        stock_match = re.search(r'\+\d+', plant_value)
-        if stock_match:
-            stock_count = int(stock_match.group(0).replace('+', ''))
-            
-            for known_plant in PLANTS_RARITY.keys():
-                if known_plant.lower() in clean_plant_name.lower():
-                    stock_data[known_plant] = stock_count
-                    print(f"✅ {known_plant}: {stock_count} шт")
-                    break
-    
-    return stock_data, current_time
+def create_gear_message(event):
+    """Сообщение о стоке снаряжения"""
+    message_text = "🛠 **НОВЫЙ СТОК СНАРЯЖЕНИЯ!** 🛠\n\n"
+    message_text += f"⏰ *Обновлено: {event.time_info} МСК*\n\n"
+    for item, stock in event.items.items():
+        message_text += f"├─ {item} ×{stock}\n"
+    message_text += "\n📢 Канал: @PlantsVersusBrainrotsSTOCK"
+    return message_text
 
 def create_telegram_message(stock_data, time_info, is_alert=False):
     if not stock_data:
@@ -800,9 +1752,7 @@ def create_telegram_message(stock_data, time_info, is_alert=False):
             rarity_groups[rarity] = []
         rarity_groups[rarity].append((plant, stock))
     
-    rarity_order = ["RARE", "EPIC", "LEGENDARY", "MYTHIC", "GODLY", "SECRET"]
-    
-    for rarity in rarity_order:
+    for rarity in RARITY_ORDER:
         if rarity in rarity_groups and rarity_groups[rarity]:
             emoji = RARITY_EMOJI.get(rarity, "🌟")
             message_text += f"{emoji} **{rarity}**\n"
@@ -818,47 +1768,102 @@ def create_telegram_message(stock_data, time_info, is_alert=False):
     
     return message_text
 
+def create_digest_message(summary, restocks, alerts=()):
+    """Сводка за период: сколько раз растение было в стоке и максимум штук, плюс события подписок"""
+    message_text = "📰 **ДАЙДЖЕСТ СТОКА** 📰\n\n"
+    if summary:
+        message_text += f"🔄 *Рестоков: {len(restocks)}, с {restocks[0][1]} по {restocks[-1][1]} МСК*\n\n"
+        message_text += "🎯 **БЫЛИ В СТОКЕ:**\n\n"
+    
+    for rarity in RARITY_ORDER:
+        plants = [plant for plant in summary if PLANTS_RARITY.get(plant) == rarity]
+        if plants:
+            emoji = RARITY_EMOJI.get(rarity, "🌟")
+            message_text += f"{emoji} **{rarity}**\n"
+            for plant in plants:
+                times, max_count = summary[plant]
+                plant_emoji = PLANTS_EMOJI.get(plant, "🌱")
+                message_text += f"├─ {plant_emoji} {plant}: {times} раз, до ×{max_count}\n"
+            message_text += "\n"
+    
+    if alerts:
+        message_text += "🔔 **СОБЫТИЯ:**\n\n"
+        for line in alerts:
+            message_text += f"├─ {line}\n"
+        message_text += "\n"
+    
+    message_text += "⚙️ Режим доставки меняется в настройках\n"
+    message_text += "👉 Канал: @PlantsVersusBrainrotsSTOCK"
+    
+    return message_text
+
 # === ОБРАБОТКА ОШИБОК ===
 async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обрабатывает ошибки"""
     error_msg = str(context.error)
     if "event loop" in error_msg.lower() or "runtimeerror" in error_msg.lower():
         return
-    print(f"❌ Ошибка бота: {context.error}")
+    logger.error(f"❌ Ошибка бота: {context.error}")
 
 # === ЗАПУСК БОТА ===
+# Кнопки меню настроек (callback_data из show_settings_menu и show_plants_menu)
+SETTINGS_CALLBACK_PATTERN = "^(toggle_|plant_|alert_|plants_menu|settings_menu|digest_cycle|test_filter|confirm_changes)"
+
+def register_handlers(application):
+    """Регистрирует обработчики бота"""
+    # Группа -1 выполняется до остальных обработчиков и может остановить апдейт
+    application.add_handler(TypeHandler(Update, track_handler(throttle_update)), group=-1)
+    application.add_handler(CommandHandler("start", track_handler(start_command)))
+    application.add_handler(CommandHandler("all", track_handler(admin_broadcast_command)))
+    application.add_handler(CommandHandler("stats", track_handler(stats_command)))
+    application.add_handler(CommandHandler("apistats", track_handler(api_stats_command)))
+    application.add_handler(CommandHandler("profile", track_handler(profile_command)))
+    application.add_handler(CommandHandler("latency", track_handler(latency_command)))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, track_handler(handle_message)))
+    application.add_handler(CallbackQueryHandler(track_handler(handle_subscription_check), pattern="check_subscription"))
+    application.add_handler(CallbackQueryHandler(track_handler(handle_settings_callback), pattern=SETTINGS_CALLBACK_PATTERN))
+    application.add_error_handler(error_handler)
+
 def run_telegram_bot():
-    print("📱 Запускаем Telegram бота...")
-    telegram_app.add_handler(CommandHandler("start", start_command))
-    telegram_app.add_handler(CommandHandler("all", admin_broadcast_command))
-    telegram_app.add_handler(CommandHandler("stats", stats_command))
-    telegram_app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
-    telegram_app.add_handler(CallbackQueryHandler(handle_subscription_check, pattern="check_subscription"))
-    telegram_app.add_handler(CallbackQueryHandler(handle_settings_callback, pattern="^(toggle_|test_filter|confirm_changes)"))
-    telegram_app.add_error_handler(error_handler)
+    logger.info("📱 Запускаем Telegram бота...")
+    register_handlers(telegram_app)
     telegram_app.run_polling()
 
 def main():
-    print("🚀 ЗАПУСКАЕМ БОТА PLANTS VS BRAINROTS!")
-    print("=" * 50)
-    print("🤖 Бот для отслеживания стока растений")
-    print("⚙️ Система фильтрации по редкостям") 
-    print("🗄️ База данных: PostgreSQL 17")
-    print("📊 Мониторинг Discord канала")
-    print("🔔 Умные уведомления о новом стоке")
-    print("=" * 50)
-    
-    # Загружаем пользователей из БД
-    load_users()
+    setup_logging()
+    
+    logger.info("🚀 ЗАПУСКАЕМ БОТА PLANTS VS BRAINROTS!")
     
-    print("🌀 Запускаем мониторинг Discord...")
-    discord_thread = threading.Thread(target=monitor_discord, daemon=True)
-    discord_thread.start()
+    # Подсистемы стартуют параллельно, Telegram не ждет загрузки пользователей
+    with startup_report.phase("health_server"):
+        start_health_server()
     
-    print("✅ ВСЕ СИСТЕМЫ ЗАПУЩЕНЫ! БОТ РАБОТАЕТ!")
-    print("⏳ Ожидаем сообщения от пользователей...")
+    # Снимок прошлого запуска: пользователи и сток доступны сразу, БД догоняет в фоне
+    with startup_report.phase("snapshot"):
+        snapshot = read_snapshot(SNAPSHOT_PATH)
+        if snapshot:
+            apply_snapshot(snapshot)
+    
+    # Слушатель стартует раньше загрузки: изменения во время загрузки не теряются
+    threading.Thread(
+        target=db.listen_changes, args=(apply_change, resync_from_db), name="db-listener", daemon=True
+    ).start()
+    threading.Thread(target=load_users_in_background, args=(snapshot,), name="load-users", daemon=True).start()
+    
+    logger.info("🌀 Запускаем мониторинг Discord...")
+    with startup_report.phase("discord_monitor"):
+        discord_thread = threading.Thread(target=monitor_discord, name="discord-monitor", daemon=True)
+        discord_thread.start()
+    
+    with startup_report.phase("telegram_app"):
+        build_telegram_app()
+    
+    logger.info("✅ ВСЕ СИСТЕМЫ ЗАПУЩЕНЫ! БОТ РАБОТАЕТ!")
     
     run_telegram_bot()
+    
+    # run_polling возвращается после SIGTERM/SIGINT
+    save_snapshot()
 
 if __name__ == "__main__":
     main()
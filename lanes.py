@@ -0,0 +1,139 @@
+import asyncio
+import contextvars
+import os
+import time
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+
+# Полосы исходящих вызовов Bot API в порядке приоритета
+LANE_INTERACTIVE = "interactive"
+LANE_RESTOCK = "restock"
+LANE_BROADCAST = "broadcast"
+LANES = (LANE_INTERACTIVE, LANE_RESTOCK, LANE_BROADCAST)
+
+# Одновременных запросов к Bot API (равно размеру пула соединений)
+BOT_API_CONCURRENCY = int(os.getenv("BOT_API_CONCURRENCY", 256))
+# Сколько из них рассылки никогда не занимают - резерв для ответов пользователям
+INTERACTIVE_RESERVED = int(os.getenv("INTERACTIVE_RESERVED", 32))
+
+# По умолчанию вызов считается ответом пользователю; рассылки выставляют свою полосу
+_current_lane = contextvars.ContextVar("current_lane", default=LANE_INTERACTIVE)
+
+@contextmanager
+def bot_lane(lane):
+    """Вызовы Bot API внутри блока (и в созданных в нем задачах) идут по полосе lane"""
+    token = _current_lane.set(lane)
+    try:
+        yield
+    finally:
+        _current_lane.reset(token)
+
+def current_lane():
+    return _current_lane.get()
+
+class LaneScheduler:
+    """Раздает слоты на запросы к Bot API по приоритету полос.
+
+    Интерактивная полоса может занять любой слот, рассылки - все, кроме
+    INTERACTIVE_RESERVED. Освободившийся слот получает самая приоритетная
+    ожидающая полоса, поэтому рассылка /all приостанавливается, пока идет
+    рассылка рестока. Работает в одном цикле событий (цикл Telegram)
+    """
+
+    def __init__(self, capacity=BOT_API_CONCURRENCY, reserved=INTERACTIVE_RESERVED):
+        self.capacity = capacity
+        self.reserved = min(reserved, capacity - 1)
+        self._in_use = 0
+        self._waiters = {lane: deque() for lane in LANES}
+        self._stats = {
+            lane: {"requests": 0, "in_flight": 0, "waited": 0, "total_wait_ms": 0.0, "max_wait_ms": 0.0}
+            for lane in LANES
+        }
+
+    def _limit(self, lane):
+        return self.capacity if lane == LANE_INTERACTIVE else self.capacity - self.reserved
+
+    def _has_waiters_before(self, lane):
+        """Есть ли ожидающие в этой или более приоритетных полосах"""
+        for other in LANES:
+            if self._waiters[other]:
+                return True
+            if other == lane:
+                return False
+        return False
+
+    def _wake(self):
+        for lane in LANES:
+            waiters = self._waiters[lane]
+            while waiters and self._in_use < self._limit(lane):
+                future = waiters.popleft()
+                if future.done():
+                    continue
+                self._in_use += 1
+                future.set_result(None)
+
+    async def _acquire(self, lane):
+        if not self._has_waiters_before(lane) and self._in_use < self._limit(lane):
+            self._in_use += 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        self._waiters[lane].append(future)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # Слот уже выдан, но ожидающий отменен - отдаем следующему
+                self._in_use -= 1
+                self._wake()
+            raise
+
+    def _release(self):
+        self._in_use -= 1
+        self._wake()
+
+    @asynccontextmanager
+    async def slot(self, lane):
+        """Занимает слот полосы на время запроса"""
+        stats = self._stats[lane]
+        start = time.perf_counter()
+        await self._acquire(lane)
+        wait_ms = (time.perf_counter() - start) * 1000
+        stats["requests"] += 1
+        stats["in_flight"] += 1
+        if wait_ms >= 1:
+            stats["waited"] += 1
+        stats["total_wait_ms"] += wait_ms
+        stats["max_wait_ms"] = max(stats["max_wait_ms"], wait_ms)
+        try:
+            yield
+        finally:
+            stats["in_flight"] -= 1
+            self._release()
+
+    def snapshot(self):
+        """Глубина очереди, запросы в работе и ожидание по полосам"""
+        result = {"capacity": self.capacity, "reserved_interactive": self.reserved, "in_use": self._in_use, "lanes": {}}
+        for lane in LANES:
+            stats = self._stats[lane]
+            result["lanes"][lane] = {
+                "queued": sum(1 for future in self._waiters[lane] if not future.done()),
+                "in_flight": stats["in_flight"],
+                "requests": stats["requests"],
+                "waited": stats["waited"],
+                "avg_wait_ms": round(stats["total_wait_ms"] / stats["requests"], 1) if stats["requests"] else 0,
+                "max_wait_ms": round(stats["max_wait_ms"], 1),
+            }
+        return result
+
+    def format_report(self):
+        """Текстовый отчет о полосах для администратора"""
+        snapshot = self.snapshot()
+        lines = [f"🚦 ПОЛОСЫ BOT API: занято {snapshot['in_use']}/{snapshot['capacity']}, резерв {snapshot['reserved_interactive']}"]
+        for lane, stats in snapshot["lanes"].items():
+            lines.append(
+                f"├─ {lane}: в очереди {stats['queued']}, в работе {stats['in_flight']}, "
+                f"запросов {stats['requests']}, ожидание ср. {stats['avg_wait_ms']} мс / макс. {stats['max_wait_ms']} мс"
+            )
+        return "\n".join(lines)
+
+lane_scheduler = LaneScheduler()
@@ -0,0 +1,133 @@
+import math
+import threading
+import time
+from array import array
+
+from plants import RARITY_ORDER
+
+# Этапы рестока в порядке прохождения; смещения считаются от публикации в Discord
+TRACE_STAGES = ("detected", "parsed", "persisted", "fanout_start", "first", "p50", "p99", "last")
+
+def percentile(values, q):
+    """Перцентиль по ближайшему рангу; None для пустого набора"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(1, math.ceil(q / 100 * len(ordered)))
+    return ordered[rank - 1]
+
+class RestockTrace:
+    """Временные метки одного рестока от публикации в Discord до последней доставки"""
+
+    def __init__(self, message_id, posted_at):
+        self.message_id = message_id
+        self.posted_at = posted_at
+        self._stages = {}
+        self._lock = threading.Lock()
+        self._deliveries = array("d")
+        # Ярусы рассылки: ярус -> (получателей, моменты доставки)
+        self._tiers = {}
+
+    def mark(self, stage, moment=None):
+        """Отмечает прохождение этапа (по умолчанию - сейчас)"""
+        self._stages[stage] = time.time() if moment is None else moment
+
+    def set_tiers(self, recipients):
+        """Ярусы рассылки в порядке отправки: {ярус: число получателей}"""
+        with self._lock:
+            self._tiers = {tier: (count, array("d")) for tier, count in recipients.items()}
+
+    def delivered(self, tier=None):
+        """Отмечает доставку одному пользователю (из яруса tier)"""
+        now = time.time()
+        with self._lock:
+            self._deliveries.append(now)
+            if tier in self._tiers:
+                self._tiers[tier][1].append(now)
+
+    def _offset_ms(self, moment):
+        return None if moment is None else round((moment - self.posted_at) * 1000)
+
+    def summary(self, recipients):
+        """Смещения этапов в мс от публикации и число получателей"""
+        with self._lock:
+            deliveries = list(self._deliveries)
+            tiers = {tier: (count, list(moments)) for tier, (count, moments) in self._tiers.items()}
+        result = {stage: self._offset_ms(self._stages.get(stage)) for stage in TRACE_STAGES[:4]}
+        result.update({
+            "first": self._offset_ms(min(deliveries, default=None)),
+            "p50": self._offset_ms(percentile(deliveries, 50)),
+            "p99": self._offset_ms(percentile(deliveries, 99)),
+            "last": self._offset_ms(max(deliveries, default=None)),
+            "recipients": recipients,
+            "delivered": len(deliveries),
+            "tiers": {
+                tier: {
+                    "recipients": count,
+                    "delivered": len(moments),
+                    "first": self._offset_ms(min(moments, default=None)),
+                    "p50": self._offset_ms(percentile(moments, 50)),
+                    "last": self._offset_ms(max(moments, default=None)),
+                }
+                for tier, (count, moments) in tiers.items()
+            } or None,
+        })
+        return result
+
+def summarize_traces(traces):
+    """Перцентили каждого этапа по списку сводок рестоков"""
+    stages = {}
+    for stage in TRACE_STAGES:
+        values = [trace[stage] for trace in traces if trace.get(stage) is not None]
+        stages[stage] = {
+            "p50": percentile(values, 50),
+            "p90": percentile(values, 90),
+            "p99": percentile(values, 99),
+            "max": max(values, default=None),
+        }
+
+    # Время доставки яруса целиком (последняя доставка), от самой редкой редкости
+    tiers = {}
+    for trace in traces:
+        for tier, values in (trace.get("tiers") or {}).items():
+            if values.get("last") is not None:
+                tiers.setdefault(tier, []).append(values["last"])
+    return {
+        "restocks": len(traces),
+        "stages": stages,
+        "tiers": {
+            tier: {
+                "restocks": len(values),
+                "p50": percentile(values, 50),
+                "p90": percentile(values, 90),
+                "p99": percentile(values, 99),
+                "max": max(values),
+            }
+            for tier, values in sorted(
+                tiers.items(), key=lambda item: -RARITY_ORDER.index(item[0]) if item[0] in RARITY_ORDER else 1
+            )
+        },
+    }
+
+def format_latency_report(report):
+    """Текстовый отчет о задержках рестоков"""
+    if not report["restocks"]:
+        return "⏱️ Пока нет данных о рестоках"
+
+    def seconds(value):
+        return "—" if value is None else f"{value / 1000:.1f}"
+
+    lines = [f"⏱️ Задержка от публикации в Discord, с (рестоков: {report['restocks']})", "этап: p50 / p90 / p99 / max", ""]
+    for stage, values in report["stages"].items():
+        lines.append(
+            f"├─ {stage}: {seconds(values['p50'])} / {seconds(values['p90'])} / "
+            f"{seconds(values['p99'])} / {seconds(values['max'])}"
+        )
+    if report.get("tiers"):
+        lines += ["", "Доставка яруса целиком, с (p50 / p90 / p99 / max):"]
+        for tier, values in report["tiers"].items():
+            lines.append(
+                f"├─ {tier}: {seconds(values['p50'])} / {seconds(values['p90'])} / "
+                f"{seconds(values['p99'])} / {seconds(values['max'])} (рестоков: {values['restocks']})"
+            )
+    return "\n".join(lines)
@@ -0,0 +1,100 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+# json - одна JSON-строка на запись, text - обычный текст
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")
+# Не больше LOG_SAMPLE_LIMIT записей одного типа (sample_key) за LOG_SAMPLE_WINDOW секунд
+LOG_SAMPLE_LIMIT = int(os.getenv("LOG_SAMPLE_LIMIT", 5))
+LOG_SAMPLE_WINDOW = float(os.getenv("LOG_SAMPLE_WINDOW", 60))
+
+# Атрибуты LogRecord, которые не относятся к полям из extra=
+_RECORD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime"}
+
+_listener = None
+
+class JsonFormatter(logging.Formatter):
+    """Форматирует запись в одну JSON-строку вместе с полями из extra="""
+
+    def format(self, record):
+        payload = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "thread": record.threadName,
+            "msg": record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_ATTRS:
+                payload[key] = value
+        if record.exc_info:
+            payload["exc"] = self.formatException(record.exc_info)
+        return json.dumps(payload, ensure_ascii=False, default=str)
+
+class SamplingFilter(logging.Filter):
+    """Ограничивает частоту записей с одинаковым sample_key.
+
+    Лишние записи отбрасываются до постановки в очередь, а число пропущенных
+    добавляется полем suppressed к первой записи следующего окна
+    """
+
+    def __init__(self, limit=LOG_SAMPLE_LIMIT, window=LOG_SAMPLE_WINDOW):
+        super().__init__()
+        self.limit = limit
+        self.window = window
+        self._lock = threading.Lock()
+        self._windows = {}
+
+    def filter(self, record):
+        key = getattr(record, "sample_key", None)
+        if key is None:
+            return True
+
+        now = time.monotonic()
+        with self._lock:
+            window_start, count, suppressed = self._windows.get(key, (now, 0, 0))
+            if now - window_start >= self.window:
+                if suppressed:
+                    record.suppressed = suppressed
+                window_start, count, suppressed = now, 0, 0
+            if count < self.limit:
+                self._windows[key] = (window_start, count + 1, suppressed)
+                return True
+            self._windows[key] = (window_start, count, suppressed + 1)
+            return False
+
+def setup_logging():
+    """Настраивает логирование через очередь: вызывающий поток только кладет запись,
+    а форматирование и запись в stdout идут в отдельном потоке"""
+    global _listener
+    if _listener is not None:
+        return
+
+    stream_handler = logging.StreamHandler(sys.stdout)
+    if LOG_FORMAT == "json":
+        stream_handler.setFormatter(JsonFormatter())
+    else:
+        stream_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    queue_handler.addFilter(SamplingFilter())
+
+    root = logging.getLogger()
+    root.handlers[:] = [queue_handler]
+    root.setLevel(LOG_LEVEL)
+
+    # httpx пишет INFO на каждый HTTP-запрос, в рассылке это тысячи строк
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+
+    _listener = logging.handlers.QueueListener(log_queue, stream_handler)
+    _listener.start()
+    atexit.register(_listener.stop)
@@ -6,6 +6,22 @@ import sys
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
 from database import db
+from logging_setup import setup_logging
+from plants import rarities_to_mask
+
+def migrate_schema():
+    """Создание/обновление схемы БД (таблицы, индексы, конвертация колонок)"""
+    print("🔄 Обновляем схему PostgreSQL...")
+    
+    if not db.conn:
+        print("❌ Нет подключения к PostgreSQL!")
+        return False
+    
+    if not db.init_tables():
+        print("❌ Схема не обновлена")
+        return False
+    print("✅ Схема обновлена")
+    return True
 
 def migrate_from_json():
     """Миграция данных из JSON файлов в PostgreSQL"""
@@ -50,6 +66,9 @@ def migrate_from_json():
             for i, (user_id_str, settings) in enumerate(settings_data.items(), 1):
                 try:
                     user_id = int(user_id_str)
+                    # В JSON редкости хранились списком, в БД - битовой маской
+                    if "ignored_rarities" in settings:
+                        settings = {**settings, "ignored_mask": rarities_to_mask(settings["ignored_rarities"])}
                     if db.update_user_settings(user_id, settings):
                         success_count += 1
                     if i % 50 == 0:
@@ -75,4 +94,10 @@ def migrate_from_json():
     print("\n🎉 Миграция завершена!")
 
 if __name__ == "__main__":
-    migrate_from_json()
+    setup_logging()
+    # --schema: только схема (release-фаза деплоя), без аргументов - схема и данные из JSON.
+    # Ненулевой код выхода останавливает релиз: новый код не выйдет на старую схему
+    if not migrate_schema():
+        sys.exit(1)
+    if "--schema" not in sys.argv:
+        migrate_from_json()
@@ -0,0 +1,114 @@
+# Справочник растений и редкостей
+PLANTS_RARITY = {
+    "Cactus": "RARE", "Strawberry": "RARE", "Pumpkin": "EPIC", "Sunflower": "EPIC",
+    "Dragon Fruit": "LEGENDARY", "Eggplant": "LEGENDARY", "Watermelon": "MYTHIC",
+    "Grape": "MYTHIC", "Cocotank": "GODLY", "Carnivorous Plant": "GODLY",
+    "Mr Carrot": "SECRET", "Tomatrio": "SECRET", "Shroombino": "SECRET"
+}
+
+# Эмодзи для растений
+PLANTS_EMOJI = {
+    "Cactus": "🌵", "Strawberry": "🍓", "Pumpkin": "🎃", "Sunflower": "🌻",
+    "Dragon Fruit": "🐉", "Eggplant": "🍆", "Watermelon": "🍉", "Grape": "🍇",
+    "Cocotank": "🥥", "Carnivorous Plant": "🌿", "Mr Carrot": "🥕",
+    "Tomatrio": "🍅", "Shroombino": "🍄"
+}
+
+# Эмодзи для редкостей
+RARITY_EMOJI = {
+    "RARE": "🔵",
+    "EPIC": "🟣",
+    "LEGENDARY": "🟡",
+    "MYTHIC": "🔴",
+    "GODLY": "🌈",
+    "SECRET": "🔲"
+}
+
+# Порядок редкостей для меню.
+# ВАЖНО: позиция редкости задает ее бит в ignored_mask в БД,
+# новые редкости добавлять только в конец списка
+RARITY_ORDER = ["RARE", "EPIC", "LEGENDARY", "MYTHIC", "GODLY", "SECRET"]
+
+# === БИТОВЫЕ МАСКИ РЕДКОСТЕЙ ===
+RARITY_BIT = {rarity: 1 << i for i, rarity in enumerate(RARITY_ORDER)}
+ALL_RARITIES_MASK = (1 << len(RARITY_ORDER)) - 1
+
+# Предрасчитанная таблица растение -> бит его редкости
+PLANT_RARITY_BIT = {plant: RARITY_BIT[rarity] for plant, rarity in PLANTS_RARITY.items()}
+
+def rarities_to_mask(rarities):
+    """Преобразует список редкостей в битовую маску"""
+    mask = 0
+    for rarity in rarities or []:
+        mask |= RARITY_BIT.get(rarity, 0)
+    return mask
+
+def mask_to_rarities(mask):
+    """Преобразует битовую маску в список редкостей (в порядке RARITY_ORDER)"""
+    return [rarity for rarity in RARITY_ORDER if mask & RARITY_BIT[rarity]]
+
+def stock_rarity_mask(stock_data):
+    """Маска редкостей, присутствующих в стоке"""
+    mask = 0
+    for plant in stock_data:
+        mask |= PLANT_RARITY_BIT.get(plant, 0)
+    return mask
+
+# === БИТОВЫЕ МАСКИ РАСТЕНИЙ ===
+# ВАЖНО: порядок PLANTS_RARITY задает бит растения в watched_plants/ignored_plants в БД,
+# новые растения добавлять только в конец словаря
+PLANT_ORDER = list(PLANTS_RARITY)
+PLANT_BIT = {plant: 1 << i for i, plant in enumerate(PLANT_ORDER)}
+ALL_PLANTS_MASK = (1 << len(PLANT_ORDER)) - 1
+
+# Растения каждой редкости
+RARITY_PLANTS_MASK = {
+    rarity: sum(PLANT_BIT[plant] for plant, plant_rarity in PLANTS_RARITY.items() if plant_rarity == rarity)
+    for rarity in RARITY_ORDER
+}
+
+# Предрасчитанная таблица маска игнорируемых редкостей -> маска скрытых растений
+IGNORED_RARITIES_PLANTS_MASK = [
+    sum(RARITY_PLANTS_MASK[rarity] for rarity in mask_to_rarities(mask))
+    for mask in range(ALL_RARITIES_MASK + 1)
+]
+
+def plants_to_mask(plants):
+    """Преобразует список растений в битовую маску"""
+    mask = 0
+    for plant in plants or []:
+        mask |= PLANT_BIT.get(plant, 0)
+    return mask
+
+def mask_to_plants(mask):
+    """Преобразует битовую маску в список растений (в порядке PLANT_ORDER)"""
+    return [plant for plant in PLANT_ORDER if mask & PLANT_BIT[plant]]
+
+def stock_plant_mask(stock_data):
+    """Маска растений, присутствующих в стоке"""
+    mask = 0
+    for plant in stock_data:
+        mask |= PLANT_BIT.get(plant, 0)
+    return mask
+
+# === ПОДПИСКИ НА СОБЫТИЯ ===
+# События Discord помимо стока семян; приходят только подписавшимся (alert_kinds в БД, бит - позиция в списке)
+ALERT_KINDS = ["gear", "announcement"]
+ALERT_NAMES = {"gear": "🛠 Сток снаряжения", "announcement": "📣 Объявления"}
+ALL_ALERT_KINDS = (1 << len(ALERT_KINDS)) - 1
+# Подписки лежат в маске видимости выше растений, поэтому индексы рассылки, дайджесты
+# и снимок хранят их вместе с фильтром растений. Сдвиг с запасом под новые растения
+ALERT_SHIFT = 24
+ALERT_BIT = {kind: 1 << (ALERT_SHIFT + i) for i, kind in enumerate(ALERT_KINDS)}
+
+def visible_plants_mask(ignored_mask, watched_plants=0, ignored_plants=0, alert_kinds=0):
+    """Маска растений, о которых пользователь получает уведомления, и его подписок на события.
+    
+    Если список отслеживаемых растений не пуст - только они, иначе все растения
+    кроме игнорируемых редкостей и игнорируемых растений
+    """
+    alerts = (alert_kinds & ALL_ALERT_KINDS) << ALERT_SHIFT
+    if watched_plants:
+        return watched_plants & ALL_PLANTS_MASK | alerts
+    hidden = IGNORED_RARITIES_PLANTS_MASK[ignored_mask & ALL_RARITIES_MASK] | ignored_plants
+    return ALL_PLANTS_MASK & ~hidden | alerts
@@ -0,0 +1,125 @@
+import math
+import os
+import sys
+import threading
+import time
+
+# Период сэмплирования в секундах
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", 0.01))
+# Максимальная длительность одного профилирования
+PROFILE_MAX_SECONDS = int(os.getenv("PROFILE_MAX_SECONDS", 60))
+
+class ProfileResult:
+    """Результат профилирования: свернутые стеки и счетчики по функциям"""
+
+    def __init__(self, stacks, samples, duration):
+        self.stacks = stacks
+        self.samples = samples
+        self.duration = duration
+
+    def top(self, limit=15):
+        """Функции с наибольшим числом сэмплов: (функция, собственные, включая вложенные)"""
+        self_counts = {}
+        total_counts = {}
+        for stack, count in self.stacks.items():
+            frames = stack.split(";")[1:]
+            if not frames:
+                continue
+            self_counts[frames[-1]] = self_counts.get(frames[-1], 0) + count
+            for frame in set(frames):
+                total_counts[frame] = total_counts.get(frame, 0) + count
+        ranked = sorted(total_counts, key=lambda frame: (-self_counts.get(frame, 0), -total_counts[frame]))
+        return [(frame, self_counts.get(frame, 0), total_counts[frame]) for frame in ranked[:limit]]
+
+    def folded(self):
+        """Стеки в формате flamegraph.pl / speedscope: 'поток;корень;...;лист число'"""
+        return "\n".join(f"{stack} {count}" for stack, count in sorted(self.stacks.items()))
+
+    def format_top(self, limit=15):
+        """Текстовый отчет о самых горячих функциях"""
+        lines = [f"🔥 Профиль: {self.samples} сэмплов за {self.duration:.1f} с", ""]
+        for frame, self_count, total_count in self.top(limit):
+            self_pct = 100 * self_count / self.samples if self.samples else 0
+            total_pct = 100 * total_count / self.samples if self.samples else 0
+            lines.append(f"{self_pct:5.1f}% / {total_pct:5.1f}%  {frame}")
+        return "\n".join(lines)
+
+    def as_dict(self, limit=30):
+        return {
+            "samples": self.samples,
+            "duration": round(self.duration, 3),
+            "top": [
+                {"function": frame, "self": self_count, "total": total_count}
+                for frame, self_count, total_count in self.top(limit)
+            ],
+        }
+
+class SamplingProfiler:
+    """Сэмплирующий профайлер по всем потокам процесса (Telegram, мониторинг Discord, HTTP).
+
+    Раз в PROFILE_INTERVAL снимает стеки через sys._current_frames(), поэтому
+    не замедляет профилируемый код, в отличие от cProfile
+    """
+
+    _busy = threading.Lock()
+
+    def __init__(self, interval=PROFILE_INTERVAL):
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+        self._stacks = {}
+        self._samples = 0
+        self._started = 0
+
+    def start(self):
+        """Запускает сэмплирование; False, если уже идет другое профилирование"""
+        if not SamplingProfiler._busy.acquire(blocking=False):
+            return False
+        self._started = time.perf_counter()
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+        self._thread.start()
+        return True
+
+    def stop(self):
+        """Останавливает сэмплирование и возвращает результат"""
+        self._stop.set()
+        self._thread.join()
+        SamplingProfiler._busy.release()
+        return ProfileResult(self._stacks, self._samples, time.perf_counter() - self._started)
+
+    def _run(self):
+        own_ident = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own_ident:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                stack.append(thread_names.get(ident, str(ident)))
+                key = ";".join(part.replace(";", ",") for part in reversed(stack))
+                self._stacks[key] = self._stacks.get(key, 0) + 1
+            self._samples += 1
+
+def profile_seconds(value):
+    """Длительность профилирования из запроса: от 1 до PROFILE_MAX_SECONDS, ValueError для не-числа и NaN"""
+    seconds = float(value)
+    if math.isnan(seconds):
+        raise ValueError("seconds must not be NaN")
+    return min(max(seconds, 1), PROFILE_MAX_SECONDS)
+
+def profile_blocking(seconds):
+    """Профилирует процесс заданное время в текущем потоке; None, если профайлер занят"""
+    seconds = profile_seconds(seconds)
+    profiler = SamplingProfiler()
+    if not profiler.start():
+        return None
+    # Профайлер останавливается и освобождает блокировку при любом исходе
+    try:
+        time.sleep(seconds)
+    finally:
+        result = profiler.stop()
+    return result
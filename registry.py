@@ -0,0 +1,169 @@
+import heapq
+import threading
+from array import array
+from bisect import bisect_left
+
+# Сколько изменений копим поверх массива перед слиянием в новый массив
+MERGE_THRESHOLD = 4096
+
+class SubscriberRegistry:
+    """Компактный реестр chat id подписчиков на отсортированном массиве int64.
+
+    Добавления и удаления копятся в словаре изменений поверх массива и сливаются
+    в новый массив пачкой, в отдельном потоке и без блокировки: пока идет слияние,
+    реестр читается по старому массиву и изменениям. Основной массив никогда не
+    меняется на месте, поэтому итерация идет по memoryview без копирования
+    """
+
+    def __init__(self, ids=None):
+        self._lock = threading.Lock()
+        self._merge_lock = threading.Lock()
+        self._ids = array("q")
+        # Изменения поверх массива: chat_id -> есть ли в реестре
+        self._pending = {}
+        # На сколько изменения меняют число id относительно массива
+        self._delta = 0
+        if ids is not None:
+            self.load_sorted_batches([sorted(ids)])
+
+    def __len__(self):
+        with self._lock:
+            return len(self._ids) + self._delta
+
+    def __bool__(self):
+        return len(self) > 0
+
+    def __contains__(self, chat_id):
+        with self._lock:
+            return self._present(chat_id)
+
+    def __iter__(self):
+        for chunk in self.chunks():
+            yield from chunk
+
+    @staticmethod
+    def _contains_sorted(ids, chat_id):
+        i = bisect_left(ids, chat_id)
+        return i < len(ids) and ids[i] == chat_id
+
+    def _present(self, chat_id):
+        present = self._pending.get(chat_id)
+        return self._contains_sorted(self._ids, chat_id) if present is None else present
+
+    def _set(self, chat_id, present):
+        before = self._present(chat_id)
+        if before != present:
+            self._delta += 1 if present else -1
+            # Пишем и совпадающее с массивом: слияние в потоке могло уже взять старое значение
+            self._pending[chat_id] = present
+
+    def add(self, chat_id):
+        with self._lock:
+            self._set(chat_id, True)
+        self._maybe_merge()
+
+    def discard(self, chat_id):
+        with self._lock:
+            self._set(chat_id, False)
+        self._maybe_merge()
+
+    def add_many(self, chat_ids):
+        """Пакетное добавление (массив перестраивается, только когда накопится MERGE_THRESHOLD изменений)"""
+        with self._lock:
+            for chat_id in chat_ids:
+                self._set(chat_id, True)
+        self._maybe_merge()
+
+    def discard_many(self, chat_ids):
+        """Пакетное удаление (массив перестраивается, только когда накопится MERGE_THRESHOLD изменений)"""
+        with self._lock:
+            for chat_id in chat_ids:
+                self._set(chat_id, False)
+        self._maybe_merge()
+
+    def load_sorted_batches(self, batches):
+        """Потоковая загрузка пачек id, отсортированных по возрастанию (ORDER BY user_id).
+
+        Пачки дописываются в новый массив без промежуточного списка всех id.
+        Небольшая дельта (досинхронизация) ложится в изменения, полная загрузка
+        сливается с текущим массивом потоково, без множеств и вне блокировки.
+        Удаленные до окончания загрузки id остаются удаленными
+        """
+        ids = array("q")
+        last = None
+        in_order = True
+        for batch in batches:
+            for chat_id in batch:
+                if last is not None and chat_id <= last:
+                    in_order = False
+                last = chat_id
+            ids.extend(batch)
+        if not in_order:
+            ids = array("q", sorted(set(ids)))
+
+        if len(ids) < MERGE_THRESHOLD:
+            with self._lock:
+                for chat_id in ids:
+                    if self._pending.get(chat_id) is not False:
+                        self._set(chat_id, True)
+            self._maybe_merge()
+        else:
+            self._merge(ids)
+
+    def chunks(self, size=1000):
+        """Итерация пачками: memoryview-срезы массива без копирования, если изменений нет"""
+        with self._lock:
+            ids = self._ids
+            pending = dict(self._pending)
+        if not pending:
+            view = memoryview(ids)
+            for start in range(0, len(ids), size):
+                yield view[start:start + size]
+            return
+
+        chunk = array("q")
+        for chat_id in self._merged_ids(ids, pending):
+            chunk.append(chat_id)
+            if len(chunk) == size:
+                yield chunk
+                chunk = array("q")
+        if chunk:
+            yield chunk
+
+    def nbytes(self):
+        """Размер основного массива в байтах"""
+        return self._ids.buffer_info()[1] * self._ids.itemsize
+
+    def _maybe_merge(self):
+        if len(self._pending) >= MERGE_THRESHOLD and not self._merge_lock.locked():
+            threading.Thread(target=self._merge, name="registry-merge", daemon=True).start()
+
+    def _merge(self, loaded=()):
+        """Сливает массив, накопленные изменения и loaded в новый массив вне блокировки"""
+        with self._merge_lock:
+            with self._lock:
+                ids = self._ids
+                pending = dict(self._pending)
+            merged = array("q", self._merged_ids(ids, pending, loaded))
+
+            with self._lock:
+                self._ids = merged
+                # Изменения, пришедшие во время слияния, остаются поверх нового массива
+                for chat_id, present in pending.items():
+                    if self._pending.get(chat_id) is present:
+                        del self._pending[chat_id]
+                self._delta = sum(
+                    (1 if present else -1) for chat_id, present in self._pending.items()
+                    if present != self._contains_sorted(merged, chat_id)
+                )
+
+    @staticmethod
+    def _merged_ids(ids, pending, loaded=()):
+        """Отсортированные id без повторов: ids + loaded с примененными изменениями"""
+        added = sorted(chat_id for chat_id, present in pending.items() if present)
+        last = None
+        for chat_id in heapq.merge(ids, loaded, added):
+            if chat_id != last:
+                last = chat_id
+                if pending.get(chat_id, True):
+                    yield chat_id
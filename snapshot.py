@@ -0,0 +1,106 @@
+import json
+import logging
+import math
+import mmap
+import os
+import struct
+import time
+from array import array
+
+logger = logging.getLogger(__name__)
+
+# Файл снимка; на платформах с эфемерным диском стоит указать постоянный том
+SNAPSHOT_PATH = os.getenv("SNAPSHOT_PATH", "snapshot.bin")
+# Как часто переписывать снимок, секунд
+SNAPSHOT_INTERVAL = int(os.getenv("SNAPSHOT_INTERVAL", 300))
+
+SNAPSHOT_MAGIC = b"PVBS"
+SNAPSHOT_VERSION = 1
+# magic, версия, время снимка, число пользователей, длина JSON-метаданных
+_HEADER = struct.Struct("<4sHdII")
+_HEADER_SIZE = 32
+
+def _aligned(size):
+    return (size + 7) & ~7
+
+class Snapshot:
+    """Снимок состояния процесса.
+
+    Пользователи хранятся колонками: id (int64, по возрастанию), маска видимых
+    растений (int32), интервал дайджеста (int32), время последнего дайджеста
+    (float64, NaN - нет). Остальное (сток, кеш рендера, курсоры Discord) - в JSON
+    """
+
+    def __init__(self, created_at, meta, user_ids, visible_masks, digest_intervals, last_digests):
+        self.created_at = created_at
+        self.meta = meta
+        self.user_ids = user_ids
+        self.visible_masks = visible_masks
+        self.digest_intervals = digest_intervals
+        self.last_digests = last_digests
+
+    def __len__(self):
+        return len(self.user_ids)
+
+    def rows(self):
+        """(user_id, маска, интервал дайджеста, время последнего дайджеста или None)"""
+        for user_id, visible_mask, digest_interval, last_digest_at in zip(
+            self.user_ids, self.visible_masks, self.digest_intervals, self.last_digests
+        ):
+            yield user_id, visible_mask, digest_interval, None if math.isnan(last_digest_at) else last_digest_at
+
+def write_snapshot(path, rows, meta):
+    """Атомарно записывает снимок; rows - (user_id, маска, интервал, время дайджеста) по возрастанию id"""
+    user_ids = array("q")
+    visible_masks = array("i")
+    digest_intervals = array("i")
+    last_digests = array("d")
+    for user_id, visible_mask, digest_interval, last_digest_at in rows:
+        user_ids.append(user_id)
+        visible_masks.append(visible_mask)
+        digest_intervals.append(digest_interval)
+        last_digests.append(math.nan if last_digest_at is None else last_digest_at)
+
+    meta_bytes = json.dumps(meta, ensure_ascii=False).encode("utf-8")
+    header = _HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, time.time(), len(user_ids), len(meta_bytes))
+
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(header.ljust(_HEADER_SIZE, b"\0"))
+        f.write(meta_bytes.ljust(_aligned(len(meta_bytes)), b"\0"))
+        # int32-колонки идут парой, поэтому float64 после них остается выровненным
+        for column in (user_ids, visible_masks, digest_intervals, last_digests):
+            column.tofile(f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    return _HEADER_SIZE + _aligned(len(meta_bytes)) + len(user_ids) * 24
+
+def read_snapshot(path):
+    """Читает снимок через mmap; None, если файла нет или он поврежден"""
+    try:
+        with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            with memoryview(mm) as view:
+                magic, version, created_at, count, meta_len = _HEADER.unpack_from(view)
+                if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+                    logger.warning(f"⚠️ Снимок {path} другой версии - пропускаем")
+                    return None
+
+                offset = _HEADER_SIZE
+                meta = json.loads(bytes(view[offset:offset + meta_len]).decode("utf-8"))
+                offset += _aligned(meta_len)
+
+                columns = []
+                for typecode in ("q", "i", "i", "d"):
+                    column = array(typecode)
+                    size = count * column.itemsize
+                    column.frombytes(view[offset:offset + size])
+                    columns.append(column)
+                    offset += size
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logger.warning(f"⚠️ Не удалось прочитать снимок {path}: {e}")
+        return None
+
+    return Snapshot(created_at, meta, *columns)
@@ -0,0 +1,589 @@
+"""Soak-тест бота с внедрением сбоев.
+
+Запускает fixed4.py отдельным процессом против локальных заменителей: фейкового
+REST Discord, фейкового Bot API и настоящего PostgreSQL за управляемым
+TCP-прокси. Рестоки публикуются в фейковый Discord с постоянным интервалом, а
+сценарии по расписанию включают задержки, 429, 5xx, обрывы соединений и
+перезапуск БД. Для каждого сценария печатает пропускную способность рассылки,
+время восстановления, потерянные и продублированные уведомления.
+
+Нужна отдельная база (в имени должно быть "soak"): таблицы бота в ней очищаются.
+
+    python soak.py --database-url postgresql://postgres@localhost/postgres --users 200
+    python soak.py --scenarios baseline,db_restart --scale 0.5 --json report.json
+"""
+import argparse
+import json
+import os
+import random
+import re
+import signal
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import psycopg
+from psycopg.conninfo import conninfo_to_dict, make_conninfo
+
+from discord_monitor import DISCORD_EPOCH_MS
+from latency import percentile
+
+BOT_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixed4.py")
+CHANNEL_ID = "1407975317682917457"
+# Растение, чье количество в стоке - номер рестока: по нему уведомление сопоставляется рестоку
+MARKER_PLANT = "Cactus"
+MARKER_RE = re.compile(MARKER_PLANT + r" ×(\d+)")
+# Прочие растения рестока (не меняются, в уведомлении просто присутствуют)
+STATIC_STOCK = {"Strawberry": 5, "Pumpkin": 3, "Sunflower": 2}
+FIRST_CHAT_ID = 10_000_000
+
+# Сценарии: цель сбоя, вид, доля затронутых запросов, параметр (задержка или retry_after, с)
+SCENARIOS = {
+    "baseline": (None, None, 0, 0),
+    "discord_latency": ("discord", "latency", 1.0, 3),
+    "discord_429": ("discord", "429", 0.5, 5),
+    "discord_5xx": ("discord", "5xx", 1.0, 0),
+    "discord_reset": ("discord", "reset", 0.5, 0),
+    "telegram_latency": ("telegram", "latency", 1.0, 1),
+    "telegram_429": ("telegram", "429", 0.3, 3),
+    "telegram_5xx": ("telegram", "5xx", 0.3, 0),
+    "telegram_reset": ("telegram", "reset", 0.3, 0),
+    "db_restart": ("db", "down", 1.0, 0),
+    "db_latency": ("db", "latency", 1.0, 0.2),
+}
+
+class Fault:
+    """Текущий сбой цели; меняется из потока расписания, читается потоками серверов"""
+
+    def __init__(self):
+        self.kind = None
+        self.rate = 0
+        self.value = 0
+        self.injected = 0
+
+    def set(self, kind=None, rate=0, value=0):
+        self.kind, self.rate, self.value = kind, rate, value
+
+    def sample(self):
+        """Вид сбоя для очередного запроса или None"""
+        kind = self.kind
+        if kind is None or random.random() >= self.rate:
+            return None
+        self.injected += 1
+        return kind
+
+class QuietServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Обрывы соединений здесь - часть сценария, а не ошибка
+        pass
+
+class FakeHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, payload, headers=None):
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def reset(self):
+        """Обрыв соединения без ответа (RST вместо FIN)"""
+        self.connection.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack("ii", 1, 0))
+        self.close_connection = True
+        self.connection.close()
+
+    def inject(self, fault, too_many):
+        """Применяет сбой к запросу; True - ответ уже отправлен (или соединение оборвано)"""
+        kind = fault.sample()
+        if kind == "latency":
+            time.sleep(fault.value)
+        elif kind == "429":
+            too_many(fault.value)
+            return True
+        elif kind == "5xx":
+            self.send_json(502, {"message": "Bad Gateway"})
+            return True
+        elif kind == "reset":
+            self.reset()
+            return True
+        return False
+
+# === ФЕЙКОВЫЙ DISCORD ===
+class FakeDiscord:
+    """GET /channels/{id}/messages: сообщения канала новыми первыми, с limit и after"""
+
+    def __init__(self):
+        self.fault = Fault()
+        self.requests = 0
+        self._messages = []
+        self._lock = threading.Lock()
+        self._last_ms = 0
+
+    def post_restock(self, seq):
+        """Публикует ресток с номером seq, возвращает время публикации"""
+        with self._lock:
+            posted_at = time.time()
+            # Два сообщения в одну миллисекунду получили бы один snowflake
+            ms = max(int(posted_at * 1000), self._last_ms + 1)
+            self._last_ms = ms
+            moment = datetime.fromtimestamp(ms / 1000, timezone.utc)
+            fields = [{"name": f"🌱 {plant}", "value": f"+{count}"} for plant, count in {MARKER_PLANT: seq, **STATIC_STOCK}.items()]
+            self._messages.append({
+                "id": str((ms - DISCORD_EPOCH_MS) << 22),
+                "channel_id": CHANNEL_ID,
+                "timestamp": moment.isoformat(),
+                "embeds": [{
+                    "title": "SEEDS SHOP RESTOCK!",
+                    "author": {"name": moment.strftime("⏳ %d/%m/%Y @ %H:%M GMT")},
+                    "fields": fields,
+                }],
+            })
+        return posted_at
+
+    def messages(self, limit, after=None):
+        with self._lock:
+            if after is None:
+                page = self._messages[-limit:]
+            else:
+                # Как Discord: ближайшие limit сообщений после курсора
+                page = [message for message in self._messages if int(message["id"]) > after][:limit]
+        return list(reversed(page))
+
+    def handler(self):
+        discord = self
+
+        class Handler(FakeHandler):
+            def do_GET(self):
+                discord.requests += 1
+
+                def too_many(retry_after):
+                    self.send_json(429, {"message": "You are being rate limited.", "retry_after": retry_after, "global": False}, {
+                        "Retry-After": str(retry_after),
+                        "X-RateLimit-Remaining": "0",
+                        "X-RateLimit-Reset-After": str(retry_after),
+                        "X-RateLimit-Bucket": "soak",
+                    })
+
+                if self.inject(discord.fault, too_many):
+                    return
+                url = urlsplit(self.path)
+                match = re.fullmatch(r"/channels/(\d+)/messages", url.path)
+                if not match or match.group(1) != CHANNEL_ID:
+                    self.send_json(404, {"message": "Unknown Channel", "code": 10003})
+                    return
+                query = parse_qs(url.query)
+                limit = min(int(query.get("limit", ["50"])[0]), 100)
+                after = int(query["after"][0]) if "after" in query else None
+                self.send_json(200, discord.messages(limit, after), {
+                    "X-RateLimit-Remaining": "4",
+                    "X-RateLimit-Reset-After": "1",
+                    "X-RateLimit-Bucket": "soak",
+                })
+
+        return Handler
+
+# === ФЕЙКОВЫЙ BOT API ===
+class FakeTelegram:
+    """POST /bot{token}/{method}: запоминает доставленные уведомления о рестоках"""
+
+    def __init__(self):
+        self.fault = Fault()
+        self.polling = threading.Event()
+        self._lock = threading.Lock()
+        self._message_id = 0
+        # (chat_id, номер рестока) -> число доставок
+        self.deliveries = {}
+        # номер рестока -> моменты доставки
+        self.moments = {}
+        self.sent = 0
+
+    def deliver(self, chat_id, text):
+        with self._lock:
+            self._message_id += 1
+            self.sent += 1
+            match = MARKER_RE.search(text or "")
+            if match:
+                key = (chat_id, int(match.group(1)))
+                self.deliveries[key] = self.deliveries.get(key, 0) + 1
+                self.moments.setdefault(key[1], []).append(time.time())
+            return self._message_id
+
+    def handler(self):
+        telegram = self
+
+        class Handler(FakeHandler):
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                raw = self.rfile.read(length).decode("utf-8") if length else ""
+                if "json" in (self.headers.get("Content-Type") or ""):
+                    params = json.loads(raw or "{}")
+                else:
+                    params = {key: values[0] for key, values in parse_qs(raw).items()}
+                method = self.path.rsplit("/", 1)[-1]
+
+                if method == "getUpdates":
+                    telegram.polling.set()
+                    # Длинный опрос без апдейтов; сбои в нем не нужны - их видит только PTB
+                    time.sleep(1)
+                    self.send_json(200, {"ok": True, "result": []})
+                    return
+
+                def too_many(retry_after):
+                    self.send_json(429, {
+                        "ok": False, "error_code": 429,
+                        "description": f"Too Many Requests: retry after {retry_after}",
+                        "parameters": {"retry_after": retry_after},
+                    })
+
+                if self.inject(telegram.fault, too_many):
+                    return
+                self.send_json(200, {"ok": True, "result": telegram.respond(method, params)})
+
+        return Handler
+
+    def respond(self, method, params):
+        if method == "getMe":
+            return {"id": 1, "is_bot": True, "first_name": "Soak", "username": "soak_bot"}
+        if method == "sendMessage":
+            chat_id = int(params["chat_id"])
+            return {
+                "message_id": self.deliver(chat_id, params.get("text")),
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "text": params.get("text", ""),
+            }
+        return True
+
+# === ПРОКСИ POSTGRESQL ===
+class PgProxy:
+    """TCP-прокси к PostgreSQL: задержка на каждый пакет клиента и "перезапуск" БД.
+
+    down обрывает все открытые соединения и отклоняет новые, пока сбой не снят -
+    для бота это неотличимо от перезапуска сервера
+    """
+
+    def __init__(self, upstream):
+        self.upstream = upstream
+        self.fault = Fault()
+        self._pairs = set()
+        self._lock = threading.Lock()
+        self._listener = socket.create_server(("127.0.0.1", 0))
+        self.port = self._listener.getsockname()[1]
+
+    def _connect_upstream(self):
+        if isinstance(self.upstream, str):
+            sock = socket.socket(socket.AF_UNIX)
+            sock.connect(self.upstream)
+            return sock
+        return socket.create_connection(self.upstream)
+
+    def serve(self):
+        while True:
+            client, _ = self._listener.accept()
+            if self.fault.kind == "down":
+                self.fault.injected += 1
+                client.close()
+                continue
+            try:
+                server = self._connect_upstream()
+            except OSError:
+                client.close()
+                continue
+            pair = (client, server)
+            with self._lock:
+                self._pairs.add(pair)
+            threading.Thread(target=self._pump, args=(client, server, pair, True), daemon=True).start()
+            threading.Thread(target=self._pump, args=(server, client, pair, False), daemon=True).start()
+
+    def _pump(self, source, target, pair, from_client):
+        try:
+            while True:
+                data = source.recv(65536)
+                if not data:
+                    break
+                if from_client and self.fault.kind == "latency":
+                    self.fault.injected += 1
+                    time.sleep(self.fault.value)
+                target.sendall(data)
+        except OSError:
+            pass
+        finally:
+            self._close(pair)
+
+    def _close(self, pair):
+        with self._lock:
+            self._pairs.discard(pair)
+        for sock in pair:
+            try:
+                sock.close()
+            except OSError:
+                pass
+
+    def go_down(self):
+        self.fault.set("down", 1.0)
+        with self._lock:
+            pairs = list(self._pairs)
+        for pair in pairs:
+            for sock in pair:
+                try:
+                    sock.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack("ii", 1, 0))
+                except OSError:
+                    pass
+            self._close(pair)
+
+def pg_upstream(conninfo):
+    """Адрес сервера из строки подключения: путь unix-сокета или (хост, порт)"""
+    params = conninfo_to_dict(conninfo)
+    host = params.get("host") or "/var/run/postgresql"
+    port = int(params.get("port") or 5432)
+    if host.startswith("/"):
+        return f"{host}/.s.PGSQL.{port}"
+    return host, port
+
+def prepare_database(admin_url, dbname, users):
+    """Создает отдельную базу, схему бота и users пользователей с настройками по умолчанию"""
+    if "soak" not in dbname:
+        raise SystemExit(f"Имя базы {dbname!r} должно содержать 'soak': ее таблицы будут очищены")
+    with psycopg.connect(admin_url, autocommit=True) as conn:
+        if not conn.execute("SELECT 1 FROM pg_database WHERE datname = %s", (dbname,)).fetchone():
+            conn.execute(f'CREATE DATABASE "{dbname}"')
+
+    url = make_conninfo(admin_url, dbname=dbname)
+    os.environ["DATABASE_URL"] = url
+    from database import Database
+    if not Database().init_tables():
+        raise SystemExit("Не удалось создать схему soak-базы")
+
+    with psycopg.connect(url, autocommit=True) as conn:
+        conn.execute("TRUNCATE users, user_settings, current_stock, restock_traces")
+        conn.execute(
+            "INSERT INTO users (user_id) SELECT generate_series(%(first)s, %(first)s + %(n)s - 1)",
+            {"first": FIRST_CHAT_ID, "n": users}
+        )
+        conn.execute("INSERT INTO user_settings (user_id) SELECT user_id FROM users")
+    return url
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def start_server(handler):
+    server = QuietServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+# === СЦЕНАРИИ ===
+class Restocks:
+    """Публикует рестоки с постоянным интервалом и помнит, в каком сценарии вышел каждый"""
+
+    def __init__(self, discord, interval):
+        self.discord = discord
+        self.interval = interval
+        self.seq = 0
+        # номер рестока -> (сценарий, время публикации)
+        self.posted = {}
+        self.scenario = None
+        self._stop = threading.Event()
+
+    def post(self, scenario):
+        self.seq += 1
+        self.posted[self.seq] = (scenario, self.discord.post_restock(self.seq))
+        return self.seq
+
+    def run(self):
+        while not self._stop.wait(self.interval):
+            self.post(self.scenario)
+
+    def start(self):
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def stop(self):
+        self._stop.set()
+
+def wait_delivered(telegram, seq, users, timeout):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if len(telegram.moments.get(seq, [])) >= users:
+            return True
+        time.sleep(0.2)
+    return False
+
+def summarize(name, window, restocks, telegram, users, fault_injected):
+    """Итоги сценария по рестокам, опубликованным в его окне"""
+    started, fault_end, finished = window
+    seqs = [seq for seq, (scenario, _) in restocks.posted.items() if scenario == name]
+    expected = len(seqs) * users
+    delivered = lost = duplicated = 0
+    detection = []
+    latencies = []
+    rates = []
+    recovery = None
+    for seq in seqs:
+        posted_at = restocks.posted[seq][1]
+        moments = sorted(telegram.moments.get(seq, []))
+        counts = [telegram.deliveries.get((chat_id, seq), 0) for chat_id in range(FIRST_CHAT_ID, FIRST_CHAT_ID + users)]
+        delivered += sum(1 for count in counts if count)
+        lost += sum(1 for count in counts if not count)
+        duplicated += sum(count - 1 for count in counts if count > 1)
+        if moments:
+            detection.append(moments[0] - posted_at)
+            latencies += [moment - posted_at for moment in moments]
+            if len(moments) > 1 and moments[-1] > moments[0]:
+                rates.append((len(moments) - 1) / (moments[-1] - moments[0]))
+        # Восстановление: первый ресток после снятия сбоя, доставленный всем
+        if recovery is None and posted_at >= fault_end and all(counts):
+            recovery = moments[-1] - fault_end
+
+    return {
+        "scenario": name,
+        "restocks": len(seqs),
+        "expected": expected,
+        "delivered": delivered,
+        "lost": lost,
+        "duplicated": duplicated,
+        "faults_injected": fault_injected,
+        "detection_p50": percentile(detection, 50),
+        "delivery_p99": percentile(latencies, 99),
+        "throughput": percentile(rates, 50),
+        "recovery": recovery,
+        "window": finished - started,
+    }
+
+def format_seconds(value):
+    return "—" if value is None else f"{value:.1f}"
+
+def main():
+    parser = argparse.ArgumentParser(description="Soak-тест бота со сбоями Discord, Telegram и PostgreSQL")
+    parser.add_argument("--database-url", default=os.getenv("SOAK_DATABASE_URL") or os.getenv("DATABASE_URL"),
+                        help="подключение с правом CREATE DATABASE (по умолчанию SOAK_DATABASE_URL)")
+    parser.add_argument("--dbname", default="pvb_soak", help="отдельная база для теста")
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--restock-interval", type=float, default=10, help="пауза между рестоками, с")
+    parser.add_argument("--fault", type=float, default=30, help="длительность сбоя, с")
+    parser.add_argument("--recovery", type=float, default=30, help="наблюдение после снятия сбоя, с")
+    parser.add_argument("--drain", type=float, default=30, help="ожидание поздних доставок в конце, с")
+    parser.add_argument("--scale", type=float, default=1, help="множитель всех длительностей")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS))
+    parser.add_argument("--json", help="куда записать отчет в JSON")
+    args = parser.parse_args()
+
+    if not args.database_url:
+        parser.error("нужен --database-url или SOAK_DATABASE_URL")
+    names = [name.strip() for name in args.scenarios.split(",") if name.strip()]
+    unknown = [name for name in names if name not in SCENARIOS]
+    if unknown:
+        parser.error(f"неизвестные сценарии: {', '.join(unknown)}")
+    fault_duration = args.fault * args.scale
+    recovery_duration = args.recovery * args.scale
+    interval = args.restock_interval * args.scale
+
+    db_url = prepare_database(args.database_url, args.dbname, args.users)
+    proxy = PgProxy(pg_upstream(db_url))
+    threading.Thread(target=proxy.serve, daemon=True).start()
+    discord = FakeDiscord()
+    telegram = FakeTelegram()
+    discord_server, discord_url = start_server(discord.handler())
+    telegram_server, telegram_url = start_server(telegram.handler())
+    faults = {"discord": discord.fault, "telegram": telegram.fault, "db": proxy.fault}
+
+    restocks = Restocks(discord, interval)
+    # Начальное сообщение канала: бот берет его курсором и не рассылает
+    restocks.post("setup")
+
+    workdir = tempfile.mkdtemp(prefix="pvb-soak-")
+    log_path = os.path.join(workdir, "bot.log")
+    env = {
+        **os.environ,
+        "DATABASE_URL": make_conninfo(db_url, host="127.0.0.1", port=str(proxy.port)),
+        "DISCORD_API_BASE": discord_url,
+        "TELEGRAM_API_BASE": telegram_url,
+        "TELEGRAM_TOKEN": "123456:SOAK",
+        "DISCORD_USER_TOKEN": "soak",
+        "DISCORD_CHANNELS": f"{CHANNEL_ID}:1",
+        "DISCORD_MAX_RPS": "5",
+        "DISCORD_FAST_INTERVAL": "0.5",
+        "DISCORD_IDLE_INTERVAL": "2",
+        "RESTOCK_NOTIFY_POLICY": "any",
+        "SNAPSHOT_PATH": os.path.join(workdir, "snapshot.bin"),
+        "PORT": str(free_port()),
+    }
+    print(f"🧪 Бот: лог {log_path}, {args.users} пользователей, ресток каждые {interval:.0f} с")
+    with open(log_path, "wb") as log:
+        bot = subprocess.Popen([sys.executable, BOT_SCRIPT], env=env, stdout=log, stderr=subprocess.STDOUT)
+    try:
+        if not telegram.polling.wait(120):
+            raise SystemExit(f"Бот не начал опрос Bot API за 120 с, см. {log_path}")
+        # Пробный ресток: бот загрузил пользователей и рассылка доходит до всех
+        warmup = restocks.post("warmup")
+        if not wait_delivered(telegram, warmup, args.users, 120):
+            raise SystemExit(f"Пробный ресток не доставлен всем за 120 с, см. {log_path}")
+
+        results = []
+        restocks.start()
+        for name in names:
+            target, kind, rate, value = SCENARIOS[name]
+            restocks.scenario = name
+            started = time.time()
+            injected_before = faults[target].injected if target else 0
+            print(f"▶️ {name}: сбой {fault_duration:.0f} с, наблюдение {recovery_duration:.0f} с")
+            if target == "db" and kind == "down":
+                proxy.go_down()
+            elif target:
+                faults[target].set(kind, rate, value)
+            time.sleep(fault_duration)
+            if target:
+                faults[target].set()
+            fault_end = time.time()
+            time.sleep(recovery_duration)
+            injected = faults[target].injected - injected_before if target else 0
+            results.append((name, (started, fault_end, time.time()), injected))
+        restocks.scenario = "drain"
+        restocks.stop()
+        time.sleep(args.drain * args.scale)
+    finally:
+        bot.send_signal(signal.SIGTERM)
+        try:
+            bot.wait(30)
+        except subprocess.TimeoutExpired:
+            bot.kill()
+        discord_server.shutdown()
+        telegram_server.shutdown()
+
+    report = [summarize(name, window, restocks, telegram, args.users, injected) for name, window, injected in results]
+    print(
+        f"\n{'сценарий':<17} {'рестоков':>8} {'сбоев':>6} {'ожидалось':>9} {'доставлено':>10} {'потеряно':>8} "
+        f"{'дублей':>6} {'обнаруж. p50':>12} {'доставка p99':>12} {'сообщ/с':>8} {'восстановл.':>11}"
+    )
+    for result in report:
+        throughput = "—" if result["throughput"] is None else f"{result['throughput']:.0f}"
+        print(
+            f"{result['scenario']:<17} {result['restocks']:>8} {result['faults_injected']:>6} {result['expected']:>9} "
+            f"{result['delivered']:>10} {result['lost']:>8} {result['duplicated']:>6} "
+            f"{format_seconds(result['detection_p50']):>12} {format_seconds(result['delivery_p99']):>12} "
+            f"{throughput:>8} {format_seconds(result['recovery']):>11}"
+        )
+    print("\nВремена в секундах; восстановление - от снятия сбоя до полной доставки первого следующего рестока")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+import threading
+import time
+from contextlib import contextmanager
+
+class StartupReport:
+    """Замеры фаз запуска относительно импорта этого модуля"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self._lock = threading.Lock()
+        self._phases = []
+
+    def _offset_ms(self, moment):
+        return round((moment - self.started) * 1000, 1)
+
+    @contextmanager
+    def phase(self, name):
+        """Замеряет длительность фазы"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            with self._lock:
+                self._phases.append({
+                    "phase": name,
+                    "thread": threading.current_thread().name,
+                    "start_ms": self._offset_ms(start),
+                    "duration_ms": round((end - start) * 1000, 1),
+                })
+
+    def mark(self, name):
+        """Отмечает момент без длительности (например, готовность обслуживать апдейты)"""
+        now = time.perf_counter()
+        with self._lock:
+            self._phases.append({
+                "phase": name,
+                "thread": threading.current_thread().name,
+                "start_ms": self._offset_ms(now),
+                "duration_ms": 0,
+            })
+
+    def as_dict(self):
+        with self._lock:
+            return {"phases": sorted(self._phases, key=lambda phase: phase["start_ms"])}
+
+    def format(self):
+        """Текстовый отчет о запуске"""
+        lines = ["⏱️ Отчет о запуске:"]
+        for phase in self.as_dict()["phases"]:
+            line = f"├─ {phase['phase']}: +{phase['start_ms']} мс"
+            if phase["duration_ms"]:
+                line += f", {phase['duration_ms']} мс"
+            line += f" [{phase['thread']}]"
+            lines.append(line)
+        return "\n".join(lines)
+
+startup_report = StartupReport()
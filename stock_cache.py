@@ -0,0 +1,90 @@
+import asyncio
+import logging
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+# Через сколько секунд сток считается устаревшим и перепроверяется в фоне
+STOCK_CACHE_MAX_AGE = float(os.getenv("STOCK_CACHE_MAX_AGE", 60))
+# Сколько секунд не повторять неудачную загрузку (стока нигде нет или ошибка)
+STOCK_CACHE_RETRY_AFTER = 10
+
+class StockCache:
+    """Кеш последнего стока для обработчиков.
+
+    Свежее значение отдается сразу. Устаревшее (старше max_age) тоже отдается
+    сразу, а перепроверка идет в фоне. Без значения все ожидающие делят одну
+    загрузку (single-flight), поэтому холодный старт и всплеск запросов стоят
+    одного обращения к БД/Discord. Монитор Discord кладет новый сток через set()
+    """
+
+    def __init__(self, loader, max_age=STOCK_CACHE_MAX_AGE):
+        self._loader = loader
+        self.max_age = max_age
+        # (сток, время рестока, момент получения)
+        self._entry = None
+        self._retry_at = 0
+        self._inflight = None
+        self.stats = {"fresh": 0, "stale": 0, "misses": 0, "fetches": 0, "coalesced": 0}
+
+    def set(self, stock_data, time_info):
+        """Новый сток от монитора Discord (можно вызывать из любого потока)"""
+        self._entry = (stock_data, time_info, time.monotonic())
+
+    def peek(self):
+        """Сток из кеша без загрузки и без учета в статистике: (stock_data, time_info) или (None, None)"""
+        entry = self._entry
+        return (entry[0], entry[1]) if entry else (None, None)
+
+    async def get(self):
+        """Последний сток (stock_data, time_info) или (None, None)"""
+        entry = self._entry
+        if entry is not None:
+            if time.monotonic() - entry[2] < self.max_age:
+                self.stats["fresh"] += 1
+            else:
+                self.stats["stale"] += 1
+                if time.monotonic() >= self._retry_at:
+                    self._refresh()
+            return entry[0], entry[1]
+
+        self.stats["misses"] += 1
+        if time.monotonic() < self._retry_at:
+            return None, None
+        # shield: отмена одного ожидающего не отменяет общую загрузку
+        return await asyncio.shield(self._refresh())
+
+    def _refresh(self):
+        """Запускает загрузку, если она еще не идет, и возвращает ее задачу"""
+        if self._inflight is None or self._inflight.done():
+            self.stats["fetches"] += 1
+            self._inflight = asyncio.ensure_future(self._load())
+        else:
+            self.stats["coalesced"] += 1
+        return self._inflight
+
+    async def _load(self):
+        started = time.monotonic()
+        try:
+            stock_data, time_info = await self._loader()
+        except Exception as e:
+            logger.error(f"❌ Ошибка загрузки стока: {e}")
+            stock_data, time_info = None, None
+
+        entry = self._entry
+        if stock_data:
+            # Не затираем сток, который монитор положил, пока шла загрузка
+            if entry is None or entry[2] <= started:
+                self._entry = entry = (stock_data, time_info, time.monotonic())
+        else:
+            self._retry_at = time.monotonic() + STOCK_CACHE_RETRY_AFTER
+        return (entry[0], entry[1]) if entry else (None, None)
+
+    def snapshot(self):
+        entry = self._entry
+        return {
+            "age": round(time.monotonic() - entry[2], 1) if entry else None,
+            "max_age": self.max_age,
+            **self.stats,
+        }
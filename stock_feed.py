@@ -0,0 +1,160 @@
+import hashlib
+import json
+import threading
+import time
+from collections import deque
+from email.utils import formatdate, parsedate_to_datetime
+from typing import NamedTuple
+
+from plants import PLANTS_RARITY, PLANT_ORDER, RARITY_BIT, RARITY_ORDER, ALL_RARITIES_MASK
+
+# Сколько последних событий хранится для переподключившихся SSE-клиентов (Last-Event-ID)
+STOCK_STREAM_BUFFER = 32
+# Пауза между комментариями keepalive в SSE, секунд
+STOCK_STREAM_KEEPALIVE = 15
+# Через сколько миллисекунд браузер переподключается к SSE
+STOCK_STREAM_RETRY_MS = 5000
+
+_PLANT_POSITION = {plant: i for i, plant in enumerate(PLANT_ORDER)}
+
+class StockView(NamedTuple):
+    """Готовый ответ /stock: тело сериализуется один раз на ресток и фильтр"""
+    body: bytes
+    etag: str
+    last_modified: str
+    modified_at: int
+
+    def not_modified(self, if_none_match=None, if_modified_since=None):
+        """Условный GET: If-None-Match важнее If-Modified-Since"""
+        if if_none_match:
+            tags = [tag.strip() for tag in if_none_match.split(",")]
+            return "*" in tags or any(tag.removeprefix("W/") == self.etag for tag in tags)
+        if if_modified_since:
+            try:
+                return parsedate_to_datetime(if_modified_since).timestamp() >= self.modified_at
+            except (TypeError, ValueError):
+                return False
+        return False
+
+def parse_rarity_filter(value):
+    """Маска редкостей из "GODLY,SECRET" (регистр не важен); пусто - все редкости"""
+    if not value:
+        return ALL_RARITIES_MASK
+    mask = 0
+    for rarity in value.split(","):
+        rarity = rarity.strip().upper()
+        if rarity not in RARITY_BIT:
+            raise ValueError(f"unknown rarity {rarity!r}, expected one of {','.join(RARITY_ORDER)}")
+        mask |= RARITY_BIT[rarity]
+    return mask
+
+class StockFeed:
+    """Последний сток для публичного HTTP API.
+
+    JSON собирается один раз на ресток (отфильтрованные по редкости варианты -
+    при первом запросе фильтра), ETag и Last-Modified позволяют опрашивающим
+    получать 304. SSE-клиенты читают один общий буфер событий: новый ресток
+    сериализуется один раз, сколько бы клиентов ни было подключено
+    """
+
+    def __init__(self, buffer_size=STOCK_STREAM_BUFFER):
+        self._cond = threading.Condition()
+        # (сток, время рестока, id сообщения, время публикации)
+        self._stock = None
+        # маска редкостей -> StockView текущего стока
+        self._views = {}
+        # (id события, готовые байты события)
+        self._events = deque(maxlen=buffer_size)
+        self.clients = 0
+        self.stats = {"published": 0, "served": 0, "not_modified": 0, "events_sent": 0}
+
+    def publish(self, stock_data, time_info, message_id=None):
+        """Новый сток (из любого потока); повтор того же стока ничего не меняет"""
+        with self._cond:
+            if self._stock and self._stock[0] == stock_data and self._stock[1] == time_info:
+                return
+            modified_at = int(time.time())
+            self._stock = (stock_data, time_info, message_id, modified_at)
+            full = self._render(ALL_RARITIES_MASK)
+            self._views = {ALL_RARITIES_MASK: full}
+            # id события - время публикации в мс: растет и между перезапусками
+            event_id = max(time.time_ns() // 1_000_000, self._events[-1][0] + 1 if self._events else 0)
+            self._events.append((event_id, b"id: %d\nevent: stock\ndata: %s\n\n" % (event_id, full.body)))
+            self.stats["published"] += 1
+            self._cond.notify_all()
+
+    def view(self, rarity_mask=ALL_RARITIES_MASK):
+        """Ответ для фильтра редкостей или None, пока стока нет"""
+        view = self._views.get(rarity_mask)
+        if view is None:
+            with self._cond:
+                if self._stock is None:
+                    return None
+                view = self._views.get(rarity_mask)
+                if view is None:
+                    view = self._views[rarity_mask] = self._render(rarity_mask)
+        return view
+
+    def lookup(self, rarity_mask, if_none_match=None, if_modified_since=None):
+        """Ответ для запроса: (StockView или None, не изменился ли с версии клиента)"""
+        view = self.view(rarity_mask)
+        if view is None:
+            return None, False
+        if view.not_modified(if_none_match, if_modified_since):
+            self.stats["not_modified"] += 1
+            return view, True
+        self.stats["served"] += 1
+        return view, False
+
+    def _render(self, rarity_mask):
+        stock_data, time_info, message_id, modified_at = self._stock
+        # Растения неизвестной редкости попадают только в ответ без фильтра
+        plants = [
+            {"name": plant, "rarity": PLANTS_RARITY.get(plant), "count": stock_data[plant]}
+            for plant in sorted(stock_data, key=lambda plant: _PLANT_POSITION.get(plant, len(PLANT_ORDER)))
+            if rarity_mask == ALL_RARITIES_MASK or RARITY_BIT.get(PLANTS_RARITY.get(plant), 0) & rarity_mask
+        ]
+        body = json.dumps({
+            "restock_time": time_info,
+            "message_id": message_id,
+            "updated_at": modified_at,
+            "plants": plants,
+        }, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        etag = '"%s"' % hashlib.blake2b(body, digest_size=8).hexdigest()
+        return StockView(body, etag, formatdate(modified_at, usegmt=True), modified_at)
+
+    def events(self, last_event_id=None):
+        """Генератор SSE: пропущенные события из буфера (или текущий сток), затем новые"""
+        with self._cond:
+            self.clients += 1
+        try:
+            yield b"retry: %d\n\n" % STOCK_STREAM_RETRY_MS
+            with self._cond:
+                pending = [event for event in self._events if last_event_id is not None and event[0] > last_event_id]
+                if not pending and self._events and self._events[-1][0] != last_event_id:
+                    # Новый клиент или разрыв длиннее буфера - отдаем текущий сток
+                    pending = [self._events[-1]]
+            sent = last_event_id or 0
+            while True:
+                for event_id, data in pending:
+                    yield data
+                    sent = event_id
+                self.stats["events_sent"] += len(pending)
+                with self._cond:
+                    if not self._events or self._events[-1][0] <= sent:
+                        self._cond.wait(STOCK_STREAM_KEEPALIVE)
+                    pending = [event for event in self._events if event[0] > sent]
+                if not pending:
+                    yield b": keepalive\n\n"
+        finally:
+            with self._cond:
+                self.clients -= 1
+
+    def snapshot(self):
+        stock = self._stock
+        return {
+            "updated_at": stock[3] if stock else None,
+            "views": len(self._views),
+            "stream_clients": self.clients,
+            **self.stats,
+        }
@@ -0,0 +1,27 @@
+"""Служебные HTTP-эндпоинты закрыты тем же токеном, что и /debug/profile"""
+import pytest
+
+import fixed4
+
+OPERATOR_ROUTES = ["/startup", "/api_calls", "/lanes", "/polling", "/debug/profile"]
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(fixed4, "PROFILE_TOKEN", "secret")
+    return fixed4.app.test_client()
+
+@pytest.mark.parametrize("route", OPERATOR_ROUTES + ["/latency"])
+def test_operator_routes_require_token(client, route):
+    assert client.get(route).status_code == 403
+    assert client.get(route, headers={"X-Profile-Token": "wrong"}).status_code == 403
+
+@pytest.mark.parametrize("route", ["/startup", "/api_calls", "/lanes", "/polling"])
+def test_operator_routes_accept_token(client, route):
+    assert client.get(route, headers={"X-Profile-Token": "secret"}).status_code == 200
+    assert client.get(route, query_string={"token": "secret"}).status_code == 200
+
+def test_routes_closed_without_configured_token(monkeypatch):
+    monkeypatch.setattr(fixed4, "PROFILE_TOKEN", None)
+    client = fixed4.app.test_client()
+    for route in OPERATOR_ROUTES:
+        assert client.get(route, query_string={"token": ""}).status_code == 403
@@ -0,0 +1,57 @@
+"""Подсчет сетевых проходов блока пайплайна"""
+from collections import deque
+from functools import partial
+from types import SimpleNamespace
+
+from database import DbCallStats, PipelineCounter
+
+class FakePgconn:
+    def pipeline_sync(self):
+        pass
+
+    def send_prepare(self, *args):
+        pass
+
+    def send_query_prepared(self, *args):
+        pass
+
+def make_pipeline():
+    pipeline = SimpleNamespace(command_queue=deque(), result_queue=deque())
+    pipeline._fetch_gen = lambda *, flush: iter(())
+    return pipeline
+
+def test_counts_syncs_flushes_and_prepares():
+    pgconn = FakePgconn()
+    pipeline = make_pipeline()
+    counter = PipelineCounter(pipeline)
+
+    pipeline.command_queue.append(partial(pgconn.send_prepare, b"_pg3_0"))
+    pipeline.command_queue.append(partial(pgconn.send_query_prepared, b"_pg3_0"))
+    pipeline.result_queue.append(object())
+    # Чтение результата внутри блока: Flush и ожидание ответа
+    list(pipeline._fetch_gen(flush=True))
+    # Выход из блока: Sync, дочитывание после него прохода не добавляет
+    counter.closing = True
+    pipeline.command_queue.append(pgconn.pipeline_sync)
+    list(pipeline._fetch_gen(flush=True))
+
+    assert (counter.syncs, counter.flushes, counter.prepares) == (1, 1, 1)
+    assert counter.round_trips == 2
+    assert len(pipeline.command_queue) == 3
+
+def test_flush_without_pending_results_is_not_a_round_trip():
+    pipeline = make_pipeline()
+    counter = PipelineCounter(pipeline)
+    list(pipeline._fetch_gen(flush=True))
+    assert counter.round_trips == 0
+
+def test_stats_report_round_trips_per_method():
+    stats = DbCallStats()
+    stats.record("get_user_settings", 1, 1, 2.0, True)
+    stats.record("get_user_settings", 2, 0, 4.0, False)
+    snapshot = stats.snapshot()["get_user_settings"]
+    assert snapshot["calls"] == 2
+    assert snapshot["round_trips"] == 3
+    assert snapshot["round_trips_per_call"] == 1.5
+    assert snapshot["prepares"] == 1
+    assert snapshot["errors"] == 1
@@ -0,0 +1,23 @@
+"""Длительность профилирования из запроса и освобождение профайлера"""
+import pytest
+
+import profiler
+from profiler import PROFILE_MAX_SECONDS, SamplingProfiler, profile_blocking, profile_seconds
+
+def test_profile_seconds_is_clamped():
+    assert profile_seconds("-1") == 1
+    assert profile_seconds("5") == 5
+    assert profile_seconds("inf") == PROFILE_MAX_SECONDS
+
+@pytest.mark.parametrize("value", ["nan", "NaN", "abc"])
+def test_profile_seconds_rejects_invalid(value):
+    with pytest.raises(ValueError):
+        profile_seconds(value)
+
+def test_failed_sleep_releases_profiler(monkeypatch):
+    def broken_sleep(seconds):
+        raise ValueError("sleep length must be non-negative")
+    monkeypatch.setattr(profiler.time, "sleep", broken_sleep)
+    with pytest.raises(ValueError):
+        profile_blocking(1)
+    assert not SamplingProfiler._busy.locked()
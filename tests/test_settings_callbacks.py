@@ -0,0 +1,104 @@
+"""Кнопки меню настроек доходят до handle_settings_callback"""
+import asyncio
+from unittest.mock import AsyncMock, MagicMock
+
+import pytest
+from telegram import Update
+from telegram.ext import Application
+
+import fixed4
+from plants import ALERT_KINDS
+
+USER_ID = 42
+
+def make_application():
+    application = Application.builder().token("123:TEST").build()
+    fixed4.register_handlers(application)
+    return application
+
+def callback_update(application, data):
+    return Update.de_json({
+        "update_id": 1,
+        "callback_query": {
+            "id": "1",
+            "from": {"id": USER_ID, "is_bot": False, "first_name": "test"},
+            "chat_instance": "1",
+            "data": data,
+        },
+    }, application.bot)
+
+def routed_callback(application, data):
+    """Обработчик, которому PTB отдаст нажатие (первый подходящий в группе 0)"""
+    update = callback_update(application, data)
+    for handler in application.handlers[0]:
+        if handler.check_update(update):
+            return getattr(handler.callback, "__wrapped__", handler.callback)
+    return None
+
+def press(data):
+    """Нажатие кнопки напрямую в handle_settings_callback, возвращает мок query"""
+    query = MagicMock()
+    query.data = data
+    query.message = None
+    query.answer = AsyncMock()
+    query.edit_message_text = AsyncMock()
+    update = MagicMock()
+    update.callback_query = query
+    update.effective_user.id = USER_ID
+    asyncio.run(fixed4.handle_settings_callback(update, None))
+    return query
+
+def setup_function():
+    fixed4.temp_settings[USER_ID] = fixed4.db._get_default_settings()
+
+def teardown_function():
+    fixed4.temp_settings.pop(USER_ID, None)
+
+def test_alert_buttons_reach_settings_callback():
+    application = make_application()
+    for kind in ALERT_KINDS:
+        assert routed_callback(application, f"alert_{kind}") is fixed4.handle_settings_callback
+
+def test_alert_toggle_updates_temp_settings_and_redraws_menu():
+    query = press("alert_gear")
+    assert fixed4.temp_settings[USER_ID]["alert_kinds"] == 1 << ALERT_KINDS.index("gear")
+    query.edit_message_text.assert_awaited_once()
+
+    press("alert_gear")
+    assert fixed4.temp_settings[USER_ID]["alert_kinds"] == 0
+
+def test_every_settings_menu_button_is_routed():
+    application = make_application()
+    for data in ("settings_menu", "plants_menu"):
+        query = press(data)
+        reply_markup = query.edit_message_text.await_args.kwargs["reply_markup"]
+        for row in reply_markup.inline_keyboard:
+            for button in row:
+                assert routed_callback(application, button.callback_data) is fixed4.handle_settings_callback, button.callback_data
+
+def queue_presses(monkeypatch, *data):
+    """В очереди пользователя за текущим апдейтом - нажатия data (None - не нажатие)"""
+    queued = []
+    for item in data:
+        if item is None:
+            queued.append(None)
+            continue
+        query = MagicMock()
+        query.data = item
+        query.message = None
+        queued.append(query)
+    monkeypatch.setattr(fixed4.update_processor, "queued_callbacks", lambda key: queued)
+
+def test_queued_toggles_debounce_redraw(monkeypatch):
+    queue_presses(monkeypatch, "toggle_GODLY", "alert_gear")
+    query = press("toggle_SECRET")
+    query.edit_message_text.assert_not_awaited()
+
+@pytest.mark.parametrize("queued", [
+    ("test_filter",), ("check_subscription",), ("plants_menu",), ("toggle_GODLY", "confirm_changes"),
+    ("plant_Mr Carrot",), (None,),
+])
+def test_other_queued_updates_do_not_skip_redraw(monkeypatch, queued):
+    queue_presses(monkeypatch, *queued)
+    query = press("toggle_SECRET")
+    query.edit_message_text.assert_awaited_once()
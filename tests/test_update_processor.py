@@ -0,0 +1,39 @@
+"""Очередь апдейтов пользователя в PerUserUpdateProcessor"""
+import asyncio
+from types import SimpleNamespace
+
+from update_processor import PerUserUpdateProcessor
+
+USER = SimpleNamespace(id=1)
+
+def make_update(data=None):
+    query = SimpleNamespace(data=data) if data is not None else None
+    return SimpleNamespace(effective_user=USER, callback_query=query)
+
+def test_queued_callbacks_in_order():
+    async def scenario():
+        processor = PerUserUpdateProcessor(max_concurrent_updates=4)
+        started = asyncio.Event()
+        release = asyncio.Event()
+        seen = []
+
+        async def first():
+            started.set()
+            await release.wait()
+            seen.append([query and query.data for query in processor.queued_callbacks(USER.id)])
+
+        async def noop():
+            seen.append([query and query.data for query in processor.queued_callbacks(USER.id)])
+
+        tasks = [asyncio.create_task(processor.do_process_update(make_update("toggle_GODLY"), first()))]
+        await started.wait()
+        for update in (make_update("toggle_SECRET"), make_update(), make_update("test_filter")):
+            tasks.append(asyncio.create_task(processor.do_process_update(update, noop())))
+        await asyncio.sleep(0)
+        release.set()
+        await asyncio.gather(*tasks)
+        return seen, processor.queued_callbacks(USER.id)
+
+    seen, left = asyncio.run(scenario())
+    assert seen == [["toggle_SECRET", None, "test_filter"], [None, "test_filter"], ["test_filter"], []]
+    assert left == []
@@ -0,0 +1,99 @@
+import os
+import time
+
+# Скорость пополнения личного лимита апдейтов, апдейтов в секунду
+THROTTLE_RATE = float(os.getenv("THROTTLE_RATE", 1))
+# Сколько апдейтов пользователь может прислать подряд без ожидания
+THROTTLE_BURST = int(os.getenv("THROTTLE_BURST", 8))
+# Сколько секунд повторный запрос стока получает уже отправленный ответ (то есть ничего)
+STOCK_REPLY_WINDOW = float(os.getenv("STOCK_REPLY_WINDOW", 5))
+# Сколько записей держим, прежде чем вычистить устаревшие
+_PRUNE_AT = 10000
+
+class TokenBuckets:
+    """Личные лимиты апдейтов (token bucket) по ключу пользователя.
+
+    Каждый апдейт тратит токен, токены пополняются со скоростью rate до burst.
+    Работает в одном цикле событий (цикл Telegram), поэтому без блокировок
+    """
+
+    def __init__(self, rate=THROTTLE_RATE, burst=THROTTLE_BURST):
+        self.rate = rate
+        self.burst = burst
+        # key -> [токены, момент обновления, отказано подряд]
+        self._buckets = {}
+        self.stats = {"allowed": 0, "rejected": 0, "throttled_users": 0}
+
+    def allow(self, key, now=None):
+        """Тратит токен; False - лимит исчерпан"""
+        now = time.monotonic() if now is None else now
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            if len(self._buckets) >= _PRUNE_AT:
+                self._prune(now)
+            bucket = self._buckets[key] = [float(self.burst), now, 0]
+        else:
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+
+        if bucket[0] >= 1:
+            bucket[0] -= 1
+            bucket[2] = 0
+            self.stats["allowed"] += 1
+            return True
+
+        bucket[2] += 1
+        self.stats["rejected"] += 1
+        if bucket[2] == 1:
+            self.stats["throttled_users"] += 1
+        return False
+
+    def available(self, key, now=None):
+        """Сколько апдейтов подряд пропустит лимит сейчас (токен не тратится)"""
+        now = time.monotonic() if now is None else now
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            return self.burst
+        return int(min(self.burst, bucket[0] + (now - bucket[1]) * self.rate))
+
+    def first_rejection(self, key):
+        """Первый ли это отказ подряд (о лимите сообщаем один раз)"""
+        bucket = self._buckets.get(key)
+        return bucket is not None and bucket[2] == 1
+
+    def _prune(self, now):
+        # Полностью восстановившийся лимит ничем не отличается от нового
+        full_after = self.burst / self.rate if self.rate > 0 else float("inf")
+        self._buckets = {key: bucket for key, bucket in self._buckets.items() if now - bucket[1] < full_after}
+
+    def snapshot(self):
+        return {"rate": self.rate, "burst": self.burst, "tracked_users": len(self._buckets), **self.stats}
+
+class RecentReplies:
+    """Что и когда пользователь уже получил: повтор того же ответа в окне не отправляется"""
+
+    def __init__(self, window=STOCK_REPLY_WINDOW):
+        self.window = window
+        # key -> (значение, момент отправки)
+        self._sent = {}
+
+    def is_recent(self, key, value, now=None):
+        """Тот же ответ уже отправлен в пределах окна"""
+        now = time.monotonic() if now is None else now
+        entry = self._sent.get(key)
+        return entry is not None and entry[0] == value and now - entry[1] < self.window
+
+    def has_recent(self, key, now=None):
+        """Хоть какой-то ответ отправлен в пределах окна"""
+        now = time.monotonic() if now is None else now
+        entry = self._sent.get(key)
+        return entry is not None and now - entry[1] < self.window
+
+    def remember(self, key, value, now=None):
+        now = time.monotonic() if now is None else now
+        if len(self._sent) >= _PRUNE_AT:
+            self._sent = {k: entry for k, entry in self._sent.items() if now - entry[1] < self.window}
+        self._sent[key] = (value, now)
+
+    def forget(self, key):
+        self._sent.pop(key, None)
@@ -0,0 +1,91 @@
+import asyncio
+import os
+
+from telegram.ext import BaseUpdateProcessor
+
+# Сколько апдейтов разных пользователей обрабатывается одновременно
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", 64))
+# Сколько апдейтов может ждать своей очереди (включая выполняющиеся)
+UPDATE_MAX_PENDING = int(os.getenv("UPDATE_MAX_PENDING", 4096))
+
+def update_user_key(update):
+    """Ключ упорядочивания апдейта: пользователь, иначе чат"""
+    user = getattr(update, "effective_user", None)
+    if user is not None:
+        return user.id
+    chat = getattr(update, "effective_chat", None)
+    return chat.id if chat is not None else None
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Параллельная обработка апдейтов разных пользователей, последовательная - одного.
+
+    Апдейты одного пользователя (нажатия в меню настроек, temp_settings) идут
+    строго по порядку. Слот параллельности занимается только после очереди
+    пользователя, поэтому пользователь, накидавший много апдейтов, держит
+    не больше одного слота и не тормозит остальных
+    """
+
+    def __init__(self, max_concurrent_updates=UPDATE_CONCURRENCY, max_pending_updates=UPDATE_MAX_PENDING):
+        # Семафор базового класса ограничивает число принятых апдейтов,
+        # собственный - число выполняющихся
+        super().__init__(max(max_pending_updates, max_concurrent_updates))
+        self.concurrency = max_concurrent_updates
+        self._running = asyncio.Semaphore(max_concurrent_updates)
+        self._active = 0
+        # user_id -> [Lock, число апдейтов пользователя в работе или в очереди,
+        #             апдейты в очереди (еще не начатые): объект-метка -> callback_query или None]
+        self._user_locks = {}
+
+    async def do_process_update(self, update, coroutine):
+        key = update_user_key(update)
+        if key is None:
+            async with self._running:
+                await self._run(coroutine)
+            return
+
+        entry = self._user_locks.get(key)
+        if entry is None:
+            entry = self._user_locks[key] = [asyncio.Lock(), 0, {}]
+        mark = object()
+        entry[1] += 1
+        entry[2][mark] = getattr(update, "callback_query", None)
+        try:
+            async with entry[0]:
+                # Апдейт начал выполняться - из очереди он выходит
+                del entry[2][mark]
+                mark = None
+                async with self._running:
+                    await self._run(coroutine)
+        finally:
+            # Отмененный в очереди апдейт тоже снимаем с учета
+            if mark is not None:
+                del entry[2][mark]
+            entry[1] -= 1
+            if not entry[1]:
+                del self._user_locks[key]
+
+    def queued_callbacks(self, key):
+        """Апдейты пользователя в очереди за текущим по порядку: callback_query нажатия или None"""
+        entry = self._user_locks.get(key)
+        return list(entry[2].values()) if entry else []
+
+    async def _run(self, coroutine):
+        self._active += 1
+        try:
+            await coroutine
+        finally:
+            self._active -= 1
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def snapshot(self):
+        return {
+            "concurrency": self.concurrency,
+            "running": self._active,
+            "users_pending": len(self._user_locks),
+            "accepted": self.current_concurrent_updates,
+        }